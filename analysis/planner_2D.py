@@ -131,12 +131,13 @@ class Planner2D(Planner):
                  'keep_only_largest_region': store_largest_connected_component,
                  'min_region_size_per_class': min_region_size_per_class, 'min_size_per_class': min_size_per_class,
                  'transpose_forward': self.transpose_forward, 'transpose_backward': self.transpose_backward,
-                 'data_identifier': self.data_identifier, 'plans_per_stage': self.plans_per_stage}
+                 'data_identifier': self.data_identifier, 'plans_per_stage': self.plans_per_stage,
+                 'resampling': self.resampling}
 
         self.plans = plans
         self.save_plans()
 
-    def do_preprocessing(self, num_threads):
+    def do_preprocessing(self, num_threads, storage_format="npz", storage_dtype="float32"):
         if os.path.isdir(join(self.preprocessing_out_folder, "gt_segmentations")):
             shutil.rmtree(join(self.preprocessing_out_folder, "gt_segmentations"))
         shutil.copytree(join(self.folder_of_cropped_data, "gt_segmentations"), join(self.preprocessing_out_folder,
@@ -145,10 +146,12 @@ class Planner2D(Planner):
         use_nonzero_mask_for_normalization = self.plans['use_mask_for_norm']
         intensityproperties = self.plans['dataset_properties']['intensityproperties']
         preprocessor = Preprocessor2D(normalization_schemes, use_nonzero_mask_for_normalization,
-                                           intensityproperties, self.transpose_forward[0])
+                                           intensityproperties, self.transpose_forward[0],
+                                           self.plans.get('resampling', "spline"))
         target_spacings = [i["current_spacing"] for i in self.plans_per_stage.values()]
         preprocessor.run(target_spacings, self.folder_of_cropped_data, self.preprocessing_out_folder,
-                         self.plans['data_identifier'], num_threads)
+                         self.plans['data_identifier'], num_threads, storage_format=storage_format,
+                         storage_dtype=storage_dtype)
 
 if __name__ == "__main__":
     t = "Task_BoneSeg"
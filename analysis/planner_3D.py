@@ -30,6 +30,8 @@ class Planner(object):
         self.plans = OrderedDict()
         self.plans_fname = join(self.preprocessing_out_folder, default_plans_identifier + "_plans_3D.pkl")
         self.data_identifier = 'UNet'
+        # spline or separable, see preprocessing.preprocessor.resampling_functions
+        self.resampling = "spline"
 
     def get_target_spacing(self):
         spacings = self.dataset_properties['all_spacings']
@@ -254,7 +256,8 @@ class Planner(object):
                  'use_mask_for_norm': use_nonzero_mask_for_normalization,
                  'keep_only_largest_region': store_largest_connected_component,
                  'min_region_size_per_class': min_region_size_per_class, 'min_size_per_class': min_size_per_class,
-                 'data_identifier': self.data_identifier, 'plans_per_stage': self.plans_per_stage}
+                 'data_identifier': self.data_identifier, 'plans_per_stage': self.plans_per_stage,
+                 'resampling': self.resampling}
 
         self.plans = plans
         self.save_plans()
@@ -319,7 +322,7 @@ class Planner(object):
             properties['use_nonzero_mask_for_norm'] = self.plans['use_mask_for_norm']
             self.save_cropped_properties(case_identifier, properties)
 
-    def do_preprocessing(self, num_threads):
+    def do_preprocessing(self, num_threads, storage_format="npz", storage_dtype="float32"):
         if os.path.isdir(join(self.preprocessing_out_folder, "gt_segmentations")):
             shutil.rmtree(join(self.preprocessing_out_folder, "gt_segmentations"))
         shutil.copytree(join(self.folder_of_cropped_data, "gt_segmentations"), 
@@ -328,14 +331,15 @@ class Planner(object):
         use_nonzero_mask_for_normalization = self.plans['use_mask_for_norm']
         intensityproperties = self.plans['dataset_properties']['intensityproperties']
         preprocessor = GenericPreprocessor(normalization_schemes, use_nonzero_mask_for_normalization,
-                                           intensityproperties)
+                                           intensityproperties, self.plans.get('resampling', "spline"))
         target_spacings = [i["current_spacing"] for i in self.plans_per_stage.values()]
         if self.plans['num_stages'] > 1 and not isinstance(num_threads, (list, tuple)):
             num_threads = (8, num_threads)
         elif self.plans['num_stages'] == 1 and isinstance(num_threads, (list, tuple)):
             num_threads = num_threads[-1]
         preprocessor.run(target_spacings, self.folder_of_cropped_data, self.preprocessing_out_folder,
-                         self.plans['data_identifier'], num_threads)
+                         self.plans['data_identifier'], num_threads, storage_format=storage_format,
+                         storage_dtype=storage_dtype)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 
 from utils.analysis_utils import contain_classes_in_slice, split_4D_nifti
 from preprocessing.cropping import ImgCropper
+from preprocessing.chunked_store import get_chunked_case_identifiers, chunked_case_suffix
 from utils.files_utils import *
 from default_configs import splitted_4D_out_dir, cropped_output_dir, preprocessing_output_dir, raw_dataset_dir
 import numpy as np
@@ -105,7 +106,8 @@ def analyze_dataset(task_string, override=False, collect_intensityproperties=Tru
     _ = dataset_analyzer.analyze_dataset(collect_intensityproperties)
 
 
-def plan_and_preprocess(task_string, num_threads=8, no_preprocessing=False):
+def plan_and_preprocess(task_string, num_threads=8, no_preprocessing=False, storage_format="npz",
+                        storage_dtype="float32", resampling="spline"):
     from analysis.planner_2D import Planner2D
     from analysis.planner_3D import Planner
 
@@ -117,14 +119,16 @@ def plan_and_preprocess(task_string, num_threads=8, no_preprocessing=False):
     shutil.copy(join(splitted_4D_out_dir, task_string, "dataset.json"), preprocessing_out_dir_train)
 
     exp_planner = Planner(cropped_out_dir, preprocessing_out_dir_train)
+    exp_planner.resampling = resampling
     exp_planner.plan_exps()
     if not no_preprocessing:
-        exp_planner.do_preprocessing(num_threads)
+        exp_planner.do_preprocessing(num_threads, storage_format, storage_dtype)
 
     exp_planner = Planner2D(cropped_out_dir, preprocessing_out_dir_train)
+    exp_planner.resampling = resampling
     exp_planner.plan_exps()
     if not no_preprocessing:
-        exp_planner.do_preprocessing(num_threads)
+        exp_planner.do_preprocessing(num_threads, storage_format, storage_dtype)
 
     if not no_preprocessing:
         p = Pool(8)
@@ -135,6 +139,9 @@ def plan_and_preprocess(task_string, num_threads=8, no_preprocessing=False):
             print(s.split("/")[-1])
             list_of_npz_files = subfiles(s, True, None, ".npz", True)
             list_of_pkl_files = [i[:-4]+".pkl" for i in list_of_npz_files]
+            chunked_cases = get_chunked_case_identifiers(s)
+            list_of_npz_files += [join(s, i + chunked_case_suffix) for i in chunked_cases]
+            list_of_pkl_files += [join(s, i + ".pkl") for i in chunked_cases]
             all_classes = []
             for pk in list_of_pkl_files:
                 with open(pk, 'rb') as f:
@@ -161,6 +168,17 @@ def main():
                         '0: do splitting again. Default: 1', required=False)
     parser.add_argument('-no_preprocessing', type=int, default=0, 
                         help='debug only. 1: only run experiment planning, not run preprocessing.')
+    parser.add_argument('--storage_format', type=str, default="npz", choices=["npz", "chunked"],
+                        help='npz: compressed npz per case (needs unpacking for fast training). chunked: per case '
+                             'folder with separately compressed chunks, the data loaders only read the chunks of a '
+                             'patch. Default: npz', required=False)
+    parser.add_argument('--storage_dtype', type=str, default="float32", choices=["float32", "float16", "bfloat16"],
+                        help='precision of the stored intensities (chunked only, the segmentation is int8). Half '
+                             'precision halves disk and page cache usage. Default: float32', required=False)
+    parser.add_argument('--resampling', type=str, default="spline", choices=["spline", "separable"],
+                        help='spline: skimage resize (+ map_coordinates along z for anisotropic data). separable: one '
+                             '1D interpolation pass per axis, see bins/compare_resampling.py. Stored in the plans. '
+                             'Default: spline', required=False)
 
     args = parser.parse_args()
     task = args.task
@@ -202,7 +220,8 @@ def main():
         for t in all_splitted_tasks:
             crop(t, override=override, num_threads=processes)
             analyze_dataset(t, override=override, collect_intensityproperties=True, num_processes=processes)
-            plan_and_preprocess(t, processes, no_preprocessing)
+            plan_and_preprocess(t, processes, no_preprocessing, args.storage_format, args.storage_dtype,
+                                args.resampling)
     else:
         if not use_splitted or not isdir(join(splitted_4D_out_dir, task)):
             print("splitting task ", task)
@@ -210,7 +229,8 @@ def main():
 
         crop(task, override=override, num_threads=processes)
         analyze_dataset(task, override, collect_intensityproperties=True, num_processes=processes)
-        plan_and_preprocess(task, processes, no_preprocessing)
+        plan_and_preprocess(task, processes, no_preprocessing, args.storage_format, args.storage_dtype,
+                            args.resampling)
 
 if __name__ == "__main__":
     main()
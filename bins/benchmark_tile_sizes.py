@@ -0,0 +1,112 @@
+import argparse
+from collections import OrderedDict
+from time import time
+import numpy as np
+from default_configs import default_plans_identifier, net_training_out_dir
+from evaluation.metrics import dice
+from preprocessing.dataset_generator import load_case
+from training.search_and_load_model import load_model_and_checkpoint_files
+from utils.files_utils import *
+
+
+def benchmark_tile_sizes(trainer, budgets, do_tta=True, max_num_cases=None):
+    """
+    predicts the validation cases of the trainer once with the training patch size and once per memory budget with
+    the tiles of DetectionNet.plan_inference_tiles
+    :param trainer: initialized trainer with the checkpoint of a fold loaded
+    :param budgets: memory budgets in bytes
+    :param do_tta:
+    :param max_num_cases: only use the first max_num_cases validation cases
+    :return: dict with one entry per setting: tile shape, number of tiles, mean latency (s), mean dice per class and
+    fraction of voxels that agree with the training patch size prediction
+    """
+    if trainer.dataset_val is None:
+        trainer.load_dataset()
+        trainer.do_split()
+    mirror_axes = trainer.data_aug_params['mirror_axes'] if do_tta else ()
+    cases = list(trainer.dataset_val.keys())[:max_num_cases]
+    settings = [("patch_size", None)] + [("%.2fGB" % (b / 1e9), b) for b in budgets]
+
+    results = OrderedDict((name, {'latency': [], 'dice': [], 'agreement': [], 'num_tiles': []})
+                          for name, _ in settings)
+    for k in cases:
+        data = load_case(trainer.dataset[k])
+        transpose_forward = trainer.plans.get('transpose_forward')
+        if transpose_forward is not None:
+            data = data.transpose([0] + [i + 1 for i in transpose_forward])
+        gt = data[-1]
+        gt[gt == -1] = 0
+        baseline = None
+        for name, budget in settings:
+            trainer.inference_large_tile_budget = budget
+            start = time()
+            softmax = trainer.predict_preprocessing_return_softmax(data[:-1], do_tta, 1, False, 1, mirror_axes, True,
+                                                                   True, 2, trainer.patch_size, True)
+            seg = np.argmax(softmax, 0)
+            results[name]['latency'].append(time() - start)
+            results[name]['num_tiles'].append(trainer.net.inference_tile_stats['num_tiles'])
+            results[name]['dice'].append([dice(seg == c, gt == c) for c in range(1, trainer.num_classes)])
+            if baseline is None:
+                baseline = seg
+            results[name]['agreement'].append(float(np.mean(seg == baseline)))
+            print(k, name, "latency: %.2f s" % results[name]['latency'][-1], "dice:", results[name]['dice'][-1])
+        trainer.inference_large_tile_budget = None
+
+    summary = OrderedDict()
+    for name, budget in settings:
+        r = results[name]
+        if budget is None:
+            tile_size = [int(i) for i in trainer.patch_size]
+        else:
+            tile_size = trainer.net.plan_inference_tiles(data.shape[-len(trainer.patch_size):], trainer.patch_size,
+                                                         data.shape[0] - 1, budget)['patch_size']
+        summary[name] = {'memory_budget': budget,
+                         'tile_size_last_case': tile_size,
+                         'mean_num_tiles': float(np.mean(r['num_tiles'])),
+                         'mean_latency': float(np.mean(r['latency'])),
+                         'mean_dice_per_class': [float(i) for i in np.nanmean(np.array(r['dice'], dtype=float), 0)],
+                         'mean_agreement_with_patch_size': float(np.mean(r['agreement']))}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency/accuracy trade-off of sliding window tiles that are larger "
+                                                 "than the training patch (see --large_tile_budget of "
+                                                 "bins/inference.py). Uses the validation cases of one fold")
+    parser.add_argument('-t', '--task_name', help='task name, required.', required=True)
+    parser.add_argument('-tr', '--unet_trainer', help='UNet trainer class. Default: Trainer', required=False,
+                        default='Trainer')
+    parser.add_argument('-m', '--model', help="2d, 3d_lowres, 3d_fullres or 3d_cascade_fullres. Default: 3d_fullres",
+                        default="3d_fullres", required=False)
+    parser.add_argument('-p', '--plans_identifier', help='plans ID', default=default_plans_identifier,
+                        required=False)
+    parser.add_argument('-f', '--fold', type=int, default=0, help="fold whose validation cases are used. Default: 0")
+    parser.add_argument("--budgets", nargs='+', type=float, default=[1, 2, 4, 8],
+                        help="memory budgets (in GB) for the forward pass of one tile. Default: 1 2 4 8")
+    parser.add_argument("--tta", required=False, type=int, default=1, help="test time data augmentation. 0: disable")
+    parser.add_argument("--max_num_cases", required=False, type=int, default=None,
+                        help="only use this many validation cases. Default: all")
+    parser.add_argument("-o", "--output_file", required=False, default=None,
+                        help="json file for the results. Default: tile_size_benchmark.json in the model folder")
+    args = parser.parse_args()
+
+    output_folder_name = join(net_training_out_dir, args.model, args.task_name, args.unet_trainer + "__" +
+                              args.plans_identifier)
+    assert isdir(output_folder_name), "model output folder not found: %s" % output_folder_name
+
+    trainer, params = load_model_and_checkpoint_files(output_folder_name, [args.fold])
+    trainer.update_fold(args.fold)
+    trainer.load_checkpoint_ram(params[0], False)
+
+    summary = benchmark_tile_sizes(trainer, [b * 1e9 for b in args.budgets], bool(args.tta), args.max_num_cases)
+    for name, r in summary.items():
+        print(name, "tiles: %.1f" % r['mean_num_tiles'], "latency: %.2f s" % r['mean_latency'],
+              "dice:", r['mean_dice_per_class'], "agreement: %.4f" % r['mean_agreement_with_patch_size'])
+    output_file = args.output_file
+    if output_file is None:
+        output_file = join(output_folder_name, "tile_size_benchmark.json")
+    save_json(summary, output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import argparse
+from collections import OrderedDict
+import numpy as np
+from default_configs import cropped_output_dir, preprocessing_output_dir, default_plans_identifier
+from evaluation.metrics import dice
+from preprocessing.preprocessor import resample_patient, resampling_functions, get_do_separate_z, get_lowres_axis
+from utils.files_utils import *
+
+
+def get_separate_z_axis(original_spacing, target_spacing):
+    """
+    same decision as resample_patient with force_separate_z=None
+    :return: do_separate_z, axis
+    """
+    if get_do_separate_z(original_spacing):
+        return True, get_lowres_axis(original_spacing)
+    elif get_do_separate_z(target_spacing):
+        return True, get_lowres_axis(target_spacing)
+    return False, None
+
+
+def compare_resampling(data, seg, original_spacing, target_spacing, methods=("spline", "separable")):
+    """
+    resamples a cropped case to target_spacing (with the orders of the preprocessing) and the data back to its
+    original shape with each method
+    :return: per method time, peak buffer memory and round trip error of the data, plus the agreement of the data and
+    the Dice of the segmentations between the first method and the others
+    """
+    results = OrderedDict()
+    resampled = OrderedDict()
+    do_separate_z, axis = get_separate_z_axis(original_spacing, target_spacing)
+    intensity_range = float(np.percentile(data, 99.5) - np.percentile(data, 0.5)) + 1e-8
+    for m in methods:
+        stats = {}
+        d, s = resample_patient(data, seg, original_spacing, target_spacing, 3, 1, force_separate_z=None,
+                                order_z_data=0, order_z_seg=0, resampling=m, stats=stats)
+        back = resampling_functions[m](d, data.shape[1:], False, axis, 3, do_separate_z, order_z=0)
+        error = np.abs(back.astype(np.float32) - data.astype(np.float32)) / intensity_range
+        results[m] = {'seconds_data': stats['data'].get('seconds', 0), 'seconds_seg': stats['seg'].get('seconds', 0),
+                      'peak_buffer_bytes_data': stats['data'].get('peak_buffer_bytes', 0),
+                      'peak_buffer_bytes_seg': stats['seg'].get('peak_buffer_bytes', 0),
+                      'round_trip_mean_abs_error': float(np.mean(error)),
+                      'round_trip_max_abs_error': float(np.max(error))}
+        resampled[m] = (d, s)
+
+    reference = methods[0]
+    d_ref, s_ref = resampled[reference]
+    classes = [c for c in np.unique(s_ref) if c > 0]
+    for m in methods[1:]:
+        d, s = resampled[m]
+        results[m]['mean_abs_difference_to_%s' % reference] = float(np.mean(np.abs(d - d_ref)) / intensity_range)
+        results[m]['dice_to_%s' % reference] = {int(c): dice(s[0] == c, s_ref[0] == c) for c in classes}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the separable resampling (1D passes per axis) with the "
+                                                 "spline resampling (skimage resize + map_coordinates) on the cropped "
+                                                 "cases of a task, at the target spacing of a stage of the plans: "
+                                                 "time, memory, round trip error (resampled to the target spacing "
+                                                 "and back) and agreement of data and segmentation")
+    parser.add_argument('-t', '--task_name', help='task name, required.', required=True)
+    parser.add_argument('-p', '--plans_identifier', help='plans ID', default=default_plans_identifier,
+                        required=False)
+    parser.add_argument('-s', '--stage', type=int, default=0, help="stage of the 3D plans. Default: 0")
+    parser.add_argument("--max_num_cases", required=False, type=int, default=None,
+                        help="only use this many cases. Default: all")
+    parser.add_argument("-o", "--output_file", required=False, default=None,
+                        help="json file for the results. Default: resampling_comparison.json in the preprocessing "
+                             "folder of the task")
+    args = parser.parse_args()
+
+    cropped_folder = join(cropped_output_dir, args.task_name)
+    preprocessing_folder = join(preprocessing_output_dir, args.task_name)
+    plans = load_pickle(join(preprocessing_folder, args.plans_identifier + "_plans_3D.pkl"))
+    target_spacing = np.array(plans['plans_per_stage'][args.stage]['current_spacing'])
+
+    results = OrderedDict()
+    case_identifiers = [i[:-4] for i in subfiles(cropped_folder, suffix=".npz", join=False)][:args.max_num_cases]
+    for k in case_identifiers:
+        all_data = np.load(join(cropped_folder, k + ".npz"))['data']
+        properties = load_pickle(join(cropped_folder, k + ".pkl"))
+        results[k] = compare_resampling(all_data[:-1].astype(np.float32), all_data[-1:],
+                                        np.array(properties['original_spacing']), target_spacing)
+        print(k, results[k])
+
+    summary = OrderedDict()
+    for m in ("spline", "separable"):
+        summary[m] = {key: float(np.nanmean([r[m][key] for r in results.values()])) for key in
+                      ('seconds_data', 'seconds_seg', 'peak_buffer_bytes_data', 'peak_buffer_bytes_seg',
+                       'round_trip_mean_abs_error', 'round_trip_max_abs_error')}
+    dices = [d for r in results.values() for d in r['separable']['dice_to_spline'].values()]
+    summary['separable']['mean_dice_to_spline'] = float(np.nanmean(dices)) if len(dices) > 0 else None
+    print(summary)
+
+    output_file = args.output_file
+    if output_file is None:
+        output_file = join(preprocessing_folder, "resampling_comparison.json")
+    save_json({'summary': summary, 'cases': results}, output_file)
+
+
+if __name__ == "__main__":
+    main()
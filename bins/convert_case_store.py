@@ -0,0 +1,33 @@
+import argparse
+from preprocessing.chunked_store import convert_npz_to_chunked, convert_chunked_to_npz, default_chunk_size
+from utils.files_utils import *
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts the cases of a preprocessed (or cropped) data folder between "
+                                                 "the npz layout and the chunked layout. The data loaders of the "
+                                                 "trainers read both")
+    parser.add_argument('-i', '--folder', help="folder with the cases, e.g. UNetData_plans_v2.1_stage0", required=True)
+    parser.add_argument('-d', '--direction', choices=["to_chunked", "to_npz"], default="to_chunked",
+                        help="Default: to_chunked")
+    parser.add_argument('-p', '--processes', type=int, default=8, help="Default: 8")
+    parser.add_argument('--chunk_size', nargs='+', type=int, default=list(default_chunk_size),
+                        help="spatial chunk size in voxels. Default: 64 64 64")
+    parser.add_argument('--codec', default=None, choices=["lz4", "zlib", "raw"],
+                        help="Default: lz4 if installed, zlib otherwise")
+    parser.add_argument('--data_dtype', default="float32", choices=["float32", "float16", "bfloat16"],
+                        help="precision of the stored intensities (to_chunked only). Default: float32")
+    parser.add_argument('--delete_source', action='store_true',
+                        help="delete the npz (and unpacked npy) files or the chunked folders after conversion")
+    args = parser.parse_args()
+
+    assert isdir(args.folder), "folder not found: %s" % args.folder
+    if args.direction == "to_chunked":
+        convert_npz_to_chunked(args.folder, args.processes, args.chunk_size, args.codec, args.delete_source,
+                               args.data_dtype)
+    else:
+        convert_chunked_to_npz(args.folder, args.processes, args.delete_source)
+
+
+if __name__ == "__main__":
+    main()
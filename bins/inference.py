@@ -41,6 +41,80 @@ def main():
                         help="test time data augmentation. 0: disable; (e.g. speedup of factor 4(2D)/8(3D)).")
     parser.add_argument("--overwrite_existing", required=False, type=int, default=1, 
                         help="Set this to 0 if you need to resume a previous prediction. ")
+    parser.add_argument("--tile_batch_size", required=False, type=int, default=1,
+                        help="Number of sliding window tiles per forward pass. 0: derive it from --tile_memory_budget. "
+                             "Default: 1")
+    parser.add_argument("--tile_memory_budget", required=False, type=float, default=None,
+                        help="Memory (in GB) one forward pass may use. Only used if --tile_batch_size is 0")
+    parser.add_argument("--tta_in_batch", required=False, type=int, default=0,
+                        help="1: run all mirrored versions of a tile in a single forward pass. Default: 0")
+    parser.add_argument("--out_of_core_budget", required=False, type=float, default=None,
+                        help="Memory (in GB) the softmax of one case may use. Larger predictions are aggregated in "
+                             "memory-mapped files in --memmap_folder. Default: always in memory")
+    parser.add_argument("--accumulation_dtype", required=False, default="float32",
+                        choices=["float32", "float16", "bfloat16"],
+                        help="dtype the sliding window tiles are aggregated in. float16 and bfloat16 halve the memory "
+                             "of the aggregation buffer. Default: float32")
+    parser.add_argument("--roi_mask", required=False, default=None, choices=["nonzero", "lowres"],
+                        help="Skip sliding window tiles outside of this mask and predict background there. nonzero: "
+                             "nonzero mask of the cropping; lowres: foreground of --lowres_segmentations. "
+                             "Default: predict all tiles")
+    parser.add_argument("--cascade_margin", required=False, type=int, default=None,
+                        help="Cascade only: run the full resolution sliding window only in the bounding boxes of the "
+                             "--lowres_segmentations foreground, enlarged by this many voxels. Everything else is "
+                             "taken from the lowres segmentation. Cannot be combined with --roi_mask and "
+                             "--ensemble_tolerance. Default: predict the whole volume")
+    parser.add_argument("--resident_folds", required=False, type=int, default=0,
+                        help="1: keep one network per fold on the GPU and ensemble them tile by tile (GPU memory grows "
+                             "with the number of folds). 0: load the folds one after the other for every case. "
+                             "Default: 0")
+    parser.add_argument("--max_bytes_in_flight", required=False, type=float, default=None,
+                        help="Memory (in GB) that preprocessed volumes waiting for prediction and predictions waiting "
+                             "for export may use (each). They are kept in shared memory (/dev/shm). "
+                             "Default: one preprocessed volume and one prediction per export worker at a time")
+    parser.add_argument("--num_cpu_workers", required=False, type=int, default=1,
+                        help="CPU inference only: split the sliding window tiles of a case among this many processes "
+                             "that share the network weights. Default: 1")
+    parser.add_argument("--large_tile_budget", required=False, type=float, default=None,
+                        help="Memory (in GB) the forward pass of one sliding window tile may use. If set, tiles larger "
+                             "than the training patch are used, which needs fewer tiles. Use "
+                             "bins/benchmark_tile_sizes.py to check the latency/accuracy trade-off of a task. "
+                             "Default: training patch size")
+    parser.add_argument("--max_cases_per_batch", required=False, type=int, default=1,
+                        help="Cases that are not larger than the patch size (e.g. small crops) are padded to it and "
+                             "predicted together, this many per forward pass. Default: 1")
+    parser.add_argument("--tta_uncertainty_threshold", required=False, type=float, default=None,
+                        help="Adaptive test time augmentation: predict every tile without mirroring first and mirror "
+                             "only tiles in which more than this fraction of the foreground voxels is ambiguous "
+                             "(softmax margin below 0.5). The fraction of mirrored tiles is printed per case. "
+                             "Only used with --tta 1. Default: mirror every tile")
+    parser.add_argument("--ensemble_tolerance", required=False, type=float, default=None,
+                        help="Evaluate the folds one after the other and stop once the remaining folds are not "
+                             "expected to change the argmax of more than this fraction of the foreground voxels "
+                             "(e.g. 0.001). The number of folds used is printed per case. Default: use all folds")
+    parser.add_argument("--compress_nifti", required=False, type=int, default=1,
+                        help="0: write uncompressed .nii instead of .nii.gz (faster export). Default: 1")
+    parser.add_argument("--compress_npz", required=False, type=int, default=1,
+                        help="0: write the softmax npz files of --save_npz uncompressed. Default: 1")
+    parser.add_argument("--preprocessing_cache", required=False, default=None,
+                        help="Folder for caching preprocessed cases. Runs of models that share the preprocessing "
+                             "(spacing, normalization, transpose) reuse the cached cases. Default: no cache")
+    parser.add_argument("--preprocessing_cache_budget", required=False, type=float, default=None,
+                        help="Disk space (in GB) of --preprocessing_cache. The least recently used cases are "
+                             "evicted first. Default: unbounded")
+    parser.add_argument("--work_folder", required=False, default=None,
+                        help="Folder on a filesystem shared by all nodes. Every node started with the same "
+                             "--work_folder claims the next unclaimed case (largest first) instead of using "
+                             "--part_id/--num_parts. Progress and ETA are written to work_folder/progress.json. "
+                             "Default: static split by --part_id/--num_parts")
+    parser.add_argument("--lease_time", required=False, type=float, default=1800,
+                        help="Seconds after which the cases claimed by a node that stopped responding are taken over "
+                             "by other nodes. Default: 1800")
+    parser.add_argument("--quantized", required=False, type=int, default=0,
+                        help="1: predict on the cpu with the int8 models created by bins/quantize_model.py. Check "
+                             "their Dice report before using them. Default: 0")
+    parser.add_argument("--memmap_folder", required=False, default=None,
+                        help="Folder for the memory-mapped files of --out_of_core_budget. Default: system temp folder")
     parser.add_argument('--exp_dir', type=str, default='/path/to/experiment/directory',
                         help='path to experiment dir. will be created if non existent.')
     parser.add_argument('--server_env', default=False, action='store_true',
@@ -61,6 +135,12 @@ def main():
     num_threads_nifti_save = args.num_threads_nifti_save
     tta = args.tta
     overwrite = args.overwrite_existing
+    tile_batch_size = args.tile_batch_size
+    tile_memory_budget = args.tile_memory_budget
+    tta_in_batch = args.tta_in_batch
+    out_of_core_budget = args.out_of_core_budget
+    if out_of_core_budget is not None:
+        out_of_core_budget = out_of_core_budget * 1e9
     cf = prep_exp(args.exp_source, args.exp_dir, args.server_env, is_training=True, use_stored_settings=True)
     
     output_folder_name = join(net_training_out_dir, args.model, args.task_name, args.unet_trainer + "__" +
@@ -95,9 +175,36 @@ def main():
     else:
         raise ValueError("Unexpected value for overwrite, Use 1 or 0")
 
+    if tta_in_batch == 0:
+        tta_in_batch = False
+    elif tta_in_batch == 1:
+        tta_in_batch = True
+    else:
+        raise ValueError("Unexpected value for tta_in_batch, Use 1 or 0")
+
+    if tile_batch_size == 0:
+        assert tile_memory_budget is not None, "--tile_batch_size 0 requires --tile_memory_budget"
+        tile_batch_size = None
+    if tile_memory_budget is not None:
+        tile_memory_budget = tile_memory_budget * 1e9
+
     predict_group(cf, output_folder_name, input_folder, output_folder, folds, save_npz, num_threads_preprocessing,
                         num_threads_nifti_save, lowres_segmentations, part_id, num_parts, tta,
-                        overwrite_existing=overwrite)
+                        overwrite_existing=overwrite, tile_batch_size=tile_batch_size,
+                        tile_memory_budget=tile_memory_budget, tta_in_batch=tta_in_batch,
+                        max_in_memory_bytes=out_of_core_budget, memmap_folder=args.memmap_folder,
+                        accumulation_dtype=args.accumulation_dtype, roi_mask=args.roi_mask,
+                        cascade_margin=args.cascade_margin, resident_folds=bool(args.resident_folds),
+                        max_bytes_in_flight=None if args.max_bytes_in_flight is None else
+                        args.max_bytes_in_flight * 1e9, num_cpu_workers=args.num_cpu_workers,
+                        large_tile_budget=None if args.large_tile_budget is None else args.large_tile_budget * 1e9,
+                        max_cases_per_batch=args.max_cases_per_batch,
+                        tta_uncertainty_threshold=args.tta_uncertainty_threshold,
+                        ensemble_tolerance=args.ensemble_tolerance, compress_nifti=bool(args.compress_nifti),
+                        compress_npz=bool(args.compress_npz), preprocessing_cache=args.preprocessing_cache,
+                        preprocessing_cache_budget=None if args.preprocessing_cache_budget is None else
+                        args.preprocessing_cache_budget * 1e9, work_folder=args.work_folder,
+                        lease_time=args.lease_time, quantized=bool(args.quantized))
     
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+import argparse
+import json
+from inference.server import InferenceClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Client for bins/inference_server.py")
+    parser.add_argument("--port", required=False, type=int, default=None)
+    parser.add_argument("--socket", required=False, default=None)
+    parser.add_argument("-t", "--task_name", required=False, default=None)
+    parser.add_argument("-i", "--input_files", required=False, nargs='+', default=None,
+                        help="one file per modality, in the same order as for training")
+    parser.add_argument("-o", "--output_file", required=False, default=None)
+    parser.add_argument("--tta", required=False, type=int, default=1,
+                        help="test time data augmentation. 0: disable. Default: 1")
+    parser.add_argument("--latency_target", required=False, type=float, default=None,
+                        help="in s. Tiles of requests with a closer latency target are scheduled first")
+    parser.add_argument("--metrics", required=False, action='store_true',
+                        help="print the metrics of the server instead of predicting")
+    args = parser.parse_args()
+
+    client = InferenceClient(args.port, args.socket)
+    if args.metrics:
+        print(json.dumps(client.metrics(), indent=4))
+        return
+    assert args.task_name is not None and args.input_files is not None and args.output_file is not None, \
+        "-t, -i and -o are required for predictions"
+    print(client.predict(args.task_name, args.input_files, args.output_file, bool(args.tta), args.latency_target))
+
+
+if __name__ == "__main__":
+    main()
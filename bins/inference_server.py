@@ -0,0 +1,39 @@
+import argparse
+from inference.server import TileBatchScheduler, InferenceServer, serve
+from default_configs import default_plans_identifier, net_training_out_dir
+from utils.files_utils import *
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keeps the models of the configured tasks loaded and serves "
+                                                 "predictions over http or a unix socket. See bins/inference_client.py")
+    parser.add_argument("-c", "--config", required=True,
+                        help="json file: {task_name: {\"model\": \"3d_fullres\", \"unet_trainer\": \"Trainer\", "
+                             "\"plans_identifier\": ..., \"folds\": [0, 1, 2, 3, 4], ...}}. All other entries are "
+                             "set as inference_* attributes of the trainer (e.g. \"tile_batch_size\": 2)")
+    parser.add_argument("--port", required=False, type=int, default=None, help="serve http on localhost:port")
+    parser.add_argument("--socket", required=False, default=None, help="serve http on this unix socket")
+    parser.add_argument("--max_tiles_per_batch", required=False, type=int, default=8,
+                        help="Upper bound for the number of tiles (of all requests) per forward pass. Default: 8")
+    parser.add_argument("--max_wait", required=False, type=float, default=0.05,
+                        help="How long (in s) tiles wait for tiles of other requests to share a forward pass. "
+                             "Default: 0.05")
+    args = parser.parse_args()
+    assert (args.port is None) != (args.socket is None), "specify either --port or --socket"
+
+    tasks = {}
+    for task_name, task in load_json(args.config).items():
+        task = dict(task)
+        model_folder = join(net_training_out_dir, task.pop('model', "3d_fullres"), task_name,
+                            task.pop('unet_trainer', "Trainer") + "__" +
+                            task.pop('plans_identifier', default_plans_identifier))
+        assert isdir(model_folder), "model output folder not found: %s" % model_folder
+        task['model_folder'] = model_folder
+        tasks[task_name] = task
+
+    scheduler = TileBatchScheduler(args.max_tiles_per_batch, args.max_wait)
+    serve(InferenceServer(tasks, scheduler), args.port, args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import argparse
+from time import time
+import numpy as np
+import torch
+from datasets.data_augmentation.aug_utils import pad_nd_img
+from default_configs import default_plans_identifier, net_training_out_dir
+from evaluation.metrics import dice
+from models.quantization import quantize_unet, save_quantized_module, get_quantized_model_file
+from preprocessing.dataset_generator import load_case
+from training.search_and_load_model import load_model_and_checkpoint_files
+from utils.files_utils import *
+
+
+def get_calibration_patches(trainer, num_patches, seed=1234):
+    """
+    random patches (of trainer.patch_size) of the preprocessed training cases of the fold
+    :return: list of (1, c, x, y, z) float tensors
+    """
+    rs = np.random.RandomState(seed)
+    keys = sorted(trainer.dataset_tr.keys())
+    patches = []
+    for i in range(num_patches):
+        data = load_case(trainer.dataset[keys[rs.randint(len(keys))]])[:-1]
+        transpose_forward = trainer.plans.get('transpose_forward')
+        if transpose_forward is not None:
+            data = data.transpose([0] + [i + 1 for i in transpose_forward])
+        data = pad_nd_img(data, trainer.patch_size, "constant", {'constant_values': 0})
+        start = [rs.randint(0, s - p + 1) for s, p in zip(data.shape[1:], trainer.patch_size)]
+        patch = data[(slice(None),) + tuple([slice(s, s + p) for s, p in zip(start, trainer.patch_size)])]
+        patches.append(torch.from_numpy(np.ascontiguousarray(patch[None])).float())
+    return patches
+
+
+def compare_with_float_model(trainer, quantized, max_num_cases=None):
+    """
+    predicts the validation cases of the fold with the float network and with the int8 network (both on the cpu)
+    :return: dict with mean dice per class and mean latency of both, and the voxel agreement of the segmentations
+    """
+    trainer.net.cpu()
+    cases = sorted(trainer.dataset_val.keys())[:max_num_cases]
+    results = {'float': {'dice': [], 'latency': []}, 'int8': {'dice': [], 'latency': []}, 'agreement': []}
+    for k in cases:
+        data = load_case(trainer.dataset[k])
+        transpose_forward = trainer.plans.get('transpose_forward')
+        if transpose_forward is not None:
+            data = data.transpose([0] + [i + 1 for i in transpose_forward])
+        gt = data[-1]
+        gt[gt == -1] = 0
+        segs = {}
+        for name, module in (('float', None), ('int8', quantized)):
+            trainer.net.set_quantized_module(module)
+            start = time()
+            softmax = trainer.predict_preprocessing_return_softmax(data[:-1], False, 1, False, 1, (), True, True, 2,
+                                                                   trainer.patch_size, True)
+            segs[name] = np.argmax(softmax, 0)
+            results[name]['latency'].append(time() - start)
+            results[name]['dice'].append([dice(segs[name] == c, gt == c) for c in range(1, trainer.num_classes)])
+        results['agreement'].append(float(np.mean(segs['float'] == segs['int8'])))
+        print(k, "dice float:", results['float']['dice'][-1], "int8:", results['int8']['dice'][-1])
+    trainer.net.set_quantized_module(None)
+
+    report = {'cases': cases, 'mean_agreement': float(np.mean(results['agreement']))}
+    for name in ('float', 'int8'):
+        report[name] = {'mean_dice_per_class': [float(i) for i in
+                                                np.nanmean(np.array(results[name]['dice'], dtype=float), 0)],
+                        'mean_latency': float(np.mean(results[name]['latency']))}
+    report['max_dice_drop'] = float(np.nanmax(np.array(report['float']['mean_dice_per_class']) -
+                                              np.array(report['int8']['mean_dice_per_class'])))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Creates the int8 cpu model of a fold (static post training "
+                                                 "quantization, calibrated on training patches) and compares its "
+                                                 "Dice on the validation cases with the float model. Accepted "
+                                                 "models are stored next to the checkpoint and used by "
+                                                 "bins/inference.py --quantized 1")
+    parser.add_argument('-t', '--task_name', help='task name, required.', required=True)
+    parser.add_argument('-tr', '--unet_trainer', help='UNet trainer class. Default: Trainer', required=False,
+                        default='Trainer')
+    parser.add_argument('-m', '--model', help="2d, 3d_lowres, 3d_fullres or 3d_cascade_fullres. Default: 3d_fullres",
+                        default="3d_fullres", required=False)
+    parser.add_argument('-p', '--plans_identifier', help='plans ID', default=default_plans_identifier,
+                        required=False)
+    parser.add_argument('-f', '--folds', nargs='+', type=int, default=[0, 1, 2, 3, 4],
+                        help="folds to quantize. Default: 0 1 2 3 4")
+    parser.add_argument("--num_calibration_patches", required=False, type=int, default=32,
+                        help="number of training patches the activation ranges are calibrated on. Default: 32")
+    parser.add_argument("--backend", required=False, default="fbgemm", choices=["fbgemm", "qnnpack"],
+                        help="fbgemm for x86, qnnpack for arm cpus. Default: fbgemm")
+    parser.add_argument("--max_num_cases", required=False, type=int, default=None,
+                        help="only use this many validation cases for the report. Default: all")
+    parser.add_argument("--max_dice_drop", required=False, type=float, default=0.01,
+                        help="the int8 model is rejected (not stored) if the Dice of any class drops by more than "
+                             "this. Default: 0.01")
+    parser.add_argument("--force", required=False, action='store_true',
+                        help="store the int8 model even if it was rejected")
+    args = parser.parse_args()
+
+    output_folder_name = join(net_training_out_dir, args.model, args.task_name, args.unet_trainer + "__" +
+                              args.plans_identifier)
+    assert isdir(output_folder_name), "model output folder not found: %s" % output_folder_name
+
+    for fold in args.folds:
+        trainer, params = load_model_and_checkpoint_files(output_folder_name, [fold])
+        trainer.update_fold(fold)
+        trainer.load_checkpoint_ram(params[0], False)
+        trainer.load_dataset()
+        trainer.do_split()
+        trainer.net.eval()
+
+        quantized = quantize_unet(trainer.net, get_calibration_patches(trainer, args.num_calibration_patches),
+                                  args.backend)
+        report = compare_with_float_model(trainer, quantized, args.max_num_cases)
+        report['accepted'] = report['max_dice_drop'] <= args.max_dice_drop
+        print("fold", fold, "dice float:", report['float']['mean_dice_per_class'], "int8:",
+              report['int8']['mean_dice_per_class'], "speedup: %.2f" %
+              (report['float']['mean_latency'] / report['int8']['mean_latency']),
+              "accepted" if report['accepted'] else "rejected")
+
+        quantized_file = get_quantized_model_file(join(output_folder_name, "fold_%d" % fold, "model_best.model"))
+        save_json(report, quantized_file[:-3] + "_report.json")
+        if report['accepted'] or args.force:
+            save_quantized_module(quantized, quantized_file)
+
+
+if __name__ == "__main__":
+    main()
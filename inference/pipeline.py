@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from multiprocessing import Condition, Value, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from time import time
+import numpy as np
+
+
+class ByteBudget(object):
+    def __init__(self, max_bytes=None, max_items=1):
+        """
+        bounds the number of bytes in flight between two pipeline stages. Can be shared with child processes. A
+        single item that is larger than max_bytes is let through once nothing else is in flight
+        :param max_bytes: None: at most max_items items in flight at a time
+        :param max_items: only used if max_bytes is None
+        """
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self._in_flight = Value('d', 0., lock=False)
+        self._num_items = Value('i', 0, lock=False)
+        self._condition = Condition()
+
+    def acquire(self, nbytes):
+        with self._condition:
+            while self._num_items.value > 0 and (
+                    self._num_items.value >= self.max_items if self.max_bytes is None else
+                    self._in_flight.value + nbytes > self.max_bytes):
+                self._condition.wait()
+            self._in_flight.value += nbytes
+            self._num_items.value += 1
+
+    def release(self, nbytes):
+        with self._condition:
+            self._in_flight.value -= nbytes
+            self._num_items.value -= 1
+            self._condition.notify_all()
+
+    @property
+    def in_flight(self):
+        return self._in_flight.value
+
+
+def array_to_shared_memory(arr):
+    """
+    copies arr into a new shared memory block. The block stays alive until it is consumed with shared_memory_array,
+    also if the calling process exits before that
+    :return: descriptor (name, shape, dtype) that can be sent to other processes
+    """
+    shm = SharedMemory(create=True, size=max(1, arr.nbytes))
+    # the consumer owns the block. Otherwise the resource tracker of this process unlinks it when the process exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+    descriptor = (shm.name, arr.shape, arr.dtype.str)
+    shm.close()
+    return descriptor
+
+
+def shared_memory_nbytes(descriptor):
+    return int(np.prod(descriptor[1])) * np.dtype(descriptor[2]).itemsize
+
+
+@contextmanager
+def shared_memory_array(descriptor):
+    """
+    maps the array behind descriptor without copying it and frees the shared memory block when the context is left.
+    Do not keep references to the array after that
+    """
+    shm = SharedMemory(name=descriptor[0])
+    try:
+        yield np.ndarray(descriptor[1], dtype=np.dtype(descriptor[2]), buffer=shm.buf)
+    finally:
+        try:
+            shm.close()
+        except BufferError:
+            # views of the array are still alive. The memory is released once they are garbage collected
+            pass
+        shm.unlink()
+
+
+class StageTimer(object):
+    def __init__(self):
+        """
+        measures which fraction of its lifetime a pipeline stage spends working (as opposed to waiting for input or
+        for space in the next queue)
+        """
+        self.start = time()
+        self.busy = 0.
+
+    @contextmanager
+    def working(self):
+        start = time()
+        try:
+            yield
+        finally:
+            self.busy += time() - start
+
+    def get_stats(self):
+        """
+        :return: (busy time, wall time) in s
+        """
+        return self.busy, time() - self.start
+
+
+def utilization(stats):
+    """
+    :param stats: list of (busy time, wall time), one per worker of a stage
+    :return: mean fraction of time the workers were busy
+    """
+    if len(stats) == 0:
+        return 0.
+    return float(np.mean([busy / max(wall, 1e-8) for busy, wall in stats]))
@@ -4,45 +4,69 @@ import numpy as np
 from datasets.data_augmentation.aug_utils import resize_seg
 from analyze_and_preprocess import get_caseIDs_of_splitted_dataset
 from utils.files_utils import *
-from utils.exp_utils import prep_exp, store_seg_from_softmax
+from utils.exp_utils import prep_exp, store_seg_from_softmax, save_softmax_for_export
+from inference.preprocessing_cache import PreprocessedCaseCache, CachedPreprocessor, get_preprocessing_fingerprint
+from inference.work_stealing import WorkStealingBoard, get_num_voxels_from_header
+from inference.pipeline import ByteBudget, StageTimer, array_to_shared_memory, shared_memory_array, \
+    shared_memory_nbytes, utilization
 from multiprocessing import Process, Queue
 import torch
 import SimpleITK as sitk
 import shutil
-from multiprocessing import Pool
+from copy import deepcopy
+from time import time
+from scipy.ndimage import label, find_objects
 
-from training.search_and_load_model import load_model_and_checkpoint_files
+from training.search_and_load_model import load_model_and_checkpoint_files, get_fold_folders
+from models.quantization import get_quantized_model_file, load_quantized_module
+from models.base_net import prepare_cpu_workers
 from training.trainer.UNetTrainer import UNetTrainer
 from utilities.one_hot_encoding import to_one_hot
 
 
-def predict_and_store_to_que(preprocess_fn, q, list_of_lists, output_files, segs_from_prev_stage, classes):
+def get_case_id(output_file):
+    return os.path.basename(output_file)[:-len(".nii.gz")]
+
+
+def predict_and_store_to_que(preprocess_fn, q, list_of_lists, output_files, segs_from_prev_stage, classes,
+                             roi_mask=None, budget=None, board=None):
+    timer = StageTimer()
     errors_in = []
     for i, l in enumerate(list_of_lists):
+        if board is not None and not board.claim(get_case_id(output_files[i])):
+            # done or claimed by another worker or node
+            continue
         try:
             output_file = output_files[i]
-            d, _, dct = preprocess_fn(l)
-            if segs_from_prev_stage[i] is not None:
-                assert isfile(segs_from_prev_stage[i]) and segs_from_prev_stage[i].endswith(".nii.gz"), \
-                "segs_from_prev_stage should point to a segmentation file" 
+            with timer.working():
+                d, s, dct = preprocess_fn(l)
+                roi = None
+                if roi_mask == "nonzero":
+                    # the cropper marks everything outside the nonzero mask with -1
+                    roi = s[0] != -1
+                if segs_from_prev_stage[i] is not None:
+                    assert isfile(segs_from_prev_stage[i]) and segs_from_prev_stage[i].endswith(".nii.gz"), \
+                    "segs_from_prev_stage should point to a segmentation file" 
                 
-                seg_prev = sitk.GetArrayFromImage(sitk.ReadImage(segs_from_prev_stage[i]))
-                # check to see if shapes match
-                img = sitk.GetArrayFromImage(sitk.ReadImage(l[0]))
-                assert all([i == j for i, j in zip(seg_prev.shape, img.shape)]), \
-                "image and segmentation don't have the same pixel array shape! " \
-                 "image: %s, seg_prev: %s" % (l[0], segs_from_prev_stage[i])
+                    seg_prev = sitk.GetArrayFromImage(sitk.ReadImage(segs_from_prev_stage[i]))
+                    # check to see if shapes match
+                    img = sitk.GetArrayFromImage(sitk.ReadImage(l[0]))
+                    assert all([i == j for i, j in zip(seg_prev.shape, img.shape)]), \
+                    "image and segmentation don't have the same pixel array shape! " \
+                     "image: %s, seg_prev: %s" % (l[0], segs_from_prev_stage[i])
                  
-                seg_reshaped = resize_seg(seg_prev, d.shape[1:], order=1, cval=0)
-                seg_reshaped = to_one_hot(seg_reshaped, classes)
-                d = np.vstack((d, seg_reshaped)).astype(np.float32)
-
-            print(d.shape)
-            if np.prod(d.shape) > (2e9 / 4 * 0.9):  # *0.9 just to be save, 4 because float32 is 4 bytes
-                print("Output is too large. Saving output temporarily to disk")
-                np.save(output_file[:-7] + ".npy", d)
-                d = output_file[:-7] + ".npy"
-            q.put((output_file, (d, dct)))
+                    seg_reshaped = resize_seg(seg_prev, d.shape[1:], order=1, cval=0)
+                    if roi_mask == "lowres":
+                        roi = seg_reshaped > 0
+                    seg_reshaped = to_one_hot(seg_reshaped, classes)
+                    d = np.vstack((d, seg_reshaped)).astype(np.float32)
+
+                print(d.shape)
+            # the volume is handed over in shared memory, budget bounds the bytes waiting for prediction
+            if budget is not None:
+                budget.acquire(d.nbytes)
+            with timer.working():
+                q.put((output_file, (array_to_shared_memory(d), dct, roi)))
         except KeyboardInterrupt:
             raise KeyboardInterrupt
         except:
@@ -50,7 +74,9 @@ def predict_and_store_to_que(preprocess_fn, q, list_of_lists, output_files, segs
             import traceback
             traceback.print_exc()
             errors_in.append(l)
-    q.put("end")
+            if board is not None:
+                board.release(get_case_id(output_files[i]))
+    q.put(("end", timer.get_stats()))
     if len(errors_in) > 0:
         print("Some errors in the following cases:", errors_in)
         print("These cases were ignored.")
@@ -58,20 +84,37 @@ def predict_and_store_to_que(preprocess_fn, q, list_of_lists, output_files, segs
         print("Ended successfully, no errors to report")
 
 
-def preprocessing_multithreads(trainer, list_of_lists, output_files, num_processes=2, segs_from_prev_stage=None):
+def preprocessing_multithreads(trainer, list_of_lists, output_files, num_processes=2, segs_from_prev_stage=None,
+                               roi_mask=None, budget=None, worker_stats=None, cache=None, board=None):
+    """
+    preprocesses the cases in num_processes worker processes and yields (output_file, (shared memory descriptor of
+    the data, properties, roi mask)). The consumer must free the shared memory (shared_memory_array) and release the
+    bytes of the data from budget
+    :param budget: ByteBudget that bounds the preprocessed bytes waiting to be consumed. None: unbounded
+    :param worker_stats: if not None, the (busy time, wall time) of every worker is appended to it
+    :param cache: PreprocessedCaseCache. If not None, cases are looked up there before they are preprocessed
+    :param board: WorkStealingBoard. If not None, every worker goes through all cases and takes the ones it can claim
+    instead of getting a fixed share
+    """
     if segs_from_prev_stage is None:
+        assert roi_mask != "lowres", "roi_mask='lowres' requires segs_from_prev_stage"
         segs_from_prev_stage = [None] * len(list_of_lists)
 
     classes = list(range(1, trainer.num_classes))
     assert isinstance(trainer, UNetTrainer)
-    q = Queue(1)
+    preprocess_fn = trainer.preprocess_patient
+    if cache is not None:
+        preprocess_fn = CachedPreprocessor(cache, preprocess_fn, get_preprocessing_fingerprint(trainer))
+    q = Queue()
     processes = []
     for i in range(num_processes):
-        pr = Process(target=predict_and_store_to_que, args=(trainer.preprocess_patient, q,
-                                                         list_of_lists[i::num_processes],
-                                                         output_files[i::num_processes],
-                                                         segs_from_prev_stage[i::num_processes],
-                                                         classes))
+        # with a board the workers claim cases dynamically, otherwise each one gets a fixed share
+        share = slice(None) if board is not None else slice(i, None, num_processes)
+        pr = Process(target=predict_and_store_to_que, args=(preprocess_fn, q,
+                                                         list_of_lists[share],
+                                                         output_files[share],
+                                                         segs_from_prev_stage[share],
+                                                         classes, roi_mask, budget, board))
         pr.start()
         processes.append(pr)
 
@@ -79,8 +122,10 @@ def preprocessing_multithreads(trainer, list_of_lists, output_files, num_process
         end_ctr = 0
         while end_ctr != num_processes:
             item = q.get()
-            if item == "end":
+            if item[0] == "end":
                 end_ctr += 1
+                if worker_stats is not None:
+                    worker_stats.append(item[1])
                 continue
             else:
                 yield item
@@ -94,15 +139,266 @@ def preprocessing_multithreads(trainer, list_of_lists, output_files, num_process
         q.close()
 
 
+def get_lowres_foreground_boxes(foreground, margin):
+    """
+    bounding boxes of the connected components of the lowres foreground, enlarged by margin voxels on each side and
+    clipped to the image. Overlapping boxes are merged
+    :param foreground: boolean mask (x, y, z)
+    :param margin:
+    :return: list of tuples of slices
+    """
+    boxes = []
+    for b in find_objects(label(foreground)[0]):
+        boxes.append([[max(0, s.start - margin), min(shp, s.stop + margin)] for s, shp in zip(b, foreground.shape)])
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                if all([a[0] < b[1] and b[0] < a[1] for a, b in zip(boxes[i], boxes[j])]):
+                    boxes[i] = [[min(a[0], b[0]), max(a[1], b[1])] for a, b in zip(boxes[i], boxes[j])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple([slice(a, b) for a, b in box]) for box in boxes]
+
+
+def predict_cascade_in_lowres_boxes(trainer, params, d, do_tta, margin):
+    """
+    full resolution cascade prediction that only runs the sliding window inside the (enlarged) bounding boxes of the
+    lowres foreground. Everything outside the boxes is taken from the lowres segmentation
+    :param params: checkpoints to average. None entries are not loaded, the network is used as is
+    :param d: preprocessed data, the last num_classes - 1 channels are the one hot encoded lowres segmentation
+    :param margin: in voxels
+    :return: softmax (averaged over all params), fraction of the volume covered by the boxes, estimated speedup
+    (sliding window tiles of the whole volume / tiles in the boxes). The softmax is a memmap the caller owns if it is
+    larger than trainer.inference_max_in_memory_bytes
+    """
+    lowres = d[-(trainer.num_classes - 1):]
+    shape = [trainer.num_classes] + list(d.shape[1:])
+    max_in_memory_bytes = trainer.inference_max_in_memory_bytes
+    if max_in_memory_bytes is not None and np.prod(shape) * np.dtype(np.float32).itemsize > max_in_memory_bytes:
+        softmax_mean = trainer.net._open_temp_memmap(shape, trainer.inference_memmap_folder)
+    else:
+        softmax_mean = np.zeros(shape, dtype=np.float32)
+    softmax_mean[0] = 1
+    for c in range(1, trainer.num_classes):
+        softmax_mean[c] = lowres[c - 1]
+        softmax_mean[0] -= lowres[c - 1]
+
+    boxes = get_lowres_foreground_boxes(lowres.max(0) > 0.5, margin)
+    coverage = np.sum([np.prod([s.stop - s.start for s in box]) for box in boxes]) / float(np.prod(d.shape[1:]))
+
+    def num_tiles(shape):
+        return len(trainer.net._get_tile_slicers(np.maximum(shape, trainer.patch_size), trainer.patch_size, 2))
+    tiles_in_boxes = np.sum([num_tiles([s.stop - s.start for s in box]) for box in boxes])
+    speedup = num_tiles(d.shape[1:]) / max(1, tiles_in_boxes)
+
+    for box in boxes:
+        softmax_mean[(slice(None),) + box] = 0
+    for p in params:
+        if p is not None:
+            trainer.load_checkpoint_ram(p, False)
+        for box in boxes:
+            softmax = trainer.predict_preprocessing_return_softmax(
+                d[(slice(None),) + box], do_tta, 1, False, 1, trainer.data_aug_params['mirror_axes'], True, True, 2,
+                trainer.patch_size, True)
+            # one channel at a time, the prediction of a box can be out-of-core as well
+            for c in range(softmax.shape[0]):
+                softmax_mean[(c,) + box] += np.asarray(softmax[c], dtype=np.float32) / len(params)
+            if isinstance(softmax, np.memmap):
+                os.remove(softmax.filename)
+            del softmax
+    if isinstance(softmax_mean, np.memmap):
+        softmax_mean.flush()
+    return softmax_mean, coverage, speedup
+
+
+def export_from_que(q, budget, stats_q, compress_nifti=True, compress_npz=True, board=None):
+    """
+    export stage of predict_patient. Stores the softmax predictions it gets from q as segmentations until it gets
+    None, then puts its (busy time, wall time) into stats_q
+    :param q: items are (softmax as shared memory descriptor or .npy file, bytes to release from budget (None: the
+    item was not counted against budget), output_filename, properties, npz_file)
+    :param budget: ByteBudget of the softmax predictions waiting for export
+    :param compress_nifti: see store_seg_from_softmax
+    :param compress_npz: see store_seg_from_softmax
+    :param board: WorkStealingBoard. If not None, exported cases are marked as done there
+    """
+    timer = StageTimer()
+    while True:
+        item = q.get()
+        if item is None:
+            break
+        softmax, nbytes, output_filename, dct, npz_file = item
+        try:
+            with timer.working():
+                if isinstance(softmax, str):
+                    store_seg_from_softmax(softmax, output_filename, dct, 1, None, None, None, npz_file,
+                                           compress_nifti=compress_nifti, compress_npz=compress_npz)
+                else:
+                    with shared_memory_array(softmax) as s:
+                        store_seg_from_softmax(s, output_filename, dct, 1, None, None, None, npz_file,
+                                               compress_nifti=compress_nifti, compress_npz=compress_npz)
+                        del s
+            if board is not None:
+                board.finish(get_case_id(output_filename))
+        except KeyboardInterrupt:
+            raise KeyboardInterrupt
+        except:
+            print("error exporting", output_filename)
+            import traceback
+            traceback.print_exc()
+            if board is not None:
+                board.release(get_case_id(output_filename))
+        finally:
+            if nbytes is not None:
+                budget.release(nbytes)
+    stats_q.put(timer.get_stats())
+
+
+def predict_case(trainer, params, d, do_tta, roi=None, cascade_margin=None, ensemble_tolerance=None):
+    """
+    softmax prediction of one preprocessed case, averaged over params
+    :param params: checkpoints as returned by load_model_and_checkpoint_files. None entries are not loaded, the
+    network is used as is
+    :param roi: roi mask, see DetectionNet.predict_3D
+    :param cascade_margin: see predict_cascade_in_lowres_boxes. Cannot be combined with roi and ensemble_tolerance
+    :param ensemble_tolerance: if not None, stop averaging over params early. After every checkpoint the fraction of
+    foreground voxels whose argmax changed with it is measured. Once this fraction times the number of remaining
+    checkpoints is at most ensemble_tolerance, the remaining checkpoints are skipped (at least two are used)
+    :return:
+    """
+    if cascade_margin is not None:
+        assert roi is None and ensemble_tolerance is None, \
+            "cascade_margin does not support roi masks and ensemble_tolerance"
+        start = time()
+        softmax_mean, coverage, speedup = predict_cascade_in_lowres_boxes(trainer, params, d, do_tta, cascade_margin)
+        print("boxes cover %.1f%% of the volume, estimated speedup %.2fx, %.1f s" %
+              (coverage * 100, speedup, time() - start))
+        return softmax_mean
+
+    # running mean over the folds. Out-of-core predictions are added to the first memmap one channel at a time
+    softmax_mean = None
+    previous_seg = None
+    num_used = len(params)
+    for k, p in enumerate(params):
+        if p is not None:
+            trainer.load_checkpoint_ram(p, False)
+        softmax = trainer.predict_preprocessing_return_softmax(d, do_tta, 1, False, 1,
+                                                               trainer.data_aug_params['mirror_axes'],
+                                                               True, True, 2, trainer.patch_size, True,
+                                                               roi_mask=roi)
+        if softmax_mean is None:
+            softmax_mean = softmax
+        elif isinstance(softmax_mean, np.memmap):
+            for c in range(softmax_mean.shape[0]):
+                softmax_mean[c] += softmax[c]
+            os.remove(softmax.filename)
+        else:
+            softmax_mean += softmax
+        del softmax
+
+        if ensemble_tolerance is not None and k + 1 < len(params):
+            # the argmax of the sum is the argmax of the running mean
+            seg = np.argmax(softmax_mean, 0)
+            if previous_seg is not None:
+                foreground = (seg > 0) | (previous_seg > 0)
+                changed = np.sum((seg != previous_seg) & foreground) / float(max(1, np.sum(foreground)))
+                if changed * (len(params) - k - 1) <= ensemble_tolerance:
+                    num_used = k + 1
+                    break
+            previous_seg = seg
+    if ensemble_tolerance is not None:
+        print("used %d of %d folds" % (num_used, len(params)))
+    if num_used > 1:
+        if isinstance(softmax_mean, np.memmap):
+            for c in range(softmax_mean.shape[0]):
+                softmax_mean[c] /= num_used
+        else:
+            softmax_mean /= num_used
+    if roi is not None:
+        tile_stats = trainer.net.inference_tile_stats
+        print("skipped %d of %d tiles outside the roi" % (tile_stats['num_skipped_tiles'], tile_stats['num_tiles']))
+    return softmax_mean
+
+
+def predict_packed_cases(trainer, params, cases, do_tta):
+    """
+    softmax predictions of several preprocessed cases that fit into the patch size, run through the network as one
+    batch and averaged over params
+    :param params: see predict_case
+    :param cases: list of preprocessed cases
+    :return: list of softmax predictions, one per case
+    """
+    softmax_means = None
+    for p in params:
+        if p is not None:
+            trainer.load_checkpoint_ram(p, False)
+        softmaxes = trainer.predict_preprocessed_packed_return_softmax(cases, do_tta, 1, False,
+                                                                       trainer.data_aug_params['mirror_axes'])
+        if softmax_means is None:
+            softmax_means = softmaxes
+        else:
+            for softmax_mean, softmax in zip(softmax_means, softmaxes):
+                softmax_mean += softmax
+    if len(params) > 1:
+        for softmax_mean in softmax_means:
+            softmax_mean /= len(params)
+    return softmax_means
+
+
+def load_resident_fold_ensemble(trainer, params):
+    """
+    loads the last of params into trainer.net and attaches a copy of the network for each of the others as its
+    inference ensemble, so that every fold is loaded only once and all folds are run tile by tile on the same input
+    :param trainer:
+    :param params: checkpoints as returned by load_model_and_checkpoint_files
+    :return:
+    """
+    ensemble = []
+    for p in params[:-1]:
+        trainer.load_checkpoint_ram(p, False)
+        ensemble.append(deepcopy(trainer.net))
+    trainer.load_checkpoint_ram(params[-1], False)
+    trainer.net.set_inference_ensemble(ensemble)
+
+
+def load_quantized_fold_ensemble(trainer, model, folds):
+    """
+    attaches the int8 models (see bins/quantize_model.py) of the folds to trainer.net and the networks of its
+    inference ensemble, as set up by load_resident_fold_ensemble
+    """
+    nets = trainer.net.inference_ensemble + [trainer.net]
+    fold_folders = get_fold_folders(model, folds)
+    assert len(nets) == len(fold_folders)
+    for net, fold_folder in zip(nets, fold_folders):
+        quantized_file = get_quantized_model_file(join(fold_folder, "model_best.model"))
+        assert isfile(quantized_file), "no quantized model found for %s, run bins/quantize_model.py first" % \
+                                       fold_folder
+        net.set_quantized_module(load_quantized_module(quantized_file))
+
+
 def predict_patient(cf, model, list_of_lists, output_filenames, folds, save_npz, num_threads_preprocessing,
                   num_threads_nifti_save, segs_from_prev_stage=None, do_tta=True,
-                  overwrite_existing=False):
+                  overwrite_existing=False, tile_batch_size=1, tile_memory_budget=None, tta_in_batch=False,
+                  max_in_memory_bytes=None, memmap_folder=None, accumulation_dtype="float32", roi_mask=None,
+                  cascade_margin=None, resident_folds=False, max_bytes_in_flight=None, num_cpu_workers=1,
+                  large_tile_budget=None, max_cases_per_batch=1, tta_uncertainty_threshold=None,
+                  ensemble_tolerance=None, compress_nifti=True, compress_npz=True, preprocessing_cache=None,
+                  preprocessing_cache_budget=None, work_board=None, quantized=False):
 
     assert len(list_of_lists) == len(output_filenames)
     if segs_from_prev_stage is not None: assert len(segs_from_prev_stage) == len(output_filenames)
-
-    prman = Pool(num_threads_nifti_save)
-    results = []
+    if cascade_margin is not None: assert segs_from_prev_stage is not None, \
+        "cascade_margin requires the segmentations of the previous stage"
+    if cascade_margin is not None: assert roi_mask is None and ensemble_tolerance is None, \
+        "cascade_margin does not support roi_mask and ensemble_tolerance"
+    assert not (quantized and ensemble_tolerance is not None), \
+        "the int8 models are ensembled tile by tile, ensemble_tolerance is not supported"
 
     cleaned_output_files = []
     for o in output_filenames:
@@ -116,7 +412,7 @@ def predict_patient(cf, model, list_of_lists, output_filenames, folds, save_npz,
 
     if not overwrite_existing:
         print("number of cases:", len(list_of_lists))
-        not_done_idx = [i for i, j in enumerate(cleaned_output_files) if not isfile(j)]
+        not_done_idx = [i for i, j in enumerate(cleaned_output_files) if not (isfile(j) or isfile(j[:-3]))]
 
         cleaned_output_files = [cleaned_output_files[i] for i in not_done_idx]
         list_of_lists = [list_of_lists[i] for i in not_done_idx]
@@ -125,54 +421,146 @@ def predict_patient(cf, model, list_of_lists, output_filenames, folds, save_npz,
 
         print("number of cases that still need to be predicted:", len(cleaned_output_files))
 
+    if work_board is not None:
+        # largest cases first, so that no node is left with a large case at the end
+        rank = dict([(c, i) for i, c in enumerate(work_board.order)])
+        order = sorted(range(len(cleaned_output_files)),
+                       key=lambda i: rank.get(get_case_id(cleaned_output_files[i]), len(rank)))
+        cleaned_output_files = [cleaned_output_files[i] for i in order]
+        list_of_lists = [list_of_lists[i] for i in order]
+        if segs_from_prev_stage is not None:
+            segs_from_prev_stage = [segs_from_prev_stage[i] for i in order]
+        work_board.start_heartbeat()
+
+    # export workers are started before the networks are loaded so that they do not inherit the CUDA context
+    preprocess_budget = ByteBudget(max_bytes_in_flight)
+    # without a byte limit every export worker can work on a prediction
+    export_budget = ByteBudget(max_bytes_in_flight, max(1, num_threads_nifti_save))
+    export_q = Queue()
+    export_stats_q = Queue()
+    exporters = []
+    for i in range(num_threads_nifti_save):
+        pr = Process(target=export_from_que, args=(export_q, export_budget, export_stats_q, compress_nifti,
+                                                   compress_npz, work_board))
+        pr.start()
+        exporters.append(pr)
+
     print("emptying cuda cache")
     torch.cuda.empty_cache()
 
     print("loading parameters for folds,", folds)
     trainer, params = load_model_and_checkpoint_files(model, folds)
+    trainer.inference_tile_batch_size = tile_batch_size
+    trainer.inference_tile_memory_budget = tile_memory_budget
+    trainer.inference_mirror_in_batch = tta_in_batch
+    trainer.inference_max_in_memory_bytes = max_in_memory_bytes
+    trainer.inference_memmap_folder = memmap_folder
+    trainer.inference_accumulation_dtype = accumulation_dtype
+    trainer.inference_num_cpu_workers = num_cpu_workers
+    if num_cpu_workers > 1:
+        prepare_cpu_workers()
+    trainer.inference_large_tile_budget = large_tile_budget
+
+    if resident_folds and ensemble_tolerance is not None and len(params) > 1:
+        # resident folds are ensembled tile by tile, early exit needs the folds one after the other
+        print("ensemble_tolerance is set, folds are evaluated one after the other")
+        resident_folds = False
+    if resident_folds or quantized:
+        print("keeping all folds resident")
+        load_resident_fold_ensemble(trainer, params)
+        params = [None]
+    if quantized:
+        print("using the int8 models on the cpu")
+        load_quantized_fold_ensemble(trainer, model, folds)
+    trainer.net.inference_tta_uncertainty_threshold = tta_uncertainty_threshold
+
+    def log_tta_escalation():
+        tta_stats = trainer.net.inference_tta_stats
+        if tta_uncertainty_threshold is not None and do_tta and tta_stats['num_tiles'] > 0:
+            print("test time augmentation for %d of %d tiles (%.1f%%)" % (
+                tta_stats['num_escalated'], tta_stats['num_tiles'],
+                100. * tta_stats['num_escalated'] / tta_stats['num_tiles']))
+        trainer.net.inference_tta_stats = {'num_tiles': 0, 'num_escalated': 0}
 
     print("starting preprocessing generator")
-    preprocessing = preprocessing_multithreads(trainer, list_of_lists, cleaned_output_files, num_threads_preprocessing, segs_from_prev_stage)
+    preprocess_stats = []
+    preprocessing = preprocessing_multithreads(trainer, list_of_lists, cleaned_output_files, num_threads_preprocessing,
+                                               segs_from_prev_stage, roi_mask, preprocess_budget, preprocess_stats,
+                                               None if preprocessing_cache is None else
+                                               PreprocessedCaseCache(preprocessing_cache, preprocessing_cache_budget),
+                                               work_board)
     print("starting prediction...")
-    for preprocessing in preprocessing:
-        output_filename, (d, dct) = preprocessing
-        if isinstance(d, str):
-            data = np.load(d)
-            os.remove(d)
-            d = data
-
-        print("predicting", output_filename)
-
-        softmax = []
-        for p in params:
-            trainer.load_checkpoint_ram(p, False)
-            softmax.append(trainer.predict_preprocessing_return_softmax(d, do_tta, 1, False, 1,
-                                                                       trainer.data_aug_params['mirror_axes'],
-                                                             True, True, 2, trainer.patch_size, True)[None])
-
-        softmax = np.vstack(softmax)
-        softmax_mean = np.mean(softmax, 0)
-
-        if save_npz:
-            npz_file = output_filename[:-7] + ".npz"
+    predict_timer = StageTimer()
+
+    def export(softmax_mean, output_filename, dct):
+        npz_file = output_filename[:-7] + ".npz" if save_npz else None
+        if isinstance(softmax_mean, np.memmap):
+            # out-of-core predictions are handed over as file and do not count against the budget
+            export_q.put((save_softmax_for_export(softmax_mean, output_filename[:-7] + ".npy"), None,
+                          output_filename, dct, npz_file))
         else:
-            npz_file = None
+            export_budget.acquire(softmax_mean.nbytes)
+            with predict_timer.working():
+                export_q.put((array_to_shared_memory(softmax_mean), softmax_mean.nbytes, output_filename, dct,
+                              npz_file))
+
+    # cases that fit into the patch size wait here until max_cases_per_batch of them can be predicted together
+    packed = []
+
+    def predict_packed():
+        print("predicting %d cases in one batch" % len(packed))
+        with predict_timer.working():
+            softmaxes = predict_packed_cases(trainer, params, [d for _, d, _ in packed], do_tta)
+        log_tta_escalation()
+        for (output_filename, _, dct), softmax_mean in zip(packed, softmaxes):
+            export(softmax_mean, output_filename, dct)
+        del packed[:]
+
+    for output_filename, (d_shared, dct, roi) in preprocessing:
+        if max_cases_per_batch > 1 and cascade_margin is None and \
+                all([i <= j for i, j in zip(d_shared[1][1:], trainer.patch_size)]):
+            with shared_memory_array(d_shared) as d:
+                packed.append((output_filename, np.array(d), dct))
+                del d
+            preprocess_budget.release(shared_memory_nbytes(d_shared))
+            if len(packed) == max_cases_per_batch:
+                predict_packed()
+            continue
 
-        if np.prod(softmax_mean.shape) > (2e9 / 4 * 0.9):  # *0.9 just to be save
-            print("Output is too large. Saving output temporarily to disk")
-            np.save(output_filename[:-7] + ".npy", softmax_mean)
-            softmax_mean = output_filename[:-7] + ".npy"
-
-        results.append(prman.starmap_async(store_seg_from_softmax,
-                                           ((softmax_mean, output_filename, dct, 1, None, None, None, npz_file), )
-                                           ))
-
-    _ = [i.get() for i in results]
+        print("predicting", output_filename)
+        with predict_timer.working():
+            with shared_memory_array(d_shared) as d:
+                softmax_mean = predict_case(trainer, params, d, do_tta, roi, cascade_margin, ensemble_tolerance)
+                del d
+        log_tta_escalation()
+        preprocess_budget.release(shared_memory_nbytes(d_shared))
+        export(softmax_mean, output_filename, dct)
+        del softmax_mean
+    if len(packed) > 0:
+        predict_packed()
+
+    for _ in exporters:
+        export_q.put(None)
+    export_stats = [export_stats_q.get() for _ in exporters]
+    for pr in exporters:
+        pr.join()
+    if work_board is not None:
+        work_board.stop_heartbeat()
+        work_board.write_progress()
+    print("stage utilization: preprocessing %.1f%% (%d workers), prediction %.1f%%, export %.1f%% (%d workers)" %
+          (utilization(preprocess_stats) * 100, num_threads_preprocessing,
+           utilization([predict_timer.get_stats()]) * 100, utilization(export_stats) * 100, num_threads_nifti_save))
 
 
 def predict_group(cf, model, input_folder, output_folder, folds, save_npz, num_threads_preprocessing,
                                      num_threads_nifti_save, lowres_segmentations, part_id, num_parts, tta,
-                        overwrite_existing=True):
+                        overwrite_existing=True, tile_batch_size=1, tile_memory_budget=None, tta_in_batch=False,
+                        max_in_memory_bytes=None, memmap_folder=None, accumulation_dtype="float32",
+                        roi_mask=None, cascade_margin=None, resident_folds=False, max_bytes_in_flight=None,
+                        num_cpu_workers=1, large_tile_budget=None, max_cases_per_batch=1,
+                        tta_uncertainty_threshold=None, ensemble_tolerance=None, compress_nifti=True,
+                        compress_npz=True, preprocessing_cache=None, preprocessing_cache_budget=None,
+                        work_folder=None, lease_time=1800, quantized=False):
     """
     use the standard naming scheme to generate list_of_lists and output_files needed by predict_patient
     :param model:
@@ -186,6 +574,44 @@ def predict_group(cf, model, input_folder, output_folder, folds, save_npz, num_t
     :param part_id:
     :param num_parts:
     :param tta:
+    :param tile_batch_size: tiles per forward pass. None: derive it from tile_memory_budget
+    :param tile_memory_budget: bytes one forward pass may use
+    :param tta_in_batch: run all mirrored versions of a tile in one forward pass
+    :param max_in_memory_bytes: softmax buffers larger than this are kept in memory-mapped files in memmap_folder
+    :param memmap_folder:
+    :param accumulation_dtype: float32, float16 or bfloat16. dtype the sliding window tiles are aggregated in
+    :param roi_mask: None, 'nonzero' (nonzero mask of the cropping) or 'lowres' (foreground of
+    lowres_segmentations). Sliding window tiles outside of it are not predicted but set to background
+    :param cascade_margin: if not None, the full resolution stage of a cascade is only predicted in the bounding
+    boxes of the lowres_segmentations foreground, enlarged by cascade_margin voxels. The rest is taken from the
+    lowres segmentation. Cannot be combined with roi_mask and ensemble_tolerance
+    :param resident_folds: keep one network per fold on the device and ensemble them tile by tile instead of
+    reloading the parameters of every fold for every case. GPU memory grows with the number of folds
+    :param max_bytes_in_flight: bytes of preprocessed volumes waiting for prediction and of predictions waiting for
+    export (each). Volumes are passed between the stages in shared memory. None: one preprocessed volume and one
+    prediction per export worker at a time
+    :param num_cpu_workers: when predicting on the cpu, split the sliding window tiles of a case among this many
+    processes. If > 1 the main process runs with one intra-op thread (see models.base_net.prepare_cpu_workers)
+    :param large_tile_budget: if not None, use sliding window tiles larger than the training patch whose forward pass
+    fits into this many bytes (fewer tiles, less overlap)
+    :param max_cases_per_batch: cases that are not larger than the patch size are padded to it and predicted together,
+    up to this many per forward pass
+    :param tta_uncertainty_threshold: adaptive test time augmentation. Tiles are first predicted without mirroring,
+    only tiles whose fraction of ambiguous voxels (within the foreground) exceeds this value are also predicted
+    mirrored. None: mirror every tile (if tta)
+    :param ensemble_tolerance: evaluate the folds one after the other and stop once the remaining folds are not
+    expected to change more than this fraction of the foreground voxels, see predict_case. None: use all folds
+    :param compress_nifti: False: write .nii instead of .nii.gz
+    :param compress_npz: False: write the softmax npz files (save_npz) uncompressed
+    :param preprocessing_cache: folder in which preprocessed cases are cached across runs and models with the same
+    preprocessing. None: no cache
+    :param preprocessing_cache_budget: bytes the cache may use, least recently used cases are evicted first
+    :param work_folder: folder on a filesystem shared by all nodes. If not None, part_id and num_parts are ignored
+    and every node claims the next unclaimed case (largest first) through claim files in work_folder, see
+    WorkStealingBoard. Progress and ETA of all nodes are written to work_folder/progress.json
+    :param lease_time: seconds after which the claims of a node that stopped renewing them are taken over by others
+    :param quantized: predict on the cpu with the int8 models stored next to the checkpoints (see
+    bins/quantize_model.py)
     :return:
     """
     maybe_mkdir_p(output_folder)
@@ -202,12 +628,31 @@ def predict_group(cf, model, input_folder, output_folder, folds, save_npz, num_t
         lowres_segmentations = [join(lowres_segmentations, i + ".nii.gz") for i in case_ids]
         assert all([isfile(i) for i in lowres_segmentations]), "not all lowres_segmentations files are present. " \
                                                                "(I was searching for case_id.nii.gz in that folder)"
-        lowres_segmentations = lowres_segmentations[part_id::num_parts]
     else:
         lowres_segmentations = None
+
+    work_board = None
+    if work_folder is not None:
+        # all nodes see all cases, the board decides who predicts what
+        part_id, num_parts = 0, 1
+        work_board = WorkStealingBoard(work_folder, case_ids,
+                                       [get_num_voxels_from_header(l[0]) for l in list_of_lists], lease_time)
+    if lowres_segmentations is not None:
+        lowres_segmentations = lowres_segmentations[part_id::num_parts]
     return predict_patient(cf, model, list_of_lists[part_id::num_parts], output_files[part_id::num_parts], folds, save_npz,
                          num_threads_preprocessing, num_threads_nifti_save, lowres_segmentations,
-                         tta, overwrite_existing=overwrite_existing)
+                         tta, overwrite_existing=overwrite_existing, tile_batch_size=tile_batch_size,
+                         tile_memory_budget=tile_memory_budget, tta_in_batch=tta_in_batch,
+                         max_in_memory_bytes=max_in_memory_bytes, memmap_folder=memmap_folder,
+                         accumulation_dtype=accumulation_dtype, roi_mask=roi_mask,
+                         cascade_margin=cascade_margin, resident_folds=resident_folds,
+                         max_bytes_in_flight=max_bytes_in_flight, num_cpu_workers=num_cpu_workers,
+                         large_tile_budget=large_tile_budget, max_cases_per_batch=max_cases_per_batch,
+                         tta_uncertainty_threshold=tta_uncertainty_threshold,
+                         ensemble_tolerance=ensemble_tolerance, compress_nifti=compress_nifti,
+                         compress_npz=compress_npz, preprocessing_cache=preprocessing_cache,
+                         preprocessing_cache_budget=preprocessing_cache_budget, work_board=work_board,
+                         quantized=quantized)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+import json
+import os
+import pickle
+from hashlib import sha1
+import numpy as np
+from utils.files_utils import *
+
+
+def get_preprocessing_fingerprint(trainer):
+    """
+    hash of everything that determines the output of trainer.preprocess_patient besides the input files: target
+    spacing, resampling, normalization, intensity properties and transpose of the plans
+    """
+    identity = {'threeD': trainer.threeD,
+                'target_spacing': trainer.plans['plans_per_stage'][trainer.stage]['current_spacing'],
+                'resampling': trainer.plans.get('resampling', "spline"),
+                'normalization_schemes': trainer.normalization_schemes,
+                'use_mask_for_norm': trainer.use_mask_for_norm,
+                'intensity_properties': trainer.intensity_properties,
+                'transpose_forward': trainer.plans.get('transpose_forward')}
+    return sha1(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def hash_files(files, chunk_size=2 ** 20):
+    h = sha1()
+    for f in files:
+        with open(f, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                h.update(chunk)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class PreprocessedCaseCache(object):
+    def __init__(self, folder, max_bytes=None):
+        """
+        content-addressed cache of preprocessed cases on disk, shared by all processes (and runs) that use folder.
+        Entries are keyed by the content of the input files and the preprocessing fingerprint of the trainer, the
+        least recently used entries are deleted once the cache grows beyond max_bytes
+        :param folder:
+        :param max_bytes: None: unbounded
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        maybe_mkdir_p(folder)
+
+    def _files(self, key):
+        return join(self.folder, key + "_data.npy"), join(self.folder, key + "_seg.npy"), join(self.folder,
+                                                                                              key + ".pkl")
+
+    def load(self, key):
+        """
+        :return: (data, seg, properties) or None if key is not in the cache
+        """
+        data_file, seg_file, properties_file = self._files(key)
+        try:
+            with open(properties_file, 'rb') as f:
+                properties = pickle.load(f)
+            data = np.load(data_file)
+            seg = np.load(seg_file) if isfile(seg_file) else None
+            # the properties file is the last one written and its access time is the one used for eviction
+            os.utime(properties_file)
+        except (IOError, OSError, EOFError, ValueError):
+            # not cached or evicted by another process while we were reading it
+            return None
+        return data, seg, properties
+
+    def store(self, key, data, seg, properties):
+        data_file, seg_file, properties_file = self._files(key)
+        pid = "_%d" % os.getpid()
+        # write to temporary files first so that concurrent readers never see partial entries
+        np.save(data_file[:-4] + pid + ".npy", data)
+        os.replace(data_file[:-4] + pid + ".npy", data_file)
+        if seg is not None:
+            np.save(seg_file[:-4] + pid + ".npy", seg)
+            os.replace(seg_file[:-4] + pid + ".npy", seg_file)
+        with open(properties_file + pid, 'wb') as f:
+            pickle.dump(properties, f)
+        os.replace(properties_file + pid, properties_file)
+        self.evict()
+
+    def evict(self):
+        """
+        deletes the least recently used entries until the cache fits into self.max_bytes
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for f in subfiles(self.folder, suffix=".pkl", join=False):
+            files = [i for i in self._files(f[:-4]) if isfile(i)]
+            try:
+                entries.append((os.path.getmtime(join(self.folder, f)), sum([os.path.getsize(i) for i in files]),
+                                files))
+            except OSError:
+                pass
+        total = sum([e[1] for e in entries])
+        for _, nbytes, files in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # the properties file goes first so that the entry is invalid before its data disappears
+            for f in files[::-1]:
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+            total -= nbytes
+
+
+class CachedPreprocessor(object):
+    def __init__(self, cache, preprocess_fn, fingerprint):
+        """
+        drop-in replacement for preprocess_fn (e.g. Trainer.preprocess_patient) that looks the input files up in
+        cache first
+        :param cache: PreprocessedCaseCache
+        :param preprocess_fn:
+        :param fingerprint: see get_preprocessing_fingerprint
+        """
+        self.cache = cache
+        self.preprocess_fn = preprocess_fn
+        self.fingerprint = fingerprint
+
+    def __call__(self, input_files):
+        key = sha1((hash_files(input_files) + self.fingerprint).encode()).hexdigest()
+        cached = self.cache.load(key)
+        if cached is not None:
+            print("preprocessed case found in cache:", input_files[0])
+            return cached
+        d, s, properties = self.preprocess_fn(input_files)
+        self.cache.store(key, d, s, properties)
+        return d, s, properties
@@ -0,0 +1,413 @@
+import itertools
+import json
+import os
+import socket
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import BytesIO
+from queue import PriorityQueue, Empty
+from socketserver import ThreadingMixIn, UnixStreamServer
+from time import time
+from urllib.parse import urlparse, parse_qs, urlencode
+import numpy as np
+
+from inference.predictor import load_resident_fold_ensemble
+from training.search_and_load_model import load_model_and_checkpoint_files
+from utils.exp_utils import store_seg_from_softmax
+from utils.files_utils import *
+
+
+class _TileJob(object):
+    def __init__(self, net, batch, args, deadline):
+        self.net = net
+        self.batch = batch
+        self.args = args
+        self.deadline = deadline
+        num_repeats, mirror_axes, do_mirroring, mult, mirror_in_batch = args
+        # only tiles with the same key can share a forward pass
+        self.key = (id(net), batch.shape[1:], num_repeats, tuple(mirror_axes), do_mirroring, id(mult),
+                    mirror_in_batch)
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class TileBatchScheduler(object):
+    def __init__(self, max_tiles_per_batch=8, max_wait=0.05):
+        """
+        merges the sliding window tile batches of concurrent predictions into shared forward passes. Attach it to a
+        network with net.inference_tile_scheduler = scheduler. All forward passes of tile batches then run in the
+        scheduler thread, the predicting threads block until their tiles are done
+        :param max_tiles_per_batch: upper bound for the number of tiles of a merged forward pass
+        :param max_wait: how long (in s) the scheduler waits for tiles of other predictions before it runs a batch.
+        Shorter if the deadline of the oldest waiting prediction does not allow it
+        """
+        self.max_tiles_per_batch = max_tiles_per_batch
+        self.max_wait = max_wait
+        self._queue = PriorityQueue()
+        self._held = []
+        self._counter = itertools.count()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._forward_time = 0.
+
+        self.queued_tiles = 0
+        self.max_queued_tiles = 0
+        self.num_forward_passes = 0
+        self.num_tiles = 0
+        self.total_forward_time = 0.
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def set_deadline(self, deadline):
+        """
+        deadline (time() timestamp) of the prediction running in the calling thread. Tiles are scheduled earliest
+        deadline first. None: no deadline
+        """
+        self._local.deadline = float("inf") if deadline is None else deadline
+
+    def predict(self, net, batch, num_repeats, mirror_axes, do_mirroring=True, mult=None, mirror_in_batch=False):
+        """
+        same as net.run_tile_batch, but the tiles may share a forward pass with the tiles of other predictions
+        """
+        job = _TileJob(net, batch, (num_repeats, mirror_axes, do_mirroring, mult, mirror_in_batch),
+                       getattr(self._local, "deadline", float("inf")))
+        with self._lock:
+            self.queued_tiles += len(batch)
+            self.max_queued_tiles = max(self.max_queued_tiles, self.queued_tiles)
+        self._queue.put((job.deadline, next(self._counter), job))
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def get_metrics(self):
+        with self._lock:
+            return {'queued_tile_batches': self._queue.qsize() + len(self._held),
+                    'queued_tiles': self.queued_tiles,
+                    'max_queued_tiles': self.max_queued_tiles,
+                    'forward_passes': self.num_forward_passes,
+                    'tiles': self.num_tiles,
+                    'mean_tiles_per_forward_pass': self.num_tiles / max(1, self.num_forward_passes),
+                    'mean_forward_time': self.total_forward_time / max(1, self.num_forward_passes)}
+
+    def _next_job(self, key, wait_until):
+        for i, job in enumerate(self._held):
+            if job.key == key:
+                return self._held.pop(i)
+        while True:
+            remaining = wait_until - time()
+            try:
+                if remaining > 0:
+                    job = self._queue.get(timeout=remaining)[2]
+                else:
+                    job = self._queue.get_nowait()[2]
+            except Empty:
+                return None
+            if job.key == key:
+                return job
+            self._held.append(job)
+
+    def _run(self):
+        while True:
+            if len(self._held) > 0:
+                first = min(self._held, key=lambda j: j.deadline)
+                self._held.remove(first)
+            else:
+                first = self._queue.get()[2]
+            jobs = [first]
+            num_tiles = len(first.batch)
+            wait_until = min(time() + self.max_wait, first.deadline - self._forward_time)
+            while num_tiles < self.max_tiles_per_batch:
+                job = self._next_job(first.key, wait_until)
+                if job is None:
+                    break
+                if num_tiles + len(job.batch) > self.max_tiles_per_batch:
+                    self._held.insert(0, job)
+                    break
+                jobs.append(job)
+                num_tiles += len(job.batch)
+            self._run_jobs(jobs, num_tiles)
+
+    def _run_jobs(self, jobs, num_tiles):
+        start = time()
+        try:
+            pred = jobs[0].net.run_tile_batch(np.concatenate([j.batch for j in jobs]), *jobs[0].args)
+            offset = 0
+            for j in jobs:
+                j.result = pred[offset:offset + len(j.batch)]
+                offset += len(j.batch)
+        except Exception as e:
+            for j in jobs:
+                j.error = e
+        forward_time = time() - start
+        # running estimate of the time a forward pass needs, batches are started early enough to meet deadlines
+        self._forward_time = 0.9 * self._forward_time + 0.1 * forward_time if self.num_forward_passes > 0 \
+            else forward_time
+        with self._lock:
+            self.queued_tiles -= num_tiles
+            self.num_forward_passes += 1
+            self.num_tiles += num_tiles
+            self.total_forward_time += forward_time
+        for j in jobs:
+            j.done.set()
+
+
+class InferenceServer(object):
+    def __init__(self, tasks, scheduler, num_latencies=1000):
+        """
+        keeps the networks of all tasks loaded. Predictions can run concurrently (one thread each), the sliding window
+        tiles of all predictions are run through scheduler
+        :param tasks: dict task name -> dict with model_folder, folds (see load_model_and_checkpoint_files) and
+        optionally trainer inference attributes without the inference_ prefix (e.g. tile_batch_size)
+        :param scheduler: TileBatchScheduler
+        :param num_latencies: number of recent request latencies kept for the metrics
+        """
+        self.scheduler = scheduler
+        self.trainers = {}
+        for name, task in tasks.items():
+            print("loading", name)
+            task = dict(task)
+            trainer, params = load_model_and_checkpoint_files(task.pop('model_folder'), task.pop('folds', None))
+            load_resident_fold_ensemble(trainer, params)
+            for k, v in task.items():
+                assert hasattr(trainer, "inference_" + k), "unknown inference setting %s for task %s" % (k, name)
+                setattr(trainer, "inference_" + k, v)
+            trainer.net.inference_tile_scheduler = scheduler
+            self.trainers[name] = trainer
+
+        self._lock = threading.Lock()
+        self.active_requests = 0
+        self.num_requests = 0
+        self.num_failed_requests = 0
+        self.num_missed_deadlines = 0
+        self.latencies = deque(maxlen=num_latencies)
+
+    def _predict(self, task, data, do_tta, latency_target):
+        if task not in self.trainers:
+            raise KeyError("unknown task %s" % task)
+        trainer = self.trainers[task]
+        self.scheduler.set_deadline(None if latency_target is None else time() + latency_target)
+        return trainer.predict_preprocessing_return_softmax(data, do_tta, 1, False, 1,
+                                                            trainer.data_aug_params['mirror_axes'], True, True, 2,
+                                                            trainer.patch_size, True)
+
+    def predict_files(self, task, input_files, output_file, do_tta=True, latency_target=None):
+        """
+        preprocesses input_files (one file per modality), predicts them and exports the segmentation to output_file
+        :param latency_target: in s, measured from the start of the request
+        """
+        start = time()
+        with self._track_request(start, latency_target):
+            d, _, dct = self.trainers[task].preprocess_patient(input_files)
+            softmax = self._predict(task, d, do_tta, None if latency_target is None else
+                                    latency_target - (time() - start))
+            store_seg_from_softmax(softmax, output_file, dct, 1, None, None, None, None)
+        return output_file
+
+    def predict_array(self, task, data, do_tta=True, latency_target=None):
+        """
+        predicts already preprocessed data (c, x, y, z)
+        :return: segmentation (x, y, z)
+        """
+        with self._track_request(time(), latency_target):
+            softmax = self._predict(task, data.astype(np.float32), do_tta, latency_target)
+            seg = np.asarray(softmax).argmax(0).astype(np.uint8 if softmax.shape[0] <= 256 else np.int16)
+        return seg
+
+    @contextmanager
+    def _track_request(self, start, latency_target):
+        with self._lock:
+            self.active_requests += 1
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            latency = time() - start
+            with self._lock:
+                self.active_requests -= 1
+                self.num_requests += 1
+                if failed:
+                    self.num_failed_requests += 1
+                else:
+                    self.latencies.append(latency)
+                    if latency_target is not None and latency > latency_target:
+                        self.num_missed_deadlines += 1
+
+    def get_metrics(self):
+        with self._lock:
+            latencies = np.array(self.latencies)
+            requests = {'active': self.active_requests,
+                        'served': self.num_requests,
+                        'failed': self.num_failed_requests,
+                        'missed_latency_targets': self.num_missed_deadlines}
+        if len(latencies) > 0:
+            requests['mean_latency'] = float(latencies.mean())
+            requests['p50_latency'] = float(np.percentile(latencies, 50))
+            requests['p95_latency'] = float(np.percentile(latencies, 95))
+        return {'requests': requests, 'scheduler': self.scheduler.get_metrics()}
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /tasks, GET /metrics
+    POST /predict with json {"task", "input_files", "output_file", "do_tta", "latency_target"}
+    POST /predict_array?task=...&do_tta=1&latency_target=... with an .npy file of preprocessed data as body. The
+    response is the segmentation as .npy file
+    """
+    def address_string(self):
+        # client_address is empty for unix sockets
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix socket"
+
+    def _send(self, code, body, content_type="application/json"):
+        if content_type == "application/json":
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self._send(200, self.server.inference_server.get_metrics())
+        elif path == "/tasks":
+            self._send(200, sorted(self.server.inference_server.trainers.keys()))
+        else:
+            self._send(404, {'error': "unknown path %s" % path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        try:
+            if url.path == "/predict":
+                request = json.loads(self._read_body().decode())
+                start = time()
+                output_file = self.server.inference_server.predict_files(request['task'], request['input_files'],
+                                                                         request['output_file'],
+                                                                         request.get('do_tta', True),
+                                                                         request.get('latency_target'))
+                self._send(200, {'output_file': output_file, 'latency': time() - start})
+            elif url.path == "/predict_array":
+                query = parse_qs(url.query)
+                latency_target = query.get('latency_target')
+                seg = self.server.inference_server.predict_array(
+                    query['task'][0], np.load(BytesIO(self._read_body())), bool(int(query.get('do_tta', ['1'])[0])),
+                    None if latency_target is None else float(latency_target[0]))
+                out = BytesIO()
+                np.save(out, seg)
+                self._send(200, out.getvalue(), "application/octet-stream")
+            else:
+                self._send(404, {'error': "unknown path %s" % url.path})
+        except (KeyError, ValueError) as e:
+            self._send(400, {'error': repr(e)})
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            self._send(500, {'error': repr(e)})
+
+
+class ThreadingHTTPInferenceServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixInferenceServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(inference_server, port=None, socket_path=None, host="localhost"):
+    """
+    serves inference_server over http on host:port or on the unix socket socket_path until interrupted
+    """
+    assert (port is None) != (socket_path is None), "specify either port or socket_path"
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = ThreadingUnixInferenceServer(socket_path, InferenceRequestHandler)
+        print("serving on unix socket", socket_path)
+    else:
+        httpd = ThreadingHTTPInferenceServer((host, port), InferenceRequestHandler)
+        print("serving on http://%s:%d" % (host, port))
+    httpd.inference_server = inference_server
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class InferenceClient(object):
+    def __init__(self, port=None, socket_path=None, host="localhost", timeout=None):
+        """
+        client for a server started with serve(). Specify either port or socket_path
+        """
+        assert (port is None) != (socket_path is None), "specify either port or socket_path"
+        self.port = port
+        self.socket_path = socket_path
+        self.host = host
+        self.timeout = timeout
+
+    def _request(self, method, url, body=None, headers=None):
+        if self.socket_path is not None:
+            connection = UnixHTTPConnection(self.socket_path, self.timeout)
+        else:
+            connection = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request(method, url, body, headers if headers is not None else {})
+            response = connection.getresponse()
+            data = response.read()
+            if response.status != 200:
+                raise RuntimeError("inference server returned %d: %s" % (response.status, data.decode()))
+            return data
+        finally:
+            connection.close()
+
+    def tasks(self):
+        return json.loads(self._request("GET", "/tasks").decode())
+
+    def metrics(self):
+        return json.loads(self._request("GET", "/metrics").decode())
+
+    def predict(self, task, input_files, output_file, do_tta=True, latency_target=None):
+        """
+        :param input_files: one file per modality, as for predict_patient. Paths must be valid on the server
+        :return: server response, dict with output_file and latency
+        """
+        request = {'task': task, 'input_files': input_files, 'output_file': output_file, 'do_tta': do_tta,
+                   'latency_target': latency_target}
+        return json.loads(self._request("POST", "/predict", json.dumps(request).encode(),
+                                        {"Content-Type": "application/json"}).decode())
+
+    def predict_array(self, task, data, do_tta=True, latency_target=None):
+        """
+        :param data: preprocessed data (c, x, y, z)
+        :return: segmentation (x, y, z)
+        """
+        query = {'task': task, 'do_tta': int(do_tta)}
+        if latency_target is not None:
+            query['latency_target'] = latency_target
+        body = BytesIO()
+        np.save(body, data)
+        return np.load(BytesIO(self._request("POST", "/predict_array?" + urlencode(query), body.getvalue(),
+                                             {"Content-Type": "application/octet-stream"})))
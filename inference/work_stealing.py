@@ -0,0 +1,176 @@
+import json
+import os
+import socket
+from threading import Event, Thread
+from time import time
+import numpy as np
+import SimpleITK as sitk
+from utils.files_utils import *
+
+
+def get_num_voxels_from_header(fname):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(fname)
+    reader.ReadImageInformation()
+    return int(np.prod(reader.GetSize()))
+
+
+def _write_json_atomic(obj, fname):
+    tmp = fname + ".%s_%d" % (socket.gethostname(), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=4)
+    os.replace(tmp, fname)
+
+
+def _create_exclusive(fname, content):
+    """
+    :return: True if fname did not exist and was created by us
+    """
+    try:
+        fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    return True
+
+
+class WorkStealingBoard(object):
+    def __init__(self, folder, case_ids, case_sizes, lease_time=1800, node_id=None):
+        """
+        distributes cases among any number of nodes through claim files in a shared folder, without a central
+        service. A node claims a case by creating its claim file exclusively and keeps the claim alive by touching it
+        (see start_heartbeat). Claims that were not touched for lease_time seconds are considered abandoned and can be
+        claimed by other nodes. Finished cases get a done file, progress.json summarizes the progress of all nodes
+        :param folder: shared by all nodes
+        :param case_ids: all cases (the same on every node)
+        :param case_sizes: number of voxels per case, used to order the cases largest first and for the ETA
+        :param lease_time: in s
+        :param node_id: default: hostname and pid
+        """
+        self.folder = folder
+        self.lease_time = lease_time
+        self.node_id = node_id if node_id is not None else "%s_%d" % (socket.gethostname(), os.getpid())
+        self.claims_folder = join(folder, "claims")
+        self.done_folder = join(folder, "done")
+        maybe_mkdir_p(self.claims_folder)
+        maybe_mkdir_p(self.done_folder)
+        # the first node fixes the start time and the case sizes for the progress manifest
+        _create_exclusive(join(folder, "start.json"), json.dumps({'start': time(), 'node': self.node_id}))
+        if not isfile(join(folder, "cases.json")):
+            _write_json_atomic(dict(zip(case_ids, [int(i) for i in case_sizes])), join(folder, "cases.json"))
+        self.order = [case_ids[i] for i in np.argsort(case_sizes, kind='stable')[::-1]]
+        self._heartbeat_stop = None
+
+    def _claim_file(self, case_id):
+        return join(self.claims_folder, case_id + ".claim")
+
+    def _done_file(self, case_id):
+        return join(self.done_folder, case_id + ".done")
+
+    def claim(self, case_id):
+        """
+        :return: True if this node now owns case_id
+        """
+        if isfile(self._done_file(case_id)):
+            return False
+        claim_file = self._claim_file(case_id)
+        if _create_exclusive(claim_file, self.node_id):
+            return True
+        try:
+            expired = time() - os.path.getmtime(claim_file) > self.lease_time
+        except OSError:
+            expired = False
+        if not expired or isfile(self._done_file(case_id)):
+            return False
+        # only one node can move the abandoned claim away, all others fail the rename
+        stale = claim_file + ".stale_" + self.node_id
+        try:
+            os.rename(claim_file, stale)
+        except OSError:
+            return False
+        os.remove(stale)
+        print("recovering abandoned case", case_id)
+        return _create_exclusive(claim_file, self.node_id)
+
+    def owns(self, case_id):
+        try:
+            with open(self._claim_file(case_id), 'r') as f:
+                return f.read() == self.node_id
+        except (IOError, OSError):
+            return False
+
+    def release(self, case_id):
+        """
+        gives up the claim on case_id (e.g. because it failed) so that it is not renewed anymore
+        """
+        if self.owns(case_id):
+            try:
+                os.remove(self._claim_file(case_id))
+            except OSError:
+                pass
+
+    def finish(self, case_id, seconds=None):
+        """
+        marks case_id as done, releases its claim and updates progress.json
+        """
+        with open(self._done_file(case_id), 'w') as f:
+            json.dump({'node': self.node_id, 'finished': time(), 'seconds': seconds}, f)
+        try:
+            os.remove(self._claim_file(case_id))
+        except OSError:
+            pass
+        self.write_progress()
+
+    def _renew_own_claims(self):
+        for f in subfiles(self.claims_folder, suffix=".claim", join=False):
+            case_id = f[:-len(".claim")]
+            if self.owns(case_id):
+                try:
+                    os.utime(self._claim_file(case_id))
+                except OSError:
+                    pass
+
+    def start_heartbeat(self, interval=None):
+        """
+        touches the claims of this node every interval s (default: lease_time / 4) in a background thread
+        """
+        interval = self.lease_time / 4. if interval is None else interval
+        self._heartbeat_stop = Event()
+
+        def heartbeat():
+            while not self._heartbeat_stop.wait(interval):
+                self._renew_own_claims()
+
+        Thread(target=heartbeat, daemon=True).start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat_stop is not None:
+            self._heartbeat_stop.set()
+
+    def write_progress(self):
+        """
+        progress.json: finished cases and voxels, cases in progress per node and an ETA from the voxel throughput of
+        all nodes since the first node started
+        """
+        case_sizes = load_json(join(self.folder, "cases.json"))
+        start = load_json(join(self.folder, "start.json"))['start']
+        done = [f[:-len(".done")] for f in subfiles(self.done_folder, suffix=".done", join=False)]
+        in_progress = {}
+        for f in subfiles(self.claims_folder, suffix=".claim", join=False):
+            try:
+                with open(join(self.claims_folder, f), 'r') as fp:
+                    node = fp.read()
+            except (IOError, OSError):
+                continue
+            in_progress[node] = in_progress.get(node, 0) + 1
+        voxels_total = sum(case_sizes.values())
+        voxels_done = sum([case_sizes.get(i, 0) for i in done])
+        elapsed = time() - start
+        eta = None
+        if voxels_done > 0:
+            eta = elapsed / voxels_done * (voxels_total - voxels_done)
+        _write_json_atomic({'num_cases': len(case_sizes), 'num_done': len(done), 'voxels_total': voxels_total,
+                            'voxels_done': voxels_done, 'in_progress_per_node': in_progress,
+                            'elapsed_seconds': elapsed, 'eta_seconds': eta, 'updated': time()},
+                           join(self.folder, "progress.json"))
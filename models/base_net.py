@@ -1,11 +1,53 @@
 
+import os
+import mmap
+import tempfile
 import numpy as np
+from itertools import product
+from numpy.lib.format import open_memmap
 from datasets.data_augmentation.aug_utils import pad_nd_img
 from utils.data_utils import flip
 from torch import nn
 import torch
+import torch.multiprocessing
 from scipy.ndimage.filters import gaussian_filter
 
+# intra-op threads of the process before prepare_cpu_workers limited it to one, shared among the cpu workers
+_cpu_worker_total_threads = None
+
+
+def prepare_cpu_workers():
+    """
+    the cpu workers of DetectionNet._accumulate_tiles_in_cpu_workers are forked. libgomp (the OpenMP runtime of the
+    linux torch builds) deadlocks in a forked child once the parent has run a parallel region, so this must be called
+    before the first forward pass of the process when num_cpu_workers > 1. It limits the parent to one intra-op thread
+    (torch then never enters OpenMP) and keeps the previous number of threads to split among the workers
+    """
+    global _cpu_worker_total_threads
+    if _cpu_worker_total_threads is None:
+        _cpu_worker_total_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+
+
+def _predict_tiles_cpu_worker(net, data, tiles, region, accumulator, weights, num_repeats, mirror_axes,
+                              do_mirroring, add, add_torch, tile_batch_size, mirror_in_batch, num_threads, tta_stats):
+    """
+    worker of DetectionNet._accumulate_tiles_in_cpu_workers. Predicts tiles and aggregates them into accumulator and
+    weights, which only cover region of data. The adaptive test time augmentation counts of its tiles are written into
+    the shared array tta_stats (num_tiles, num_escalated)
+    """
+    torch.set_num_threads(num_threads)
+    net.inference_tta_stats = {'num_tiles': 0, 'num_escalated': 0}
+    for b in range(0, len(tiles), tile_batch_size):
+        batch_tiles = tiles[b:b + tile_batch_size]
+        batch = np.stack([data[(slice(None),) + t] for t in batch_tiles])
+        pred = net.run_tile_batch(batch, num_repeats, mirror_axes, do_mirroring, add_torch, mirror_in_batch)
+        for i, t in enumerate(batch_tiles):
+            t = tuple([slice(s.start - r.start, s.stop - r.start) for s, r in zip(t, region)])
+            accumulator[(slice(None),) + t] += pred[i]
+            weights[t] += add
+    tta_stats[:] = [net.inference_tta_stats['num_tiles'], net.inference_tta_stats['num_escalated']]
+
 
 class BaseNet(nn.Module):
     def __init__(self):
@@ -34,10 +76,33 @@ class DetectionNet(BaseNet):
         self.num_classes = None
         super(BaseNet, self).__init__()
         self.inference_apply_nonlin = lambda x:x
+        # rough number of float32 feature maps held per voxel during a forward pass. Only used to derive the number
+        # of tiles per forward pass from a memory budget
+        self.inference_feature_maps_per_voxel = 64
+        self._importance_map_cache = {}
+        # number of tiles of the last tiled prediction and how many of them were skipped because they did not
+        # contain any voxel of the roi mask
+        self.inference_tile_stats = None
+        # networks (usually the other folds of a cross-validation) whose predictions are averaged with the ones of
+        # this network during inference, see set_inference_ensemble
+        self.inference_ensemble = []
+        # if set, sliding window tile batches are not run directly but handed to this scheduler (see
+        # inference.server.TileBatchScheduler), which may merge them with the tiles of other predictions
+        self.inference_tile_scheduler = None
+        # adaptive test time augmentation: if set, sliding window tiles (and the slices of 2D prediction) are first
+        # predicted without mirroring and only those whose uncertainty (see _get_tile_uncertainty) exceeds this value
+        # are also predicted mirrored. The number of tiles and of escalated tiles is counted in inference_tta_stats,
+        # including the ones of the cpu workers
+        self.inference_tta_uncertainty_threshold = None
+        self.inference_tta_stats = {'num_tiles': 0, 'num_escalated': 0}
+        # int8 version of the forward pass (see models.quantization) that replaces self(x) during inference
+        self.inference_quantized_module = None
 
     def predict_3D(self, x, do_mirroring, num_repeats=1, use_train_mode=False, batch_size=1, mirror_axes=(0, 1, 2),
                    tiled=False, tile_in_z=True, step=2, patch_size=None, regions_class_order=None, use_gaussian=False,
-                   pad_border_mode="edge", pad_kwargs=None):
+                   pad_border_mode="edge", pad_kwargs=None, tile_batch_size=1, tile_memory_budget=None,
+                   mirror_in_batch=False, max_in_memory_bytes=None, memmap_folder=None,
+                   accumulation_dtype="float32", roi_mask=None, num_cpu_workers=1, gaussian_sigma_scale=1. / 8):
         """
         :param x: (c, x, y , z)
         :param do_mirroring:
@@ -51,6 +116,28 @@ class DetectionNet(BaseNet):
         :param patch_size:
         :param regions_class_order:
         :param use_gaussian:
+        :param tile_batch_size: number of tiles that are run through the network in one forward pass. If None it is
+        derived from tile_memory_budget. For a 2D network without tiling: number of slices per forward pass
+        :param tile_memory_budget: memory (in bytes) one forward pass may use, only used if tile_batch_size is None
+        :param mirror_in_batch: run all mirrored versions of a tile in the same forward pass instead of one forward
+        pass per mirroring
+        :param max_in_memory_bytes: if the aggregation buffers of a tiled 3D prediction would need more than this, they
+        are kept in memory-mapped files in memmap_folder (default: system temp folder) instead. Their pages are dropped
+        after every slab of tiles, and normalization and argmax run in slabs of about this size, so the resident part
+        of the buffers does not grow with the volume. The input volume (and its padded copy) and the returned
+        segmentation are still held in memory and are not covered by this bound. The softmax is then returned as
+        np.memmap backed by an .npy file that the caller owns
+        :param memmap_folder:
+        :param accumulation_dtype: dtype of the buffer the tiles are aggregated in (float32, float16 or bfloat16).
+        Reduced precision halves the size of the buffer, the final normalization is done in float32 and the softmax
+        is returned as float16
+        :param roi_mask: boolean (x, y, z) mask, only used for tiled prediction. Tiles without any roi voxel are not
+        run through the network, their output is background. The number of skipped tiles is stored in
+        self.inference_tile_stats
+        :param num_cpu_workers: only used for tiled prediction on the cpu. The tiles are split among this many worker
+        processes that share the network weights and the input
+        :param gaussian_sigma_scale: sigma of the gaussian importance map relative to patch_size. Scalar or one value
+        per axis, see plan_inference_tiles
         :return:
         """
         print("debug: mirroring", do_mirroring, "mirror_axes", mirror_axes)
@@ -68,18 +155,38 @@ class DetectionNet(BaseNet):
             if tiled:
                 res = self._inner_predict_3D_3Dconv_tiled(x, num_repeats, batch_size, tile_in_z, step, do_mirroring,
                                                              mirror_axes, patch_size, regions_class_order, use_gaussian,
-                                                             pad_border_mode, pad_kwargs=pad_kwargs)
+                                                             pad_border_mode, pad_kwargs=pad_kwargs,
+                                                             tile_batch_size=tile_batch_size,
+                                                             tile_memory_budget=tile_memory_budget,
+                                                             mirror_in_batch=mirror_in_batch,
+                                                             max_in_memory_bytes=max_in_memory_bytes,
+                                                             memmap_folder=memmap_folder,
+                                                             accumulation_dtype=accumulation_dtype,
+                                                             roi_mask=roi_mask,
+                                                             num_cpu_workers=num_cpu_workers,
+                                                             gaussian_sigma_scale=gaussian_sigma_scale)
             else:
                 res = self._inner_predict_3D_3Dconv(x, do_mirroring, num_repeats, patch_size, batch_size,
-                                                       mirror_axes, regions_class_order, pad_border_mode, pad_kwargs=pad_kwargs)
+                                                       mirror_axes, regions_class_order, pad_border_mode, pad_kwargs=pad_kwargs,
+                                                       mirror_in_batch=mirror_in_batch)
         elif self.conv_op == nn.Conv2d:
             if tiled:
                 res = self._inner_predict_3D_2Dconv_tiled(x, do_mirroring, num_repeats, batch_size, mirror_axes,
                                                              step, patch_size, regions_class_order, use_gaussian,
-                                                             pad_border_mode, pad_kwargs=pad_kwargs)
+                                                             pad_border_mode, pad_kwargs=pad_kwargs,
+                                                             tile_batch_size=tile_batch_size,
+                                                             tile_memory_budget=tile_memory_budget,
+                                                             mirror_in_batch=mirror_in_batch,
+                                                             accumulation_dtype=accumulation_dtype,
+                                                             roi_mask=roi_mask,
+                                                             num_cpu_workers=num_cpu_workers,
+                                                             gaussian_sigma_scale=gaussian_sigma_scale)
             else:
                 res = self._inner_predict_3D_2Dconv(x, do_mirroring, num_repeats, patch_size, batch_size,
-                                                       mirror_axes, regions_class_order, pad_border_mode, pad_kwargs=pad_kwargs)
+                                                       mirror_axes, regions_class_order, pad_border_mode, pad_kwargs=pad_kwargs,
+                                                       mirror_in_batch=mirror_in_batch,
+                                                       slice_batch_size=tile_batch_size,
+                                                       slice_memory_budget=tile_memory_budget)
         else:
             raise RuntimeError("Invalid conv op, cannot determine what dimensionality (2d/3d) the net is")
         if use_train_mode is not None:
@@ -88,7 +195,9 @@ class DetectionNet(BaseNet):
 
     def predict_2D(self, x, do_mirroring, num_repeats=1, use_train_mode=False, batch_size=1, mirror_axes=(0, 1),
                    tiled=False, step=2, patch_size=None, regions_class_order=None, use_gaussian=False,
-                   pad_border_mode="edge", pad_kwargs=None):
+                   pad_border_mode="edge", pad_kwargs=None, tile_batch_size=1, tile_memory_budget=None,
+                   mirror_in_batch=False, accumulation_dtype="float32", roi_mask=None, num_cpu_workers=1,
+                   gaussian_sigma_scale=1. / 8):
         if len(mirror_axes) > 0 and max(mirror_axes) > 1:
             raise ValueError("mirror axes. duh")
         assert len(x.shape) == 3, "data must have shape (c,x,y)"
@@ -105,17 +214,214 @@ class DetectionNet(BaseNet):
             if tiled:
                 res = self._inner_pred_2D_2Dconv_tiled(x, num_repeats, batch_size, step, do_mirroring,
                                                              mirror_axes, patch_size, regions_class_order,
-                                                             use_gaussian, pad_border_mode, pad_kwargs=pad_kwargs)
+                                                             use_gaussian, pad_border_mode, pad_kwargs=pad_kwargs,
+                                                             tile_batch_size=tile_batch_size,
+                                                             tile_memory_budget=tile_memory_budget,
+                                                             mirror_in_batch=mirror_in_batch,
+                                                             accumulation_dtype=accumulation_dtype,
+                                                             roi_mask=roi_mask,
+                                                             num_cpu_workers=num_cpu_workers,
+                                                             gaussian_sigma_scale=gaussian_sigma_scale)
             else:
                 res = self._inner_predict_2D_2Dconv(x, do_mirroring, num_repeats, None, batch_size, mirror_axes,
-                                                       regions_class_order, pad_border_mode, pad_kwargs=pad_kwargs)
+                                                       regions_class_order, pad_border_mode, pad_kwargs=pad_kwargs,
+                                                       mirror_in_batch=mirror_in_batch)
         else:
             raise RuntimeError("Invalid conv op, cannot determine what dimensionality (2d/3d) the net is")
         if use_train_mode is not None:
             self.train(current_mode)
         return res
 
-    def _inner_mirror_and_pred_3D(self, x, num_repeats, mirror_axes, do_mirroring=True, mult=None):
+    def predict_packed(self, xs, do_mirroring, num_repeats=1, use_train_mode=False, mirror_axes=(0, 1, 2),
+                       patch_size=None, pad_border_mode="edge", pad_kwargs=None, mirror_in_batch=False):
+        """
+        prediction of several small images in a single batch. Every image is padded to patch_size, the padded images
+        are run through the network (including mirroring) together and the predictions are cropped back. For images
+        that are not larger than patch_size this gives the same result as tiled prediction, which would use a
+        single tile per image
+        :param xs: list of (c, x, y(, z)) arrays, none of them larger than patch_size
+        :param do_mirroring:
+        :param num_repeats:
+        :param use_train_mode:
+        :param mirror_axes:
+        :param patch_size:
+        :param pad_border_mode:
+        :param pad_kwargs:
+        :param mirror_in_batch:
+        :return: list of softmax predictions (num_classes, x, y(, z)), one per image
+        """
+        assert patch_size is not None, "patch_size cannot be None for packed prediction"
+        assert all([len(x.shape) == len(patch_size) + 1 for x in xs]), "images must have shape (c, x, y(, z))"
+        assert all([all([i <= j for i, j in zip(x.shape[1:], patch_size)]) for x in xs]), \
+            "all images must fit into patch_size"
+        current_mode = self.training
+        if use_train_mode is not None and use_train_mode:
+            self.train()
+        elif use_train_mode is not None and not use_train_mode:
+            self.eval()
+        with torch.no_grad():
+            padded = [pad_nd_img(x, patch_size, pad_border_mode, pad_kwargs, True, None) for x in xs]
+            batch = np.stack([x for x, _ in padded]).astype(np.float32)
+            pred = self._predict_tile_batch(batch, num_repeats, mirror_axes, do_mirroring, None, mirror_in_batch)
+        if use_train_mode is not None:
+            self.train(current_mode)
+        return [pred[i][(slice(None),) + tuple(slicer[1:])] for i, (_, slicer) in enumerate(padded)]
+
+    def set_inference_ensemble(self, nets):
+        """
+        every forward pass during inference is also run through nets and the softmax outputs are averaged. This keeps
+        all folds of a cross-validation resident on the device and ensembles them tile by tile. The nets are always
+        run in eval mode
+        :param nets: list of networks with the same output as this one. Empty list to disable
+        """
+        for net in nets:
+            net.eval()
+        self.inference_ensemble = list(nets)
+
+    def set_quantized_module(self, module):
+        """
+        runs all inference forward passes through module (e.g. from models.quantization.quantize_unet) instead of the
+        float network. Quantized modules run on the cpu only, so the network is moved there
+        :param module: None to go back to the float network
+        """
+        if module is not None:
+            self.cpu()
+        # not registered as a submodule, so it stays out of state_dict() and is not moved by .cuda()/.to()
+        object.__setattr__(self, 'inference_quantized_module', module)
+
+    def _inference_forward(self, x):
+        if self.inference_quantized_module is not None:
+            return self.inference_quantized_module(x)
+        return self(x)
+
+    def _predict_nonlin(self, x):
+        """
+        softmax prediction of x, averaged over this network and self.inference_ensemble
+        """
+        pred = self.inference_apply_nonlin(self._inference_forward(x))
+        for net in self.inference_ensemble:
+            pred += net.inference_apply_nonlin(net._inference_forward(x))
+        if len(self.inference_ensemble) > 0:
+            pred /= len(self.inference_ensemble) + 1
+        return pred
+
+    def _predict_tile_batch(self, batch, num_repeats, mirror_axes, do_mirroring=True, mult=None,
+                            mirror_in_batch=False):
+        """
+        runs a (b, c, x, y(, z)) batch of sliding window tiles through _inner_mirror_and_pred_3D/_2D, or hands it to
+        self.inference_tile_scheduler
+        """
+        if self.inference_tile_scheduler is not None:
+            return self.inference_tile_scheduler.predict(self, batch, num_repeats, mirror_axes, do_mirroring, mult,
+                                                         mirror_in_batch)
+        return self.run_tile_batch(batch, num_repeats, mirror_axes, do_mirroring, mult, mirror_in_batch)
+
+    def run_tile_batch(self, batch, num_repeats, mirror_axes, do_mirroring=True, mult=None, mirror_in_batch=False):
+        if do_mirroring and self.inference_tta_uncertainty_threshold is not None:
+            return self._inner_adaptive_mirror_and_pred(batch, num_repeats, mirror_axes, mult, mirror_in_batch)
+        if len(batch.shape) == 5:
+            return self._inner_mirror_and_pred_3D(batch, num_repeats, mirror_axes, do_mirroring, mult,
+                                                  mirror_in_batch)
+        return self._inner_mirror_and_pred_2D(batch, num_repeats, mirror_axes, do_mirroring, mult, mirror_in_batch)
+
+    @staticmethod
+    def _get_mirror_dims(mirror_axes, do_mirroring=True):
+        """
+        all combinations of the axes in mirror_axes, translated to the dims of a (b, c, x, y(, z)) tensor. The first
+        entry is always the unmirrored input
+        :param mirror_axes:
+        :param do_mirroring:
+        :return: list of tuples of dims that need to be flipped
+        """
+        if not do_mirroring:
+            return [()]
+        dims = [a + 2 for a in sorted(mirror_axes)]
+        return [tuple([d for j, d in enumerate(dims) if (m >> j) & 1]) for m in range(2 ** len(dims))]
+
+    @staticmethod
+    def _flip_dims(x, dims):
+        for d in dims:
+            x = flip(x, d)
+        return x
+
+    def _inner_mirror_in_batch_and_pred(self, x_torch, num_repeats, mirror_axes, do_mirroring=True):
+        """
+        stacks all mirrored versions of x_torch along the batch dimension so that every repeat needs only one forward
+        pass, then mirrors the predictions back and averages them
+        :param x_torch: (b, c, x, y(, z)) tensor, already on the device of the network
+        :return: (b, num_classes, x, y(, z)) tensor
+        """
+        mirror_dims = self._get_mirror_dims(mirror_axes, do_mirroring)
+        num_results = num_repeats * len(mirror_dims)
+        x_mirrored = torch.cat([self._flip_dims(x_torch, dims) for dims in mirror_dims], 0)
+
+        result_torch = None
+        for i in range(num_repeats):
+            pred = self._predict_nonlin(x_mirrored)
+            pred = torch.stack([self._flip_dims(p, dims) for p, dims in
+                                zip(torch.chunk(pred, len(mirror_dims), 0), mirror_dims)]).sum(0)
+            result_torch = pred if result_torch is None else result_torch + pred
+        return result_torch / num_results
+
+    @staticmethod
+    def _get_tile_uncertainty(pred):
+        """
+        fraction of ambiguous voxels (margin between the two largest softmax values below 0.5) among the voxels that
+        are either ambiguous or predicted as foreground. Tiles of confident background are 0
+        :param pred: (b, num_classes, x, y(, z)) softmax tensor
+        :return: (b,) tensor
+        """
+        top2 = torch.topk(pred, 2, dim=1)[0]
+        ambiguous = (top2[:, 0] - top2[:, 1]) < 0.5
+        foreground = pred.argmax(1) > 0
+        num_voxels = (ambiguous | foreground).view(pred.shape[0], -1).sum(1).float()
+        return ambiguous.view(pred.shape[0], -1).sum(1).float() / num_voxels.clamp(min=1)
+
+    def _inner_adaptive_mirror_and_pred(self, x, num_repeats, mirror_axes, mult=None, mirror_in_batch=False):
+        """
+        predicts the (b, c, x, y(, z)) batch x without mirroring and adds the mirrored predictions only for the tiles
+        whose uncertainty exceeds self.inference_tta_uncertainty_threshold. Escalated tiles end up with the same
+        result as full mirroring
+        """
+        with torch.no_grad():
+            x_torch = torch.from_numpy(x).float()
+            if self.get_device() == "cpu":
+                x_torch = x_torch.cpu()
+            else:
+                x_torch = x_torch.cuda(self.get_device())
+
+            result_torch = self._predict_nonlin(x_torch)
+            for i in range(1, num_repeats):
+                result_torch += self._predict_nonlin(x_torch)
+            result_torch /= num_repeats
+
+            mirror_dims = self._get_mirror_dims(mirror_axes)[1:]
+            escalate = torch.nonzero(self._get_tile_uncertainty(result_torch) >
+                                     self.inference_tta_uncertainty_threshold).view(-1)
+            if len(escalate) > 0 and len(mirror_dims) > 0:
+                x_escalate = x_torch[escalate]
+                mirrored = torch.zeros_like(result_torch[escalate])
+                for i in range(num_repeats):
+                    if mirror_in_batch:
+                        pred = self._predict_nonlin(torch.cat([self._flip_dims(x_escalate, dims)
+                                                               for dims in mirror_dims], 0))
+                        mirrored += torch.stack([self._flip_dims(p, dims) for p, dims in
+                                                 zip(torch.chunk(pred, len(mirror_dims), 0), mirror_dims)]).sum(0)
+                    else:
+                        for dims in mirror_dims:
+                            mirrored += self._flip_dims(self._predict_nonlin(self._flip_dims(x_escalate, dims)), dims)
+                result_torch[escalate] = (result_torch[escalate] + mirrored / num_repeats) / (len(mirror_dims) + 1)
+
+            self.inference_tta_stats['num_tiles'] += x.shape[0]
+            self.inference_tta_stats['num_escalated'] += len(escalate)
+
+        if mult is not None:
+            result_torch[:, :] *= mult
+
+        return result_torch.detach().cpu().numpy()
+
+    def _inner_mirror_and_pred_3D(self, x, num_repeats, mirror_axes, do_mirroring=True, mult=None,
+                                  mirror_in_batch=False):
         with torch.no_grad():
             x_torch = torch.from_numpy(x).float()
             if self.get_device() == "cpu":
@@ -123,7 +429,7 @@ class DetectionNet(BaseNet):
             else:
                 x_torch = x_torch.cuda(self.get_device())
 
-            result_torch = torch.zeros([1, self.num_classes] + list(x.shape[2:])).float()
+            result_torch = torch.zeros([x.shape[0], self.num_classes] + list(x.shape[2:])).float()
             if self.get_device() == "cpu":
                 result_torch = result_torch.cpu()
             else:
@@ -136,125 +442,439 @@ class DetectionNet(BaseNet):
             else:
                 mirror_idx = 1
 
-            for i in range(num_repeats):
-                for m in range(mirror_idx):
-                    if m == 0:
-                        pred = self.inference_apply_nonlin(self(x_torch))
-                        result_torch += 1/num_results * pred
+            if mirror_in_batch:
+                result_torch += self._inner_mirror_in_batch_and_pred(x_torch, num_repeats, mirror_axes,
+                                                                     do_mirroring)
+            else:
+                for i in range(num_repeats):
+                    for m in range(mirror_idx):
+                        if m == 0:
+                            pred = self._predict_nonlin(x_torch)
+                            result_torch += 1/num_results * pred
 
-                    if m == 1 and (2 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(x_torch, 4)))
-                        result_torch += 1/num_results * flip(pred, 4)
+                        if m == 1 and (2 in mirror_axes):
+                            pred = self._predict_nonlin(flip(x_torch, 4))
+                            result_torch += 1/num_results * flip(pred, 4)
 
-                    if m == 2 and (1 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(x_torch, 3)))
-                        result_torch += 1/num_results * flip(pred, 3)
+                        if m == 2 and (1 in mirror_axes):
+                            pred = self._predict_nonlin(flip(x_torch, 3))
+                            result_torch += 1/num_results * flip(pred, 3)
 
-                    if m == 3 and (2 in mirror_axes) and (1 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(flip(x_torch, 4), 3)))
-                        result_torch += 1/num_results * flip(flip(pred, 4), 3)
+                        if m == 3 and (2 in mirror_axes) and (1 in mirror_axes):
+                            pred = self._predict_nonlin(flip(flip(x_torch, 4), 3))
+                            result_torch += 1/num_results * flip(flip(pred, 4), 3)
 
-                    if m == 4 and (1 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(x_torch, 2)))
-                        result_torch += 1/num_results * flip(pred, 2)
+                        if m == 4 and (0 in mirror_axes):
+                            pred = self._predict_nonlin(flip(x_torch, 2))
+                            result_torch += 1/num_results * flip(pred, 2)
 
-                    if m == 5 and (0 in mirror_axes) and (2 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(flip(x_torch, 4), 2)))
-                        result_torch += 1/num_results * flip(flip(pred, 4), 2)
+                        if m == 5 and (0 in mirror_axes) and (2 in mirror_axes):
+                            pred = self._predict_nonlin(flip(flip(x_torch, 4), 2))
+                            result_torch += 1/num_results * flip(flip(pred, 4), 2)
 
-                    if m == 6 and (0 in mirror_axes) and (1 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(flip(x_torch, 3), 2)))
-                        result_torch += 1/num_results * flip(flip(pred, 3), 2)
+                        if m == 6 and (0 in mirror_axes) and (1 in mirror_axes):
+                            pred = self._predict_nonlin(flip(flip(x_torch, 3), 2))
+                            result_torch += 1/num_results * flip(flip(pred, 3), 2)
 
-                    if m == 7 and (0 in mirror_axes) and (1 in mirror_axes) and (2 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(flip(flip(x_torch, 3), 2), 4)))
-                        result_torch += 1/num_results * flip(flip(flip(pred, 3), 2), 4)
+                        if m == 7 and (0 in mirror_axes) and (1 in mirror_axes) and (2 in mirror_axes):
+                            pred = self._predict_nonlin(flip(flip(flip(x_torch, 3), 2), 4))
+                            result_torch += 1/num_results * flip(flip(flip(pred, 3), 2), 4)
 
         if mult is not None:
             result_torch[:, :] *= mult
 
         return result_torch.detach().cpu().numpy()
 
-    def _inner_predict_3D_3Dconv_tiled(self, x, num_repeats, BATCH_SIZE=None, tile_in_z=True, step=2,
-                                          do_mirroring=True, mirror_axes=(0, 1, 2), patch_size=None,
-                                          regions_class_order=None, use_gaussian=False, pad_border_mode="edge", pad_kwargs=None):
-        "x must be (c, x, y, z)"
-        assert len(x.shape) == 4, "x must be (c, x, y, z)"
-        with torch.no_grad():
-            assert patch_size is not None, "patch_size cannot be None for tiled prediction"
-
-            data, slicer = pad_nd_img(x, patch_size, pad_border_mode, pad_kwargs, True, None)
-
-            data = data[None]
-
-            if BATCH_SIZE is not None:
-                data = np.vstack([data] * BATCH_SIZE)
-
-            input_size = [1, x.shape[0]] + list(patch_size)
-            if not tile_in_z:
-                input_size[2] = data.shape[2]
-                patch_size[0] = data.shape[2]
-            input_size = [int(i) for i in input_size]
-
-            a = torch.rand(input_size).float()
-            if self.get_device() == "cpu":
-                a = a.cpu()
-            else:
-                a = a.cuda(self.get_device())
-
-            # dummy run to see number of classes
-            nb_of_classes = self(a).size()[1]
-
-            result = np.zeros([nb_of_classes] + list(data.shape[2:]), dtype=np.float32)
-            result_numsamples = np.zeros([nb_of_classes] + list(data.shape[2:]), dtype=np.float32)
+    def _get_importance_map(self, patch_size, use_gaussian, sigma_scale=1. / 8, dtype=np.float32):
+        """
+        weight map for aggregating the tiles of a sliding window prediction. Gaussian maps are expensive to compute,
+        so they are memoized per (patch_size, sigma_scale, dtype, device). Do not modify the returned arrays in place
+        :param patch_size:
+        :param use_gaussian: if False a map of ones is returned
+        :param sigma_scale: sigma of the gaussian relative to patch_size, scalar or one value per axis
+        :param dtype:
+        :return: weight map as numpy array and as float tensor on the device of the network
+        """
+        device = self.get_device()
+        sigma_scale = tuple(np.ones(len(patch_size)) * sigma_scale)
+        key = (tuple([int(i) for i in patch_size]), sigma_scale if use_gaussian else None, np.dtype(dtype).str, device)
+        if key not in self._importance_map_cache:
             if use_gaussian:
-                tmp = np.zeros(patch_size)
+                tmp = np.zeros(patch_size, dtype=dtype)
                 center_coords = [i//2 for i in patch_size]
-                sigmas = [i//8 for i in patch_size]
+                sigmas = [int(i * s) for i, s in zip(patch_size, sigma_scale)]
                 tmp[tuple(center_coords)] = 1
                 tmp_smooth = gaussian_filter(tmp, sigmas, 0, mode='constant', cval=0)
                 tmp_smooth = tmp_smooth / tmp_smooth.max() * 1
                 add = tmp_smooth + 1e-8
             else:
-                add = np.ones(patch_size)
+                add = np.ones(patch_size, dtype=dtype)
 
-            if self.get_device() == "cpu":
+            if device == "cpu":
                 add_torch = torch.from_numpy(add).cpu().float()
             else:
-                add_torch = torch.from_numpy(add).cuda(self.get_device()).float()
-
-            data_shape = data.shape
-            center_coord_start = np.array([i//2 for i in patch_size]).astype(int)
-            center_coord_end = np.array([data_shape[i + 2] - patch_size[i] // 2 for i in range(len(patch_size))]).astype(int)
-            num_steps = np.ceil([(center_coord_end[i] - center_coord_start[i]) / (patch_size[i] / step) for i in range(3)])
-            step_size = np.array([(center_coord_end[i] - center_coord_start[i]) / (num_steps[i] + 1e-8) for i in range(3)])
-            step_size[step_size == 0] = 9999999
-            xsteps = np.round(np.arange(center_coord_start[0], center_coord_end[0]+1e-8, step_size[0])).astype(int)
-            ysteps = np.round(np.arange(center_coord_start[1], center_coord_end[1]+1e-8, step_size[1])).astype(int)
-            zsteps = np.round(np.arange(center_coord_start[2], center_coord_end[2]+1e-8, step_size[2])).astype(int)
-
-            for x in xsteps:
-                lb_x = x - patch_size[0] // 2
-                ub_x = x + patch_size[0] // 2
-                for y in ysteps:
-                    lb_y = y - patch_size[1] // 2
-                    ub_y = y + patch_size[1] // 2
-                    for z in zsteps:
-                        lb_z = z - patch_size[2] // 2
-                        ub_z = z + patch_size[2] // 2
-                        result[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += \
-                            self._inner_mirror_and_pred_3D(data[:, :, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z],
-                                                                          num_repeats, mirror_axes, do_mirroring, add_torch)[0]
-                        result_numsamples[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += add
+                add_torch = torch.from_numpy(add).cuda(device).float()
+            self._importance_map_cache[key] = (add, add_torch)
+        return self._importance_map_cache[key]
 
-            slicer = tuple([slice(0, result.shape[i]) for i in range(len(result.shape) - (len(slicer) - 1))] + slicer[1:])
-            result = result[slicer]
-            result_numsamples = result_numsamples[slicer]
+    @staticmethod
+    def _get_tile_slicers(image_size, patch_size, step):
+        """
+        computes the tiles of the sliding window. Tiles are returned in the order in which they would be visited by
+        nested loops over the axes (x outermost)
+        :param image_size: spatial shape of the (padded) image
+        :param patch_size:
+        :param step: patch_size / step is the (approximate) distance between neighbouring tiles. Scalar or one value
+        per axis
+        :return: list of tuples of slices, one slice per spatial axis
+        """
+        dim = len(patch_size)
+        step = np.ones(dim) * step
+        center_coord_start = np.array([i//2 for i in patch_size]).astype(int)
+        center_coord_end = np.array([image_size[i] - patch_size[i] // 2 for i in range(dim)]).astype(int)
+        num_steps = np.ceil([(center_coord_end[i] - center_coord_start[i]) / (patch_size[i] / step[i])
+                             for i in range(dim)])
+        step_size = np.array([(center_coord_end[i] - center_coord_start[i]) / (num_steps[i] + 1e-8) for i in range(dim)])
+        step_size[step_size == 0] = 9999999
+        steps = [np.round(np.arange(center_coord_start[i], center_coord_end[i]+1e-8, step_size[i])).astype(int)
+                 for i in range(dim)]
+
+        tiles = []
+        for centers in product(*steps):
+            tiles.append(tuple([slice(c - patch_size[i] // 2, c + patch_size[i] // 2) for i, c in enumerate(centers)]))
+        return tiles
+
+    def _accumulate_tiles_in_cpu_workers(self, data, tiles, accumulator, result_numsamples, num_workers, num_repeats,
+                                         mirror_axes, do_mirroring, add, add_torch, tile_batch_size,
+                                         mirror_in_batch):
+        """
+        predicts the tiles in num_workers forked processes that share the network weights and the input. Every worker
+        gets a contiguous chunk of the tile grid and aggregates it into its own shared accumulator, which only covers
+        the bounding box of its tiles. The accumulators are added to accumulator / result_numsamples at the end.
+        Requires prepare_cpu_workers to be called before the first forward pass of the process
+        :param data: padded input (c, x, y(, z))
+        """
+        assert _cpu_worker_total_threads is not None and torch.get_num_threads() == 1, \
+            "call models.base_net.prepare_cpu_workers() before the first forward pass when using cpu workers, " \
+            "forking after OpenMP was used can deadlock"
+        self.share_memory()
+        for net in self.inference_ensemble:
+            net.share_memory()
+        data = torch.from_numpy(np.ascontiguousarray(data)).share_memory_().numpy()
+        num_threads = max(1, _cpu_worker_total_threads // num_workers)
+
+        ctx = torch.multiprocessing.get_context("fork")
+        workers = []
+        for chunk in np.array_split(np.arange(len(tiles)), min(num_workers, len(tiles))):
+            worker_tiles = [tiles[i] for i in chunk]
+            region = tuple([slice(min([t[i].start for t in worker_tiles]), max([t[i].stop for t in worker_tiles]))
+                            for i in range(len(worker_tiles[0]))])
+            region_shape = [r.stop - r.start for r in region]
+            worker_accumulator = torch.zeros([accumulator.shape[0]] + region_shape).share_memory_().numpy()
+            worker_weights = torch.zeros(region_shape).share_memory_().numpy()
+            worker_tta_stats = torch.zeros(2, dtype=torch.int64).share_memory_().numpy()
+            pr = ctx.Process(target=_predict_tiles_cpu_worker,
+                             args=(self, data, worker_tiles, region, worker_accumulator, worker_weights, num_repeats,
+                                   mirror_axes, do_mirroring, add, add_torch, tile_batch_size, mirror_in_batch,
+                                   num_threads, worker_tta_stats))
+            pr.start()
+            workers.append((pr, region, worker_accumulator, worker_weights, worker_tta_stats))
+
+        for pr, region, worker_accumulator, worker_weights, worker_tta_stats in workers:
+            pr.join()
+            if pr.exitcode != 0:
+                raise RuntimeError("cpu inference worker failed with exit code %d" % pr.exitcode)
+            # the counters of the forked workers do not reach this process otherwise
+            self.inference_tta_stats['num_tiles'] += int(worker_tta_stats[0])
+            self.inference_tta_stats['num_escalated'] += int(worker_tta_stats[1])
+            if not isinstance(accumulator, np.ndarray):
+                worker_accumulator = torch.from_numpy(worker_accumulator)
+            accumulator[(slice(None),) + region] += worker_accumulator
+            result_numsamples[region] += worker_weights
+
+    @staticmethod
+    def _split_tiles_by_roi(tiles, roi_mask, padded_shape, slicer):
+        """
+        separates the tiles that contain at least one roi voxel from those that don't
+        :param roi_mask: boolean mask with the spatial shape of the unpadded image. If None, no tile is skipped
+        :param padded_shape: spatial shape of the padded image the tiles refer to
+        :param slicer: slicer returned by pad_nd_img (including the channel axis)
+        :return: tiles to predict, skipped tiles
+        """
+        if roi_mask is None:
+            return tiles, []
+        roi = np.zeros(padded_shape, dtype=bool)
+        roi[tuple(slicer[1:])] = roi_mask
+        keep = [roi[t].any() for t in tiles]
+        return [t for t, k in zip(tiles, keep) if k], [t for t, k in zip(tiles, keep) if not k]
+
+    @staticmethod
+    def _fill_skipped_tiles(accumulator, result_numsamples, skipped_tiles, add, fill_background=True):
+        """
+        aggregates skipped tiles as if the network had predicted background everywhere
+        :param add: importance map
+        :param fill_background: False for region based training, where background means that all channels are 0
+        """
+        background = add if isinstance(accumulator, np.ndarray) else torch.from_numpy(add)
+        for t in skipped_tiles:
+            if fill_background:
+                accumulator[(0,) + t] += background
+            result_numsamples[t] += add
+
+    def get_tile_batch_size(self, patch_size, num_input_channels, memory_budget, forward_passes_per_tile=1):
+        """
+        number of tiles that can be run through the network in one forward pass without exceeding memory_budget.
+        This is a rough estimate based on self.inference_feature_maps_per_voxel, not a measurement
+        :param patch_size:
+        :param num_input_channels:
+        :param memory_budget: in bytes. If None, 1 is returned
+        :param forward_passes_per_tile: how many copies of each tile end up in the same forward pass
+        :return:
+        """
+        if memory_budget is None:
+            return 1
+        maps_per_voxel = num_input_channels + 2 * self.num_classes + self.inference_feature_maps_per_voxel
+        bytes_per_tile = 4 * np.prod(patch_size) * maps_per_voxel * forward_passes_per_tile
+        return max(1, int(memory_budget // bytes_per_tile))
+
+    def plan_inference_tiles(self, image_shape, patch_size, num_input_channels, memory_budget, step=2):
+        """
+        tiles larger than the training patch for fully convolutional networks. Starting from patch_size, the tile is
+        grown in multiples of input_shape_must_be_divisible_by, always along the axis that needs the most tiles, as
+        long as a forward pass of one tile fits into memory_budget (estimated like in get_tile_batch_size) and the
+        tile is not larger than the (padded) image. Tiles keep the overlap in voxels that step gives for patch_size,
+        so larger tiles need fewer tiles. The gaussian is scaled with the distance between tiles, which reproduces
+        the default sigma of 1/8 for patch_size and step 2
+        :param image_shape: spatial shape of the image
+        :param patch_size: training patch size
+        :param num_input_channels:
+        :param memory_budget: in bytes
+        :param step: step that would be used with patch_size
+        :return: dict with patch_size, step and gaussian_sigma_scale (one value per axis each) and num_tiles
+        """
+        dim = len(patch_size)
+        divisor = self.input_shape_must_be_divisible_by if self.input_shape_must_be_divisible_by is not None else 1
+        divisor = (np.ones(dim) * np.array(divisor)).astype(int)
+        patch_size = np.array(patch_size).astype(int)
+        image_shape = np.array(image_shape[-dim:]).astype(int)
+        overlap = patch_size - patch_size / float(step)
+        max_size = np.maximum(patch_size, np.ceil(image_shape / divisor.astype(float)) * divisor).astype(int)
+        bytes_per_voxel = 4 * (num_input_channels + 2 * self.num_classes + self.inference_feature_maps_per_voxel)
+
+        def tiles_per_axis(tile):
+            return [1 if image_shape[i] <= tile[i] else
+                    int(np.ceil((image_shape[i] - tile[i]) / (tile[i] - overlap[i]))) + 1 for i in range(dim)]
+
+        tile = patch_size.copy()
+        while True:
+            candidates = [i for i in range(dim) if tile[i] + divisor[i] <= max_size[i] and
+                          bytes_per_voxel * np.prod(tile) / tile[i] * (tile[i] + divisor[i]) <= memory_budget]
+            if len(candidates) == 0:
+                break
+            num_tiles = tiles_per_axis(tile)
+            axis = max(candidates, key=lambda i: (num_tiles[i], image_shape[i] / float(tile[i])))
+            tile[axis] += divisor[axis]
+
+        distance = tile - overlap
+        return {'patch_size': [int(i) for i in tile],
+                'step': [float(i) for i in tile / distance],
+                'gaussian_sigma_scale': [float(i) for i in distance / (4. * tile)],
+                'num_tiles': int(np.prod(tiles_per_axis(tile)))}
+
+    @staticmethod
+    def _open_temp_memmap(shape, folder=None, dtype=np.float32, unlink=False):
+        """
+        zero initialized, memory-mapped .npy file in folder (default: system temp folder)
+        :param unlink: remove the file right away. The data stays accessible until the array is garbage collected
+        """
+        fd, fname = tempfile.mkstemp(suffix=".npy", dir=folder)
+        os.close(fd)
+        arr = open_memmap(fname, mode='w+', dtype=dtype, shape=tuple([int(i) for i in shape]))
+        if unlink:
+            os.remove(fname)
+        return arr
+
+    @staticmethod
+    def _release_memmap_pages(arr):
+        """
+        writes the dirty pages of a memmap back and drops all of its pages from the memory of the process. flush()
+        alone keeps them resident. Pages that are accessed again are read back (usually from the page cache)
+        """
+        if not isinstance(arr, np.memmap):
+            return
+        arr.flush()
+        base = arr
+        while getattr(base, '_mmap', None) is None and isinstance(base.base, np.ndarray):
+            base = base.base
+        if getattr(base, '_mmap', None) is not None and hasattr(mmap, 'MADV_DONTNEED'):
+            base._mmap.madvise(mmap.MADV_DONTNEED)
+
+    @staticmethod
+    def _argmax_in_slabs(softmax, slab_size):
+        """
+        argmax over the first axis of a (c, x, y, z) array that only reads slab_size planes along x at a time
+        """
+        dtype = np.uint8 if softmax.shape[0] <= 256 else np.int16
+        seg = np.zeros(softmax.shape[1:], dtype=dtype)
+        for s in range(0, softmax.shape[1], slab_size):
+            seg[s:s + slab_size] = np.asarray(softmax[:, s:s + slab_size]).argmax(0)
+            DetectionNet._release_memmap_pages(softmax)
+        return seg
+
+    def _allocate_accumulator(self, shape, accumulation_dtype="float32", out_of_core=False, memmap_folder=None):
+        """
+        zero initialized buffer for aggregating the tile predictions. numpy has no bfloat16, so bfloat16 buffers are
+        stored as int16 and wrapped in a torch tensor that shares their memory
+        :param accumulation_dtype: float32, float16 or bfloat16
+        :return: the numpy buffer and the array predictions are added to (the buffer itself or a torch view of it)
+        """
+        if accumulation_dtype not in ("float32", "float16", "bfloat16"):
+            raise ValueError("accumulation_dtype must be float32, float16 or bfloat16, got %s" % accumulation_dtype)
+        storage_dtype = np.int16 if accumulation_dtype == "bfloat16" else np.dtype(accumulation_dtype)
+        if out_of_core:
+            result = self._open_temp_memmap(shape, memmap_folder, storage_dtype, unlink=True)
+        else:
+            result = np.zeros(shape, dtype=storage_dtype)
+        if accumulation_dtype == "bfloat16":
+            return result, torch.from_numpy(result).view(torch.bfloat16)
+        return result, result
 
-            softmax_pred = result / result_numsamples
+    def _normalize_accumulator(self, result, accumulator, result_numsamples, spatial_slicer, out_of_core=False,
+                               memmap_folder=None, max_in_memory_bytes=None):
+        """
+        divides the aggregated predictions by the aggregated tile weights and crops away the padding. The division is
+        always done in float32. In-memory float32 and float16 buffers are normalized in place, other in-memory buffers
+        one channel at a time into a new array. Out-of-core buffers are normalized in slabs along the first spatial
+        axis (all channels, about max_in_memory_bytes per slab) into a new memmap, the pages of all memmaps are
+        dropped after every slab
+        :param result: numpy buffer returned by _allocate_accumulator
+        :param accumulator: array the predictions were added to
+        :param result_numsamples: aggregated tile weights, one channel only (x, y(, z))
+        :param spatial_slicer: crops the padding
+        :return: (c, x, y(, z)) softmax, float32 for float32 accumulation and float16 otherwise. A memmap the caller
+        owns if out_of_core
+        """
+        channel_slicer = (slice(None),) + tuple(spatial_slicer)
+        if not out_of_core and result.dtype == np.float32:
+            result /= result_numsamples[None]
+            return result[channel_slicer]
+        if not out_of_core and result.dtype == np.float16:
+            for c in range(result.shape[0]):
+                result[c] = result[c] / result_numsamples
+            return result[channel_slicer]
+
+        weights = result_numsamples[tuple(spatial_slicer)]
+        shape = [result.shape[0]] + list(weights.shape)
+        dtype = np.float32 if result.dtype == np.float32 else np.float16
+        if out_of_core:
+            softmax = self._open_temp_memmap(shape, memmap_folder, dtype)
+            # float32 slab of all channels plus its weights
+            bytes_per_plane = 4 * (result.shape[0] + 1) * int(np.prod(shape[2:]))
+            slab_size = shape[1] if max_in_memory_bytes is None else max(1, int(max_in_memory_bytes //
+                                                                                bytes_per_plane))
+            offset = spatial_slicer[0].start
+            for s in range(0, shape[1], slab_size):
+                src = (slice(None), slice(offset + s, offset + min(s + slab_size, shape[1]))) + \
+                      tuple(spatial_slicer[1:])
+                if accumulator is result:
+                    slab = result[src].astype(np.float32)
+                else:
+                    slab = accumulator[src].float().numpy()
+                softmax[:, s:s + slab_size] = slab / weights[None, s:s + slab_size]
+                del slab
+                for arr in (softmax, result, result_numsamples):
+                    self._release_memmap_pages(arr)
+            return softmax
+
+        softmax = np.empty(shape, dtype=dtype)
+        for c in range(result.shape[0]):
+            if accumulator is result:
+                channel = result[c][tuple(spatial_slicer)].astype(np.float32)
+            else:
+                channel = accumulator[c][tuple(spatial_slicer)].float().numpy()
+            softmax[c] = channel / weights
+        return softmax
+
+    def _inner_predict_3D_3Dconv_tiled(self, x, num_repeats, BATCH_SIZE=None, tile_in_z=True, step=2,
+                                          do_mirroring=True, mirror_axes=(0, 1, 2), patch_size=None,
+                                          regions_class_order=None, use_gaussian=False, pad_border_mode="edge",
+                                          pad_kwargs=None, tile_batch_size=1, tile_memory_budget=None,
+                                          mirror_in_batch=False, max_in_memory_bytes=None, memmap_folder=None,
+                                          accumulation_dtype="float32", roi_mask=None, num_cpu_workers=1,
+                                          gaussian_sigma_scale=1. / 8):
+        "x must be (c, x, y, z)"
+        assert len(x.shape) == 4, "x must be (c, x, y, z)"
+        with torch.no_grad():
+            assert patch_size is not None, "patch_size cannot be None for tiled prediction"
+
+            data, slicer = pad_nd_img(x, patch_size, pad_border_mode, pad_kwargs, True, None)
+
+            if not tile_in_z:
+                patch_size[0] = data.shape[1]
+
+            assert self.num_classes is not None, "num_classes of the network must be known for tiled prediction"
+            nb_of_classes = self.num_classes
+
+            # all classes get the same weight, so the weights are aggregated in a single float32 channel
+            bytes_per_value = 4 if accumulation_dtype == "float32" else 2
+            buffer_bytes = (bytes_per_value * nb_of_classes + 4) * np.prod(data.shape[1:])
+            out_of_core = max_in_memory_bytes is not None and buffer_bytes > max_in_memory_bytes
+            # memory-mapped buffers are unlinked right away, their disk space is released once they are garbage
+            # collected
+            result, accumulator = self._allocate_accumulator([nb_of_classes] + list(data.shape[1:]),
+                                                             accumulation_dtype, out_of_core, memmap_folder)
+            if out_of_core:
+                result_numsamples = self._open_temp_memmap(data.shape[1:], memmap_folder, unlink=True)
+            else:
+                result_numsamples = np.zeros(data.shape[1:], dtype=np.float32)
+            add, add_torch = self._get_importance_map(patch_size, use_gaussian, gaussian_sigma_scale)
+
+            if tile_batch_size is None:
+                passes_per_tile = len(self._get_mirror_dims(mirror_axes, do_mirroring)) if mirror_in_batch else 1
+                tile_batch_size = self.get_tile_batch_size(patch_size, x.shape[0], tile_memory_budget, passes_per_tile)
+
+            # tiles come in slabs along the first axis. Once the tiles of a slab are done, all planes in front of the
+            # next slab are final. Dropping the pages of the buffers then keeps only the current slab (plus overlap)
+            # resident
+            tiles = self._get_tile_slicers(data.shape[1:], patch_size, step)
+            tiles, skipped_tiles = self._split_tiles_by_roi(tiles, roi_mask, data.shape[1:], slicer)
+            self.inference_tile_stats = {'num_tiles': len(tiles) + len(skipped_tiles),
+                                         'num_skipped_tiles': len(skipped_tiles)}
+            self._fill_skipped_tiles(accumulator, result_numsamples, skipped_tiles, add, regions_class_order is None)
+            if out_of_core:
+                self._release_memmap_pages(result)
+                self._release_memmap_pages(result_numsamples)
+            if num_cpu_workers > 1 and self.get_device() == "cpu" and len(tiles) > 1:
+                self._accumulate_tiles_in_cpu_workers(data, tiles, accumulator, result_numsamples, num_cpu_workers,
+                                                      num_repeats, mirror_axes, do_mirroring, add, add_torch,
+                                                      tile_batch_size, mirror_in_batch)
+                tiles = []
+            slab_start = tiles[0][0].start if len(tiles) > 0 else None
+            for b in range(0, len(tiles), tile_batch_size):
+                batch_tiles = tiles[b:b + tile_batch_size]
+                batch = np.stack([data[(slice(None),) + t] for t in batch_tiles])
+                pred = self._predict_tile_batch(batch, num_repeats, mirror_axes, do_mirroring, add_torch,
+                                                mirror_in_batch)
+                if accumulator is not result:
+                    pred = torch.from_numpy(pred)
+                for i, t in enumerate(batch_tiles):
+                    accumulator[(slice(None),) + t] += pred[i]
+                    result_numsamples[t] += add
+                if out_of_core and batch_tiles[-1][0].start != slab_start:
+                    slab_start = batch_tiles[-1][0].start
+                    self._release_memmap_pages(result)
+                    self._release_memmap_pages(result_numsamples)
+
+            softmax_pred = self._normalize_accumulator(result, accumulator, result_numsamples, slicer[1:],
+                                                       out_of_core, memmap_folder, max_in_memory_bytes)
+            del result, accumulator, result_numsamples
 
             # patient_data = patient_data[:, :old_shape[0], :old_shape[1], :old_shape[2]]
-            if regions_class_order is None:
+            if regions_class_order is None and out_of_core:
+                bytes_per_plane = softmax_pred.dtype.itemsize * softmax_pred.shape[0] * np.prod(softmax_pred.shape[2:])
+                slab_size = max(1, int(max_in_memory_bytes // bytes_per_plane))
+                predicted_segmentation = self._argmax_in_slabs(softmax_pred, slab_size)
+            elif regions_class_order is None:
                 predicted_segmentation = softmax_pred.argmax(0)
             else:
                 predicted_segmentation_shp = softmax_pred[0].shape
@@ -264,7 +884,8 @@ class DetectionNet(BaseNet):
         return predicted_segmentation, None, softmax_pred, None
 
     def _inner_predict_2D_2Dconv(self, x, do_mirroring, num_repeats, min_size=None, BATCH_SIZE=None,
-                                    mirror_axes=(0, 1), regions_class_order=None, pad_border_mode="edge", pad_kwargs=None):
+                                    mirror_axes=(0, 1), regions_class_order=None, pad_border_mode="edge", pad_kwargs=None,
+                                    mirror_in_batch=False):
         with torch.no_grad():
             _ = None
             #x, old_shape = pad_patient_2D_incl_c(x, self.input_shape_must_be_divisible_by, min_size)
@@ -285,7 +906,8 @@ class DetectionNet(BaseNet):
             if BATCH_SIZE is not None:
                 data = np.vstack([data] * BATCH_SIZE)
 
-            result = self._inner_mirror_and_pred_2D(data, num_repeats, mirror_axes, do_mirroring)[0]
+            result = self._inner_mirror_and_pred_2D(data, num_repeats, mirror_axes, do_mirroring, None,
+                                                    mirror_in_batch)[0]
 
             slicer = tuple([slice(0, result.shape[i]) for i in range(len(result.shape) - (len(slicer) - 1))] + slicer[1:])
             result = result[slicer]
@@ -302,7 +924,7 @@ class DetectionNet(BaseNet):
 
     def _inner_predict_3D_3Dconv(self, x, do_mirroring, num_repeats, min_size=None, BATCH_SIZE=None,
                                     mirror_axes=(0, 1, 2), regions_class_order=None, pad_border_mode="edge",
-                                    pad_kwargs=None):
+                                    pad_kwargs=None, mirror_in_batch=False):
         with torch.no_grad():
             x, slicer = pad_nd_img(x, min_size, pad_border_mode, pad_kwargs, True, self.input_shape_must_be_divisible_by)
             #x, old_shape = pad_patient_3D_incl_c(x, self.input_shape_must_be_divisible_by, min_size)
@@ -316,7 +938,8 @@ class DetectionNet(BaseNet):
             if BATCH_SIZE is not None:
                 data = np.vstack([data] * BATCH_SIZE)
 
-            stacked = self._inner_mirror_and_pred_3D(data, num_repeats, mirror_axes, do_mirroring, None)[0]
+            stacked = self._inner_mirror_and_pred_3D(data, num_repeats, mirror_axes, do_mirroring, None,
+                                                     mirror_in_batch)[0]
 
             slicer = tuple([slice(0, stacked.shape[i]) for i in range(len(stacked.shape) - (len(slicer) - 1))] + slicer[1:])
             stacked = stacked[slicer]
@@ -331,7 +954,8 @@ class DetectionNet(BaseNet):
                     predicted_segmentation[softmax_pred[i] > 0.5] = c
         return predicted_segmentation, None, softmax_pred, None
 
-    def _inner_mirror_and_pred_2D(self, x, num_repeats, mirror_axes, do_mirroring=True, mult=None):
+    def _inner_mirror_and_pred_2D(self, x, num_repeats, mirror_axes, do_mirroring=True, mult=None,
+                                  mirror_in_batch=False):
         with torch.no_grad():
             x_torch = torch.from_numpy(x).float()
             if self.get_device() == "cpu":
@@ -339,7 +963,7 @@ class DetectionNet(BaseNet):
             else:
                 x_torch = x_torch.cuda(self.get_device())
 
-            result_torch = torch.zeros([1, self.num_classes] + list(x.shape[2:])).float()
+            result_torch = torch.zeros([x.shape[0], self.num_classes] + list(x.shape[2:])).float()
             if self.get_device() == "cpu":
                 result_torch = result_torch.cpu()
             else:
@@ -352,23 +976,27 @@ class DetectionNet(BaseNet):
             else:
                 mirror_idx = 1
 
-            for i in range(num_repeats):
-                for m in range(mirror_idx):
-                    if m == 0:
-                        pred = self.inference_apply_nonlin(self(x_torch))
-                        result_torch += 1/num_results * pred
+            if mirror_in_batch:
+                result_torch += self._inner_mirror_in_batch_and_pred(x_torch, num_repeats, mirror_axes,
+                                                                     do_mirroring)
+            else:
+                for i in range(num_repeats):
+                    for m in range(mirror_idx):
+                        if m == 0:
+                            pred = self._predict_nonlin(x_torch)
+                            result_torch += 1/num_results * pred
 
-                    if m == 1 and (1 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(x_torch, 3)))
-                        result_torch += 1/num_results * flip(pred, 3)
+                        if m == 1 and (1 in mirror_axes):
+                            pred = self._predict_nonlin(flip(x_torch, 3))
+                            result_torch += 1/num_results * flip(pred, 3)
 
-                    if m == 2 and (0 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(x_torch, 2)))
-                        result_torch += 1/num_results * flip(pred, 2)
+                        if m == 2 and (0 in mirror_axes):
+                            pred = self._predict_nonlin(flip(x_torch, 2))
+                            result_torch += 1/num_results * flip(pred, 2)
 
-                    if m == 3 and (0 in mirror_axes) and (1 in mirror_axes):
-                        pred = self.inference_apply_nonlin(self(flip(flip(x_torch, 3), 2)))
-                        result_torch += 1/num_results * flip(flip(pred, 3), 2)
+                        if m == 3 and (0 in mirror_axes) and (1 in mirror_axes):
+                            pred = self._predict_nonlin(flip(flip(x_torch, 3), 2))
+                            result_torch += 1/num_results * flip(flip(pred, 3), 2)
 
         if mult is not None:
             result_torch[:, :] *= mult
@@ -377,71 +1005,96 @@ class DetectionNet(BaseNet):
 
     def _inner_pred_2D_2Dconv_tiled(self, patient_data, num_repeats, BATCH_SIZE=None, step=2,
                                      do_mirroring=True, mirror_axes=(0, 1), patch_size=None, regions_class_order=None,
-                                          use_gaussian=False, pad_border_mode="edge", pad_kwargs=None):
+                                          use_gaussian=False, pad_border_mode="edge", pad_kwargs=None,
+                                          tile_batch_size=1, tile_memory_budget=None, mirror_in_batch=False,
+                                          accumulation_dtype="float32", roi_mask=None, num_cpu_workers=1,
+                                          gaussian_sigma_scale=1. / 8):
         with torch.no_grad():
             tile_size = patch_size
             assert tile_size is not None, "patch_size cannot be None for tiled prediction"
             # pad images so that their size is a multiple of tile_size
             data, slicer = pad_nd_img(patient_data, tile_size, pad_border_mode, pad_kwargs, True)
 
-            data = data[None]
-
-            if BATCH_SIZE is not None:
-                data = np.vstack([data] * BATCH_SIZE)
-
-            input_size = [1, patient_data.shape[0]] + list(tile_size)
-            input_size = [int(i) for i in input_size]
-            a = torch.rand(input_size).float()
-            if self.get_device() == "cpu":
-                a = a.cpu()
-            else:
-                a = a.cuda(self.get_device())
-
-            # dummy run to see number of classes
-            nb_of_classes = self(a).size()[1]
+            assert self.num_classes is not None, "num_classes of the network must be known for tiled prediction"
+            nb_of_classes = self.num_classes
+
+            result, accumulator = self._allocate_accumulator([nb_of_classes] + list(data.shape[1:]), accumulation_dtype)
+            result_numsamples = np.zeros(data.shape[1:], dtype=np.float32)
+            add, add_torch = self._get_importance_map(tile_size, use_gaussian, gaussian_sigma_scale)
+
+            if tile_batch_size is None:
+                passes_per_tile = len(self._get_mirror_dims(mirror_axes, do_mirroring)) if mirror_in_batch else 1
+                tile_batch_size = self.get_tile_batch_size(patch_size, patient_data.shape[0], tile_memory_budget,
+                                                           passes_per_tile)
+
+            tiles = self._get_tile_slicers(data.shape[1:], patch_size, step)
+            tiles, skipped_tiles = self._split_tiles_by_roi(tiles, roi_mask, data.shape[1:], slicer)
+            self.inference_tile_stats = {'num_tiles': len(tiles) + len(skipped_tiles),
+                                         'num_skipped_tiles': len(skipped_tiles)}
+            self._fill_skipped_tiles(accumulator, result_numsamples, skipped_tiles, add, regions_class_order is None)
+            if num_cpu_workers > 1 and self.get_device() == "cpu" and len(tiles) > 1:
+                self._accumulate_tiles_in_cpu_workers(data, tiles, accumulator, result_numsamples, num_cpu_workers,
+                                                      num_repeats, mirror_axes, do_mirroring, add, add_torch,
+                                                      tile_batch_size, mirror_in_batch)
+                tiles = []
+            for b in range(0, len(tiles), tile_batch_size):
+                batch_tiles = tiles[b:b + tile_batch_size]
+                batch = np.stack([data[(slice(None),) + t] for t in batch_tiles])
+                pred = self._predict_tile_batch(batch, num_repeats, mirror_axes, do_mirroring, add_torch,
+                                                mirror_in_batch)
+                if accumulator is not result:
+                    pred = torch.from_numpy(pred)
+                for i, t in enumerate(batch_tiles):
+                    accumulator[(slice(None),) + t] += pred[i]
+                    result_numsamples[t] += add
+
+            softmax_pred = self._normalize_accumulator(result, accumulator, result_numsamples, slicer[1:])
+            del result, accumulator, result_numsamples
 
-            result = np.zeros([nb_of_classes] + list(data.shape[2:]), dtype=np.float32)
-            result_numsamples = np.zeros([nb_of_classes] + list(data.shape[2:]), dtype=np.float32)
-            if use_gaussian:
-                tmp = np.zeros(tile_size, dtype=np.float32)
-                center_coords = [i//2 for i in tile_size]
-                sigmas = [i // 8 for i in tile_size]
-                tmp[tuple(center_coords)] = 1
-                tmp_smooth = gaussian_filter(tmp, sigmas, 0, mode='constant', cval=0)
-                tmp_smooth = tmp_smooth / tmp_smooth.max() * 1
-                add = tmp_smooth
-            else:
-                add = np.ones(tile_size)
-
-            if self.get_device() == "cpu":
-                add_torch = torch.from_numpy(add).cpu().float()
+            if regions_class_order is None:
+                predicted_segmentation = softmax_pred.argmax(0)
             else:
-                add_torch = torch.from_numpy(add).cuda(self.get_device()).float()
-
-            data_shape = data.shape
-            center_coord_start = np.array([i//2 for i in patch_size]).astype(int)
-            center_coord_end = np.array([data_shape[i + 2] - patch_size[i] // 2 for i in range(len(patch_size))]).astype(int)
-            num_steps = np.ceil([(center_coord_end[i] - center_coord_start[i]) / (patch_size[i] / step) for i in range(2)])
-            step_size = np.array([(center_coord_end[i] - center_coord_start[i]) / (num_steps[i] + 1e-8) for i in range(2)])
-            step_size[step_size == 0] = 9999999
-            xsteps = np.round(np.arange(center_coord_start[0], center_coord_end[0]+1e-8, step_size[0])).astype(int)
-            ysteps = np.round(np.arange(center_coord_start[1], center_coord_end[1]+1e-8, step_size[1])).astype(int)
-
-            for x in xsteps:
-                lb_x = x - patch_size[0] // 2
-                ub_x = x + patch_size[0] // 2
-                for y in ysteps:
-                    lb_y = y - patch_size[1] // 2
-                    ub_y = y + patch_size[1] // 2
-                    result[:, lb_x:ub_x, lb_y:ub_y] += \
-                        self._inner_mirror_and_pred_2D(data[:, :, lb_x:ub_x, lb_y:ub_y],
-                                                                num_repeats, mirror_axes, do_mirroring, add_torch)[0]
-                    result_numsamples[:, lb_x:ub_x, lb_y:ub_y] += add
+                predicted_segmentation_shp = softmax_pred[0].shape
+                predicted_segmentation = np.zeros(predicted_segmentation_shp, dtype=np.float32)
+                for i, c in enumerate(regions_class_order):
+                    predicted_segmentation[softmax_pred[i] > 0.5] = c
+        return predicted_segmentation, None, softmax_pred, None
 
-            slicer = tuple([slice(0, result.shape[i]) for i in range(len(result.shape) - (len(slicer) - 1))] + slicer[1:])
-            result = result[slicer]
-            result_numsamples = result_numsamples[slicer]
-            softmax_pred = result / result_numsamples
+    def _inner_predict_slices_2Dconv(self, data, pseudo3D_slices, do_mirroring, num_repeats, min_size=None,
+                                     mirror_axes=(0, 1), regions_class_order=None, pad_border_mode="edge",
+                                     pad_kwargs=None, mirror_in_batch=False, slice_batch_size=1,
+                                     slice_memory_budget=None):
+        """
+        2D prediction of every slice of a (c, z, x, y) volume. The volume is padded once and slice_batch_size slices
+        are run through the network per forward pass. Each slice is stacked with its neighbours along the channel
+        axis (pseudo3D_slices in total). The predictions are written into a preallocated softmax. Slices are escalated
+        to mirroring like tiles if self.inference_tta_uncertainty_threshold is set
+        :param data: (c, z, x, y), already padded along z with (pseudo3D_slices - 1) // 2 slices on either side
+        :param pseudo3D_slices: 1 for plain 2D prediction
+        :param slice_batch_size: slices per forward pass. None: derive it from slice_memory_budget
+        :param slice_memory_budget: memory (in bytes) one forward pass may use, see get_tile_batch_size
+        :return:
+        """
+        with torch.no_grad():
+            data, slicer = pad_nd_img(data, min_size, pad_border_mode, pad_kwargs, True,
+                                      self.input_shape_must_be_divisible_by)
+            num_slices = data.shape[1] - pseudo3D_slices + 1
+            slice_shape = data.shape[2:]
+            spatial_slicer = tuple(slicer[2:])
+            softmax_pred = np.zeros([self.num_classes, num_slices] + [s.stop - s.start for s in spatial_slicer],
+                                    dtype=np.float32)
+
+            if slice_batch_size is None:
+                passes_per_slice = len(self._get_mirror_dims(mirror_axes, do_mirroring)) if mirror_in_batch else 1
+                slice_batch_size = self.get_tile_batch_size(slice_shape, data.shape[0] * pseudo3D_slices,
+                                                            slice_memory_budget, passes_per_slice)
+
+            for b in range(0, num_slices, slice_batch_size):
+                batch = np.stack([data[:, s:s + pseudo3D_slices].reshape((-1,) + slice_shape)
+                                  for s in range(b, min(b + slice_batch_size, num_slices))])
+                pred = self.run_tile_batch(batch, num_repeats, mirror_axes, do_mirroring, None, mirror_in_batch)
+                softmax_pred[:, b:b + len(batch)] = pred[(slice(None), slice(None)) + spatial_slicer].transpose(
+                    (1, 0, 2, 3))
 
             if regions_class_order is None:
                 predicted_segmentation = softmax_pred.argmax(0)
@@ -453,22 +1106,16 @@ class DetectionNet(BaseNet):
         return predicted_segmentation, None, softmax_pred, None
 
     def _inner_predict_3D_2Dconv(self, data, do_mirroring, num_repeats, min_size=None, BATCH_SIZE=None,
-                                    mirror_axes=(0, 1), regions_class_order=None, pad_border_mode="edge", pad_kwargs=None):
+                                    mirror_axes=(0, 1), regions_class_order=None, pad_border_mode="edge", pad_kwargs=None,
+                                    mirror_in_batch=False, slice_batch_size=1, slice_memory_budget=None):
         assert len(data.shape) == 4, "data must be c, x, y, z"
-        predicted_segmentation = []
-        softmax_pred = []
-        for s in range(data.shape[1]):
-            pred_seg, bayesian_predictions, softmax_pres, uncertainty = \
-                self._inner_predict_2D_2Dconv(data[:, s], do_mirroring, num_repeats, min_size, BATCH_SIZE,
-                                                 mirror_axes, regions_class_order, pad_border_mode, pad_kwargs)
-            predicted_segmentation.append(pred_seg[None])
-            softmax_pred.append(softmax_pres[None])
-        predicted_segmentation = np.vstack(predicted_segmentation)
-        softmax_pred = np.vstack(softmax_pred).transpose((1, 0, 2, 3))
-        return predicted_segmentation, None, softmax_pred, None
+        return self._inner_predict_slices_2Dconv(data, 1, do_mirroring, num_repeats, min_size, mirror_axes,
+                                                 regions_class_order, pad_border_mode, pad_kwargs, mirror_in_batch,
+                                                 slice_batch_size, slice_memory_budget)
 
     def pred_3D_pseu3D_2Dconv(self, data, do_mirroring, num_repeats, min_size=None, BATCH_SIZE=None,
-                                   mirror_axes=(0, 1), regions_class_order=None, pseudo3D_slices=5):
+                                   mirror_axes=(0, 1), regions_class_order=None, pseudo3D_slices=5,
+                                   mirror_in_batch=False, slice_batch_size=1, slice_memory_budget=None):
         assert len(data.shape) == 4, "data must be c, x, y, z"
         assert pseudo3D_slices % 2 == 1, "pseudo3D_slices must be odd"
         extra_slices = (pseudo3D_slices - 1) // 2
@@ -476,34 +1123,37 @@ class DetectionNet(BaseNet):
         shp_for_pad[1] = extra_slices
         pad = np.zeros(shp_for_pad, dtype=np.float32)
         data = np.concatenate((pad, data, pad), 1)
-        predicted_segmentation = []
-        softmax_pred = []
-        for s in range(extra_slices, data.shape[1] - extra_slices):
-            d = data[:, (s - extra_slices):(s + extra_slices + 1)]
-            d = d.reshape((-1, d.shape[-2], d.shape[-1]))
-            pred_seg, bayesian_predictions, softmax_pres, uncertainty = \
-                self._inner_predict_2D_2Dconv(d, do_mirroring, num_repeats, min_size, BATCH_SIZE, mirror_axes,
-                                                 regions_class_order)
-            predicted_segmentation.append(pred_seg[None])
-            softmax_pred.append(softmax_pres[None])
-        predicted_segmentation = np.vstack(predicted_segmentation)
-        softmax_pred = np.vstack(softmax_pred).transpose((1, 0, 2, 3))
-
-        return predicted_segmentation, None, softmax_pred, None
+        return self._inner_predict_slices_2Dconv(data, pseudo3D_slices, do_mirroring, num_repeats, min_size,
+                                                 mirror_axes, regions_class_order, mirror_in_batch=mirror_in_batch,
+                                                 slice_batch_size=slice_batch_size,
+                                                 slice_memory_budget=slice_memory_budget)
 
     def _inner_predict_3D_2Dconv_tiled(self, data, do_mirroring, num_repeats, BATCH_SIZE=None, mirror_axes=(0, 1),
                                           step=2, patch_size=None, regions_class_order=None, use_gaussian=False,
-                                          pad_border_mode="edge", pad_kwargs=None):
+                                          pad_border_mode="edge", pad_kwargs=None, tile_batch_size=1,
+                                          tile_memory_budget=None, mirror_in_batch=False, accumulation_dtype="float32",
+                                          roi_mask=None, num_cpu_workers=1, gaussian_sigma_scale=1. / 8):
         assert len(data.shape) == 4, "data must be c, x, y, z"
         predicted_segmentation = []
         softmax_pred = []
+        tile_stats = {'num_tiles': 0, 'num_skipped_tiles': 0}
         for s in range(data.shape[1]):
             pred_seg, bayesian_predictions, softmax_pres, uncertainty = \
                 self._inner_pred_2D_2Dconv_tiled(data[:, s], num_repeats, BATCH_SIZE, step, do_mirroring,
                                                        mirror_axes, patch_size, regions_class_order, use_gaussian,
-                                                       pad_border_mode=pad_border_mode, pad_kwargs=pad_kwargs)
+                                                       pad_border_mode=pad_border_mode, pad_kwargs=pad_kwargs,
+                                                       tile_batch_size=tile_batch_size,
+                                                       tile_memory_budget=tile_memory_budget,
+                                                       mirror_in_batch=mirror_in_batch,
+                                                       accumulation_dtype=accumulation_dtype,
+                                                       roi_mask=roi_mask[s] if roi_mask is not None else None,
+                                                       num_cpu_workers=num_cpu_workers,
+                                                       gaussian_sigma_scale=gaussian_sigma_scale)
             predicted_segmentation.append(pred_seg[None])
             softmax_pred.append(softmax_pres[None])
+            for k in tile_stats.keys():
+                tile_stats[k] += self.inference_tile_stats[k]
+        self.inference_tile_stats = tile_stats
         predicted_segmentation = np.vstack(predicted_segmentation)
         softmax_pred = np.vstack(softmax_pred).transpose((1, 0, 2, 3))
         return predicted_segmentation, None, softmax_pred, None
@@ -0,0 +1,52 @@
+from copy import deepcopy
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+def get_quantized_model_file(checkpoint_file):
+    """
+    the int8 model of a checkpoint is stored next to it, e.g. fold_0/model_best.model.int8.pt
+    """
+    return checkpoint_file + ".int8.pt"
+
+
+def quantize_static(module, calibration_batches, backend="fbgemm"):
+    """
+    post training static int8 quantization (FX graph mode) for cpu inference. Weights and activations are int8, the
+    activation ranges are observed while calibration_batches are run through the module. The quantized module takes
+    and returns float tensors, so it can replace module as is
+    :param module: float module whose forward can be traced with torch.fx (Generic_UNet without deep supervision)
+    :param calibration_batches: list of float tensors (b, c, x, y(, z))
+    :param backend: fbgemm (x86) or qnnpack (arm)
+    :return: torch.jit.ScriptModule
+    """
+    torch.backends.quantized.engine = backend
+    module = deepcopy(module).cpu().eval()
+    prepared = prepare_fx(module, get_default_qconfig_mapping(backend), example_inputs=(calibration_batches[0],))
+    with torch.no_grad():
+        for batch in calibration_batches:
+            prepared(batch)
+        quantized = convert_fx(prepared)
+        return torch.jit.trace(quantized, calibration_batches[0], strict=False)
+
+
+def quantize_unet(net, calibration_batches, backend="fbgemm"):
+    """
+    int8 version of the forward pass of a Generic_UNet. Attach it with DetectionNet.set_quantized_module, the
+    sliding window and everything else keep running on the float network
+    """
+    do_ds = net.do_ds
+    net.do_ds = False
+    try:
+        return quantize_static(net, calibration_batches, backend)
+    finally:
+        net.do_ds = do_ds
+
+
+def save_quantized_module(module, fname):
+    torch.jit.save(module, fname)
+
+
+def load_quantized_module(fname):
+    return torch.jit.load(fname, map_location='cpu')
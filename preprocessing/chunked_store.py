@@ -0,0 +1,304 @@
+import itertools
+import shutil
+import zlib
+from multiprocessing import Pool
+import numpy as np
+from utils.files_utils import *
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+# a case is stored in the folder <case_identifier>.chunked next to its .pkl file
+chunked_case_suffix = ".chunked"
+default_chunk_size = (64, 64, 64)
+
+
+def get_default_codec():
+    """
+    lz4 if it is installed (decompresses at several GB/s), zlib at its fastest level otherwise
+    """
+    return "lz4" if lz4_frame is not None else "zlib"
+
+
+def _compress(buf, codec):
+    if codec == "lz4":
+        return lz4_frame.compress(buf)
+    elif codec == "zlib":
+        return zlib.compress(buf, 1)
+    elif codec == "raw":
+        return buf
+    raise ValueError("unknown codec: %s" % codec)
+
+
+def _decompress(buf, codec):
+    if codec == "lz4":
+        return lz4_frame.decompress(buf)
+    elif codec == "zlib":
+        return zlib.decompress(buf)
+    elif codec == "raw":
+        return buf
+    raise ValueError("unknown codec: %s" % codec)
+
+
+def float32_to_bfloat16(arr):
+    """
+    bfloat16 (round to nearest even) as raw uint16, numpy has no bfloat16 type
+    """
+    bits = np.ascontiguousarray(arr, dtype=np.float32).view(np.uint32)
+    rounding = ((bits >> 16) & 1) + np.uint32(0x7FFF)
+    return ((bits + rounding) >> 16).astype(np.uint16)
+
+
+def bfloat16_to_float32(arr):
+    return (arr.astype(np.uint32) << 16).view(np.float32)
+
+
+def write_chunked_array(fname, arr, chunk_size=default_chunk_size, codec=None, encoding=None):
+    """
+    writes arr (c, x, y(, z)) to fname as independently compressed chunks. A chunk spans all channels and chunk_size
+    voxels along each spatial axis, chunks are written in C order
+    :param encoding: None or bfloat16 (arr is float32 and stored as raw bfloat16)
+    :return: meta data needed to read the array (see ChunkedArray)
+    """
+    if codec is None:
+        codec = get_default_codec()
+    if encoding == "bfloat16":
+        arr = float32_to_bfloat16(arr)
+    elif encoding is not None:
+        raise ValueError("unknown encoding: %s" % encoding)
+    spatial_shape = arr.shape[1:]
+    chunk_size = [int(i) for i in chunk_size[-len(spatial_shape):]]
+    grid = [int(np.ceil(float(s) / c)) for s, c in zip(spatial_shape, chunk_size)]
+    offsets = []
+    position = 0
+    with open(fname, 'wb') as f:
+        for idx in np.ndindex(*grid):
+            slicer = (slice(None),) + tuple([slice(i * c, (i + 1) * c) for i, c in zip(idx, chunk_size)])
+            buf = _compress(np.ascontiguousarray(arr[slicer]).tobytes(), codec)
+            f.write(buf)
+            offsets.append([position, len(buf)])
+            position += len(buf)
+    return {'shape': [int(i) for i in arr.shape], 'dtype': str(arr.dtype), 'encoding': encoding,
+            'chunk_size': chunk_size, 'codec': codec, 'offsets': offsets}
+
+
+class ChunkedArray(object):
+    def __init__(self, fname, meta):
+        """
+        read access to an array written by write_chunked_array
+        :param fname:
+        :param meta: as returned by write_chunked_array
+        """
+        self.fname = fname
+        self.shape = tuple(meta['shape'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.chunk_size = meta['chunk_size']
+        self.codec = meta['codec']
+        self.offsets = meta['offsets']
+        self.encoding = meta.get('encoding')
+        self.grid = [int(np.ceil(float(s) / c)) for s, c in zip(self.shape[1:], self.chunk_size)]
+
+    def read(self, bbox):
+        """
+        decompresses only the chunks that overlap bbox
+        :param bbox: [[lb, ub], ...] for each spatial axis, must lie within the array
+        :return: all channels of the region (c, ...), bfloat16 arrays are returned as float32
+        """
+        out = np.empty((self.shape[0],) + tuple([ub - lb for lb, ub in bbox]), dtype=self.dtype)
+        chunk_ranges = [range(lb // c, (ub - 1) // c + 1) for (lb, ub), c in zip(bbox, self.chunk_size)]
+        with open(self.fname, 'rb') as f:
+            for idx in itertools.product(*chunk_ranges):
+                offset, nbytes = self.offsets[int(np.ravel_multi_index(idx, self.grid))]
+                f.seek(offset)
+                start = [i * c for i, c in zip(idx, self.chunk_size)]
+                chunk_shape = [min(c, s - st) for c, s, st in zip(self.chunk_size, self.shape[1:], start)]
+                chunk = np.frombuffer(_decompress(f.read(nbytes), self.codec), dtype=self.dtype).reshape(
+                    [self.shape[0]] + chunk_shape)
+                src = tuple([slice(max(lb, st) - st, min(ub, st + cs) - st)
+                             for (lb, ub), st, cs in zip(bbox, start, chunk_shape)])
+                dst = tuple([slice(max(lb, st) - lb, min(ub, st + cs) - lb)
+                             for (lb, ub), st, cs in zip(bbox, start, chunk_shape)])
+                out[(slice(None),) + dst] = chunk[(slice(None),) + src]
+        if self.encoding == "bfloat16":
+            out = bfloat16_to_float32(out)
+        return out
+
+    def read_all(self):
+        return self.read([[0, s] for s in self.shape[1:]])
+
+
+class ChunkedCase(object):
+    def __init__(self, folder):
+        """
+        a preprocessed case stored with save_chunked_case. Indexing it works like indexing the 'data' array of the npz
+        files (data channels followed by the segmentation, float32) but only reads the chunks of the requested region.
+        The data can be stored as float32, float16 or bfloat16, the segmentation (incl. the -1 of the nonzero mask) as
+        int8 (int16 for more than 127 classes)
+        :param folder: <case_identifier>.chunked
+        """
+        self.folder = folder
+        meta = load_json(join(folder, "meta.json"))
+        self.data = ChunkedArray(join(folder, "data.bin"), meta['data'])
+        self.seg = ChunkedArray(join(folder, "seg.bin"), meta['seg']) if meta.get('seg') is not None else None
+        num_seg_channels = self.seg.shape[0] if self.seg is not None else 0
+        self.shape = (self.data.shape[0] + num_seg_channels,) + self.data.shape[1:]
+        self.ndim = len(self.shape)
+        self._class_locations = None
+
+    def __getitem__(self, key):
+        """
+        supports ints, slices with step 1, None and Ellipsis. The channel axis can also be indexed with lists or
+        arrays of indices
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        is_ellipsis = [k is Ellipsis for k in key]
+        assert sum(is_ellipsis) <= 1, "an index can only have a single ellipsis"
+        num_axis_keys = len([k for k in key if k is not None and k is not Ellipsis])
+        if any(is_ellipsis):
+            i = is_ellipsis.index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - num_axis_keys) + key[i + 1:]
+        else:
+            key = key + (slice(None),) * (self.ndim - num_axis_keys)
+        axis_keys = [k for k in key if k is not None]
+        assert len(axis_keys) == self.ndim, "too many indices for a case with %d dimensions" % self.ndim
+        channels = np.atleast_1d(np.arange(self.shape[0])[axis_keys[0]])
+
+        bbox = []
+        for k, s in zip(axis_keys[1:], self.shape[1:]):
+            if isinstance(k, slice):
+                lb, ub, step = k.indices(s)
+                assert step == 1, "only slices with step 1 are supported"
+                bbox.append([lb, max(lb, ub)])
+            else:
+                assert isinstance(k, (int, np.integer)), "spatial axes only support ints and slices"
+                k = int(k) + s if k < 0 else int(k)
+                assert 0 <= k < s, "index %d is out of bounds for axis with size %d" % (k, s)
+                bbox.append([k, k + 1])
+
+        num_data_channels = self.data.shape[0]
+        data = self.data.read(bbox) if np.any(channels < num_data_channels) else None
+        seg = self.seg.read(bbox) if np.any(channels >= num_data_channels) else None
+        result = np.empty((len(channels),) + tuple([ub - lb for lb, ub in bbox]), dtype=np.float32)
+        for i, c in enumerate(channels):
+            result[i] = data[c] if c < num_data_channels else seg[c - num_data_channels]
+
+        # result still has all axes: drop the ones indexed with ints and insert the new ones
+        output_key = tuple([None if k is None else 0 if isinstance(k, (int, np.integer)) else slice(None)
+                            for k in key])
+        return result[output_key]
+
+    def get_seg(self):
+        """
+        :return: the whole segmentation in its integer storage dtype (1, x, y, z)
+        """
+        return self.seg.read_all()
+
+    def get_class_locations(self, c):
+        """
+        :return: (n, dim) coordinates of (at most 10000 randomly sampled) voxels of class c, computed when the case was
+        stored. Replaces np.argwhere(seg == c) so that the whole segmentation need not be read
+        """
+        if self._class_locations is None:
+            locations = np.load(join(self.folder, "class_locations.npz"))
+            self._class_locations = {int(k): locations[k] for k in locations.files}
+        return self._class_locations.get(int(c), np.zeros((0, self.ndim - 1), dtype=int))
+
+
+def get_class_locations(seg, num_samples=10000, seed=1234):
+    """
+    :param seg: (x, y(, z))
+    :return: dict class -> (n, dim) voxel coordinates, at most num_samples per class
+    """
+    rs = np.random.RandomState(seed)
+    locations = {}
+    for c in np.unique(seg):
+        voxels = np.argwhere(seg == c)
+        if len(voxels) > num_samples:
+            voxels = voxels[np.sort(rs.choice(len(voxels), num_samples, replace=False))]
+        locations[str(int(c))] = voxels.astype(np.int32)
+    return locations
+
+
+def save_chunked_case(folder, case_identifier, data, seg=None, chunk_size=default_chunk_size, codec=None,
+                      data_dtype="float32"):
+    """
+    stores a case in folder/<case_identifier>.chunked: data and seg (int8/int16) as separate chunked arrays,
+    the sampled voxel locations of each class and meta.json, which is written last so that only complete cases are
+    picked up by load_dataset
+    :param folder:
+    :param case_identifier:
+    :param data: (c, x, y, z)
+    :param seg: (1, x, y, z) or None
+    :param chunk_size: spatial chunk size in voxels
+    :param codec: lz4, zlib or raw. Default: see get_default_codec
+    :param data_dtype: float32, float16 or bfloat16. The normalized intensities lose little in half precision and
+    need half the disk space and page cache
+    :return: case folder
+    """
+    case_folder = join(folder, case_identifier + chunked_case_suffix)
+    if isdir(case_folder):
+        shutil.rmtree(case_folder)
+    maybe_mkdir_p(case_folder)
+    if data_dtype == "bfloat16":
+        data_meta = write_chunked_array(join(case_folder, "data.bin"), data, chunk_size, codec, "bfloat16")
+    else:
+        assert data_dtype in ("float32", "float16"), "data_dtype must be float32, float16 or bfloat16"
+        data_meta = write_chunked_array(join(case_folder, "data.bin"), data.astype(data_dtype), chunk_size, codec)
+    meta = {'data': data_meta, 'seg': None}
+    if seg is not None:
+        seg_dtype = np.int8 if seg.min() >= -128 and seg.max() <= 127 else np.int16
+        meta['seg'] = write_chunked_array(join(case_folder, "seg.bin"), seg.astype(seg_dtype), chunk_size, codec)
+        np.savez(join(case_folder, "class_locations.npz"), **get_class_locations(seg[-1]))
+    save_json(meta, join(case_folder, "meta.json"))
+    return case_folder
+
+
+def get_chunked_case_identifiers(folder):
+    return [i[:-len(chunked_case_suffix)] for i in subdirs(folder, join=False, suffix=chunked_case_suffix)
+            if isfile(join(folder, i, "meta.json"))]
+
+
+def npz_to_chunked(npz_file, chunk_size=default_chunk_size, codec=None, delete_npz=False, data_dtype="float32"):
+    """
+    converts a case of the npz layout (npz['data'] is data followed by the segmentation). Removes the npz (and the
+    npy of unpack_dataset) afterwards if delete_npz
+    """
+    all_data = np.load(npz_file)['data']
+    folder, fname = os.path.split(npz_file)
+    save_chunked_case(folder, fname[:-4], all_data[:-1], all_data[-1:], chunk_size, codec, data_dtype)
+    if delete_npz:
+        for f in (npz_file, npz_file[:-4] + ".npy"):
+            if isfile(f):
+                os.remove(f)
+
+
+def chunked_to_npz(case_folder, delete_chunked=False):
+    all_data = ChunkedCase(case_folder)[:]
+    np.savez_compressed(case_folder[:-len(chunked_case_suffix)] + ".npz", data=all_data)
+    if delete_chunked:
+        shutil.rmtree(case_folder)
+
+
+def convert_npz_to_chunked(folder, threads=8, chunk_size=default_chunk_size, codec=None, delete_npz=False,
+                           data_dtype="float32"):
+    """
+    converts all cases (not the segFromPrevStage files) of a folder with npz files to the chunked layout
+    """
+    npz_files = [i for i in subfiles(folder, True, None, ".npz", True) if i.find("segFromPrevStage") == -1]
+    p = Pool(threads)
+    p.starmap(npz_to_chunked, zip(npz_files, [chunk_size] * len(npz_files), [codec] * len(npz_files),
+                                  [delete_npz] * len(npz_files), [data_dtype] * len(npz_files)))
+    p.close()
+    p.join()
+
+
+def convert_chunked_to_npz(folder, threads=8, delete_chunked=False):
+    case_folders = [join(folder, i + chunked_case_suffix) for i in get_chunked_case_identifiers(folder)]
+    p = Pool(threads)
+    p.starmap(chunked_to_npz, zip(case_folders, [delete_chunked] * len(case_folders)))
+    p.close()
+    p.join()
@@ -5,6 +5,7 @@ import numpy as np
 from preprocessing.data_loader import DataLoaderBase
 from multiprocessing import Pool
 from default_configs import preprocessing_output_dir
+from preprocessing.chunked_store import ChunkedCase, get_chunked_case_identifiers, chunked_case_suffix
 from utils.files_utils import *
 
 class BatchGenerator3D(DataLoaderBase):
@@ -58,7 +59,10 @@ class BatchGenerator3D(DataLoaderBase):
 
             case_properties.append(self._data[i]['properties'])
 
-            if isfile(self._data[i]['data_file'][:-4] + ".npy"):
+            if self._data[i].get('chunked_case') is not None:
+                # only the chunks of the patch are read further down
+                case_all_data = ChunkedCase(self._data[i]['chunked_case'])
+            elif isfile(self._data[i]['data_file'][:-4] + ".npy"):
                 case_all_data = np.load(self._data[i]['data_file'][:-4] + ".npy", self.memmap_mode)
             else:
                 case_all_data = np.load(self._data[i]['data_file'])['data']
@@ -105,7 +109,10 @@ class BatchGenerator3D(DataLoaderBase):
                     selected_class = 0
                 else:
                     selected_class = np.random.choice(foreground_classes)
-                voxels_of_that_class = np.argwhere(case_all_data[-1] == selected_class)
+                if isinstance(case_all_data, ChunkedCase):
+                    voxels_of_that_class = case_all_data.get_class_locations(selected_class)
+                else:
+                    voxels_of_that_class = np.argwhere(case_all_data[-1] == selected_class)
 
 
                 if len(voxels_of_that_class) != 0:
@@ -236,10 +243,13 @@ class BatchGenerator2D(DataLoaderBase):
             else:
                 force_fg = False
 
-            if not isfile(self._data[i]['data_file'][:-4] + ".npy"):
+            if self._data[i].get('chunked_case') is not None:
+                case_all_data = ChunkedCase(self._data[i]['chunked_case'])
+            elif not isfile(self._data[i]['data_file'][:-4] + ".npy"):
                 case_all_data = np.load(self._data[i]['data_file'][:-4] + ".npz")['data']
             else:
                 case_all_data = np.load(self._data[i]['data_file'][:-4] + ".npy", self.memmap_mode)
+            chunked_case = case_all_data if isinstance(case_all_data, ChunkedCase) else None
 
             # 2d slice in case_all_data (2d support)
             if len(case_all_data.shape) == 3:
@@ -263,6 +273,13 @@ class BatchGenerator2D(DataLoaderBase):
                     selected_class = 0
                 if classes_in_slice_per_axis is not None:
                     valid_slices = classes_in_slice_per_axis[leading_axis][selected_class]
+                elif chunked_case is not None:
+                    locations = chunked_case.get_class_locations(selected_class)
+                    if chunked_case.ndim == 3:
+                        # 2d case, its only slice is the one of the added axis
+                        valid_slices = np.zeros(min(1, len(locations)), dtype=int)
+                    else:
+                        valid_slices = np.unique(locations[:, leading_axis])
                 else:
                     valid_slices = np.where(np.sum(case_all_data[-1] == selected_class, axis=[i for i in range(3) if i != leading_axis]))[0]
                 if len(valid_slices) != 0:
@@ -285,10 +302,8 @@ class BatchGenerator2D(DataLoaderBase):
                 mx = random_slice + (self.pseudo_3d_slices - 1) // 2 + 1
                 valid_mn = max(mn, 0)
                 valid_mx = min(mx, case_all_data.shape[1])
-                case_all_seg = case_all_data[-1:]
-                case_all_data = case_all_data[:-1]
-                case_all_data = case_all_data[:, valid_mn:valid_mx]
-                case_all_seg = case_all_seg[:, random_slice]
+                case_all_seg = case_all_data[-1:, random_slice]
+                case_all_data = case_all_data[:-1, valid_mn:valid_mx]
                 need_to_pad_below = valid_mn - mn
                 need_to_pad_above = mx - valid_mx
                 if need_to_pad_below > 0:
@@ -394,12 +409,19 @@ def delete_npy(folder):
 
 
 def load_dataset(folder):
-    case_identifiers = get_patientIDs(folder)
+    """
+    finds the cases of the npz layout and of the chunked layout (see preprocessing.chunked_store). Chunked cases have
+    the entry 'chunked_case', which the data loaders prefer over 'data_file'
+    """
+    chunked_case_identifiers = get_chunked_case_identifiers(folder)
+    case_identifiers = list(set(get_patientIDs(folder)) | set(chunked_case_identifiers))
     case_identifiers.sort()
     dataset = OrderedDict()
     for c in case_identifiers:
         dataset[c] = OrderedDict()
         dataset[c]['data_file'] = join(folder, "%s.npz"%c)
+        if c in chunked_case_identifiers:
+            dataset[c]['chunked_case'] = join(folder, c + chunked_case_suffix)
         with open(join(folder, "%s.pkl"%c), 'rb') as f:
             dataset[c]['properties'] = pickle.load(f)
         if dataset[c].get('seg_from_prev_stage_file') is not None:
@@ -407,6 +429,16 @@ def load_dataset(folder):
     return dataset
 
 
+def load_case(dataset_entry):
+    """
+    :param dataset_entry: a case of load_dataset
+    :return: the whole case (data channels followed by the segmentation), from whichever layout is on disk
+    """
+    if dataset_entry.get('chunked_case') is not None:
+        return ChunkedCase(dataset_entry['chunked_case'])[:]
+    return np.load(dataset_entry['data_file'])['data']
+
+
 def crop_2D_img(img, crop_size, force_class=None):
     """
     img must be [c, x, y]
@@ -7,17 +7,28 @@ from skimage.transform import resize
 from scipy.ndimage.interpolation import map_coordinates
 import numpy as np
 from analysis.configuration import RESAMPLING_SEPARATE_Z_ANISOTROPY_THRESHOLD
-from multiprocessing.pool import Pool
+from multiprocessing.pool import Pool, ThreadPool
+from time import time
+import resource
+from preprocessing.chunked_store import save_chunked_case
+from preprocessing.separable_resampling import resample_separable, resample_labels
+
+# threads per resample_data_or_seg call. Preprocessing and export already run several processes, so keep this moderate
+default_resampling_threads = 4
 
 
 
 class GenericPreprocessor(object):
-    def __init__(self, normalization_scheme_per_modality, use_nonzero_mask, intensityproperties=None):
+    def __init__(self, normalization_scheme_per_modality, use_nonzero_mask, intensityproperties=None,
+                 resampling="spline"):
         """
         :param normalization_scheme_per_modality: dict {0:'nonCT'}
         :param use_nonzero_mask: {0:False}
         :param intensityproperties:
+        :param resampling: spline (skimage resize + map_coordinates) or separable (1D passes per axis), see
+        resampling_functions. Stored in the properties of each case so that the export resamples the same way
         """
+        self.resampling = resampling
         self.intensityproperties = intensityproperties
         self.normalization_scheme_per_modality = normalization_scheme_per_modality
         self.use_nonzero_mask = use_nonzero_mask
@@ -34,7 +45,8 @@ class GenericPreprocessor(object):
     def resample_and_normalize(self, data, target_spacing, properties, seg=None, force_separate_z=None):
         print("before resample:", "shape", data.shape, "spacing", np.array(properties["original_spacing"]))
         data, seg = resample_patient(data, seg, np.array(properties["original_spacing"]), target_spacing, 3, 1,
-                                     force_separate_z=force_separate_z, order_z_data=0, order_z_seg=0)
+                                     force_separate_z=force_separate_z, order_z_data=0, order_z_seg=0,
+                                     resampling=self.resampling)
         print("after resample:", "shape", data.shape, "spacing", target_spacing, "\n")
 
         if seg is not None:  # hippocampus 243 has one voxel with -2 as label. wtf?
@@ -42,6 +54,7 @@ class GenericPreprocessor(object):
 
         properties["size_after_resampling"] = data[0].shape
         properties["spacing_after_resampling"] = target_spacing
+        properties["resampling"] = self.resampling
         use_nonzero_mask = self.use_nonzero_mask
 
         assert len(self.normalization_scheme_per_modality) == len(data), "self.normalization_scheme_per_modality " \
@@ -95,21 +108,28 @@ class GenericPreprocessor(object):
         return data.astype(np.float32), seg, properties
 
     def _do_star(self, args):
-        target_spacing, case_identifier, output_folder_stage, cropped_output_dir, force_separate_z = args
+        target_spacing, case_identifier, output_folder_stage, cropped_output_dir, force_separate_z, storage_format, \
+            storage_dtype = args
 
         data, seg, properties = self.load_cropped(cropped_output_dir, case_identifier)
 
         data, seg, properties = self.resample_and_normalize(data, target_spacing,
                                                             properties, seg, force_separate_z)
 
-        all_data = np.vstack((data, seg)).astype(np.float32)
-        print("saving: ", os.path.join(output_folder_stage, "%s.npz" % case_identifier))
-        np.savez_compressed(os.path.join(output_folder_stage, "%s.npz" % case_identifier),
-                            data=all_data.astype(np.float32))
+        if storage_format == "chunked":
+            print("saving: ", save_chunked_case(output_folder_stage, case_identifier, data, seg,
+                                                data_dtype=storage_dtype))
+        else:
+            assert storage_dtype == "float32", "half precision storage requires storage_format chunked"
+            all_data = np.vstack((data, seg)).astype(np.float32)
+            print("saving: ", os.path.join(output_folder_stage, "%s.npz" % case_identifier))
+            np.savez_compressed(os.path.join(output_folder_stage, "%s.npz" % case_identifier),
+                                data=all_data.astype(np.float32))
         with open(os.path.join(output_folder_stage, "%s.pkl" % case_identifier), 'wb') as f:
             pickle.dump(properties, f)
 
-    def run(self, target_spacings, input_folder_with_cropped_npz, output_folder, data_identifier='UNetV2', num_threads=8, force_separate_z=None):
+    def run(self, target_spacings, input_folder_with_cropped_npz, output_folder, data_identifier='UNetV2', num_threads=8, force_separate_z=None,
+            storage_format="npz", storage_dtype="float32"):
         """
 
         :param target_spacings: list of lists [[1.25, 1.25, 5]]
@@ -117,6 +137,9 @@ class GenericPreprocessor(object):
         :param output_folder:
         :param num_threads:
         :param force_separate_z: None
+        :param storage_format: npz (np.savez_compressed of data and seg) or chunked (see preprocessing.chunked_store)
+        :param storage_dtype: float32, float16 or bfloat16 for the normalized intensities of the chunked format, the
+        segmentation is stored as int8
         :return:
         """
         print("Initializing to do preprocessing")
@@ -137,7 +160,8 @@ class GenericPreprocessor(object):
             spacing = target_spacings[i]
             for j, case in enumerate(list_of_cropped_npz_files):
                 case_identifier = get_patientID_from_npz(case)
-                args = spacing, case_identifier, output_folder_stage, input_folder_with_cropped_npz, force_separate_z
+                args = spacing, case_identifier, output_folder_stage, input_folder_with_cropped_npz, force_separate_z, \
+                       storage_format, storage_dtype
                 all_args.append(args)
             p = Pool(num_threads[i])
             p.map(self._do_star, all_args)
@@ -147,12 +171,13 @@ class GenericPreprocessor(object):
 
 class Preprocessor2D(GenericPreprocessor):
     def __init__(self, normalization_scheme_per_modality, use_nonzero_mask, intensityproperties=None,
-                 out_of_plane_axis=0):
+                 out_of_plane_axis=0, resampling="spline"):
         super(Preprocessor2D, self).__init__(normalization_scheme_per_modality, use_nonzero_mask,
-                                                intensityproperties)
+                                                intensityproperties, resampling)
         self.out_of_plane_axis = out_of_plane_axis
 
-    def run(self, target_spacings, input_folder_with_cropped_npz, output_folder, data_identifier='UNetV2', num_threads=8, force_separate_z=None):
+    def run(self, target_spacings, input_folder_with_cropped_npz, output_folder, data_identifier='UNetV2', num_threads=8, force_separate_z=None,
+            storage_format="npz", storage_dtype="float32"):
         print("Initializing to do preprocessing")
         print("npz folder:", input_folder_with_cropped_npz)
         print("output_folder:", output_folder)
@@ -167,7 +192,8 @@ class Preprocessor2D(GenericPreprocessor):
             spacing = target_spacings[i]
             for j, case in enumerate(list_of_cropped_npz_files):
                 case_identifier = get_patientID_from_npz(case)
-                args = spacing, case_identifier, output_folder_stage, input_folder_with_cropped_npz, force_separate_z
+                args = spacing, case_identifier, output_folder_stage, input_folder_with_cropped_npz, force_separate_z, \
+                       storage_format, storage_dtype
                 all_args.append(args)
         p = Pool(num_threads)
         p.map(self._do_star, all_args)
@@ -180,7 +206,8 @@ class Preprocessor2D(GenericPreprocessor):
         target_spacing[self.out_of_plane_axis] = original_spacing[self.out_of_plane_axis]
 
         data, seg = resample_patient(data, seg, np.array(properties["original_spacing"]), target_spacing, 3, 1,
-                                     force_separate_z=force_separate_z, order_z_data=0, order_z_seg=0)
+                                     force_separate_z=force_separate_z, order_z_data=0, order_z_seg=0,
+                                     resampling=self.resampling)
 
         print("after resample:", "shape", data.shape, "spacing", target_spacing, "\n")
 
@@ -189,6 +216,7 @@ class Preprocessor2D(GenericPreprocessor):
 
         properties["size_after_resampling"] = data[0].shape
         properties["spacing_after_resampling"] = target_spacing
+        properties["resampling"] = self.resampling
         use_nonzero_mask = self.use_nonzero_mask
 
         assert len(self.normalization_scheme_per_modality) == len(data), "self.normalization_scheme_per_modality " \
@@ -244,7 +272,8 @@ def get_lowres_axis(new_spacing):
 
 
 def resample_patient(data, seg, original_spacing, target_spacing, order_data=3, order_seg=0, force_separate_z=False,
-                     cval_data=0, cval_seg=-1, order_z_data=0, order_z_seg=0):
+                     cval_data=0, cval_seg=-1, order_z_data=0, order_z_seg=0, num_threads=None, resampling="spline",
+                     stats=None):
     """
     :param cval_seg:
     :param cval_data:
@@ -258,6 +287,10 @@ def resample_patient(data, seg, original_spacing, target_spacing, order_data=3,
     /never resample along z separately
     :param order_z_seg: only applies if do_separate_z is True
     :param order_z_data: only applies if do_separate_z is True
+    :param num_threads: see resample_data_or_seg
+    :param resampling: key of resampling_functions
+    :param stats: if a dict is given, it receives the stats of the resampling of data and seg (see
+    resample_data_or_seg)
     :return:
     """
     assert not ((data is None) and (seg is None))
@@ -285,20 +318,35 @@ def resample_patient(data, seg, original_spacing, target_spacing, order_data=3,
             do_separate_z = False
             axis = None
 
+    resample_fn = resampling_functions[resampling]
+    if stats is not None:
+        stats['data'] = {}
+        stats['seg'] = {}
     if data is not None:
-        data_reshaped = resample_data_or_seg(data, new_shape, False, axis, order_data, do_separate_z, cval=cval_data,
-                                             order_z=order_z_data)
+        data_reshaped = resample_fn(data, new_shape, False, axis, order_data, do_separate_z, cval=cval_data,
+                                    order_z=order_z_data, num_threads=num_threads,
+                                    stats=stats['data'] if stats is not None else None)
     else:
         data_reshaped = None
     if seg is not None:
-        seg_reshaped = resample_data_or_seg(seg, new_shape, True, axis, order_seg, do_separate_z, cval=cval_seg,
-                                            order_z=order_z_seg)
+        seg_reshaped = resample_fn(seg, new_shape, True, axis, order_seg, do_separate_z, cval=cval_seg,
+                                   order_z=order_z_seg, num_threads=num_threads,
+                                   stats=stats['seg'] if stats is not None else None)
     else:
         seg_reshaped = None
     return data_reshaped, seg_reshaped
 
 
-def resample_data_or_seg(data, new_shape, is_seg, axis=None, order=3, do_separate_z=False, cval=0, order_z=0):
+def _run_threaded(pool, fn, num_jobs):
+    if pool is None or num_jobs == 1:
+        for i in range(num_jobs):
+            fn(i)
+    else:
+        pool.map(fn, range(num_jobs))
+
+
+def resample_data_or_seg(data, new_shape, is_seg, axis=None, order=3, do_separate_z=False, cval=0, order_z=0,
+                         compute_dtype=np.float32, num_threads=None, stats=None):
     """
     separate_z=True will resample with order 0 along z
     :param data:
@@ -309,9 +357,20 @@ def resample_data_or_seg(data, new_shape, is_seg, axis=None, order=3, do_separat
     :param do_separate_z:
     :param cval:
     :param order_z: only applies if do_separate_z is True
+    :param compute_dtype: dtype the data is resampled in. float32 halves memory and time compared to float (float64).
+    Only one slice (or channel) per thread is converted at a time, the result is written into a preallocated array.
+    Segmentations are resampled with resample_labels (linear instead of spline interpolation of the one hot maps for
+    order > 1) unless they only need nearest neighbor interpolation
+    :param num_threads: channels (and slices if do_separate_z) are resampled by a thread pool, scipy and skimage
+    release the GIL. Default: default_resampling_threads
+    :param stats: if a dict is given, the time, the (estimated) peak memory of the resampling buffers and the peak rss
+    of the process are measured, printed and stored in it. None: no stats
     :return:
     """
     assert len(data.shape) == 4, "data must be (c, x, y, z)"
+    start = time()
+    if num_threads is None:
+        num_threads = default_resampling_threads
     if is_seg:
         resize_fn = resize_seg
         kwargs = OrderedDict()
@@ -319,71 +378,158 @@ def resample_data_or_seg(data, new_shape, is_seg, axis=None, order=3, do_separat
         resize_fn = resize
         kwargs = {'mode': 'edge', 'anti_aliasing': False}
     dtype_data = data.dtype
-    data = data.astype(float)
     shape = np.array(data[0].shape)
     new_shape = np.array(new_shape)
-    if np.any(shape != new_shape):
-        if do_separate_z:
+    if np.all(shape == new_shape):
+        print("no resampling necessary")
+        return data.astype(compute_dtype)
+
+    itemsize = np.dtype(compute_dtype).itemsize
+    reshaped_final_data = np.empty([data.shape[0]] + list(new_shape), dtype=dtype_data)
+    buffer_bytes = reshaped_final_data.nbytes
+    orders = [order] * 3
+    if do_separate_z:
+        assert len(axis) == 1, "only one anisotropic axis supported"
+        orders[axis[0]] = order_z
+    pool = ThreadPool(num_threads) if num_threads > 1 else None
+    try:
+        if is_seg and any([o > 0 for o in orders]):
+            # weight sum and best weight per thread (the label regions are small compared to those)
+            buffer_bytes += min(num_threads, data.shape[0]) * 2 * np.prod(new_shape) * itemsize
+            _resample_labels_channels(data, new_shape, [min(o, 1) if o > 0 else 0 for o in orders], compute_dtype,
+                                      pool, reshaped_final_data)
+        elif do_separate_z:
             print("separate z")
             assert len(axis) == 1, "only one anisotropic axis supported"
             axis = axis[0]
-            if axis == 0:
-                new_shape_2d = new_shape[1:]
-            elif axis == 1:
-                new_shape_2d = new_shape[[0, 2]]
+            in_plane_axes = [i for i in range(3) if i != axis]
+            new_shape_2d = new_shape[in_plane_axes]
+            # input slice (cast) and resampled slice per thread
+            buffer_bytes += num_threads * (np.prod(shape[in_plane_axes]) + np.prod(new_shape_2d)) * itemsize
+
+            if shape[axis] != new_shape[axis]:
+                # in plane resampled channel, reused for all channels
+                shape_in_plane_resampled = new_shape.copy()
+                shape_in_plane_resampled[axis] = shape[axis]
+                reshaped_data = np.empty(shape_in_plane_resampled, dtype=compute_dtype)
+                buffer_bytes += reshaped_data.nbytes
+
+                # the second pass only resamples along axis, the coordinates of the other axes are the identity. It is
+                # therefore done slice by slice along one of the other axes, with the same coordinates for all slices
+                other_axis = in_plane_axes[0]
+                slice_axes = [i for i in range(3) if i != other_axis]
+                slice_shape = new_shape[slice_axes]
+                scales = [float(shape_in_plane_resampled[i]) / new_shape[i] for i in slice_axes]
+                # blatantly copied and modified from sklearn's resize()
+                coord_map = np.array([scale * (m + 0.5) - 0.5 for scale, m in
+                                      zip(scales, np.mgrid[:slice_shape[0], :slice_shape[1]])])
+                buffer_bytes += coord_map.nbytes + num_threads * 2 * np.prod(slice_shape) * itemsize
             else:
-                new_shape_2d = new_shape[:-1]
+                reshaped_data = None
 
-            reshaped_final_data = []
             for c in range(data.shape[0]):
-                reshaped_data = []
-                for slice_id in range(shape[axis]):
-                    if axis == 0:
-                        reshaped_data.append(resize_fn(data[c, slice_id], new_shape_2d, order, cval=cval, **kwargs))
-                    elif axis == 1:
-                        reshaped_data.append(resize_fn(data[c, :, slice_id], new_shape_2d, order, cval=cval, **kwargs))
-                    else:
-                        reshaped_data.append(resize_fn(data[c, :, :, slice_id], new_shape_2d, order, cval=cval,
-                                                       **kwargs))
-                reshaped_data = np.stack(reshaped_data, axis)
-                if shape[axis] != new_shape[axis]:
-
-                    # blatantly copied and modified from sklearn's resize()
-                    rows, cols, dim = new_shape[0], new_shape[1], new_shape[2]
-                    orig_rows, orig_cols, orig_dim = reshaped_data.shape#data[c].shape[0], reshaped_data.shape[1], reshaped_data.shape[2]
-
-                    row_scale = float(orig_rows) / rows
-                    col_scale = float(orig_cols) / cols
-                    dim_scale = float(orig_dim) / dim
-
-                    map_rows, map_cols, map_dims = np.mgrid[:rows, :cols, :dim]
-                    map_rows = row_scale * (map_rows + 0.5) - 0.5
-                    map_cols = col_scale * (map_cols + 0.5) - 0.5
-                    map_dims = dim_scale * (map_dims + 0.5) - 0.5
-
-                    coord_map = np.array([map_rows, map_cols, map_dims])
-                    if not is_seg or order_z == 0:
-                        reshaped_final_data.append(map_coordinates(reshaped_data, coord_map, order=order_z, cval=cval,
-                                                                   mode='nearest')[None])
-                    else:
-                        unique_labels = np.unique(reshaped_data)
-                        reshaped = np.zeros(new_shape, dtype=dtype_data)
-
-                        for i, cl in enumerate(unique_labels):
-                            reshaped_multihot = np.round(
-                                map_coordinates((reshaped_data == cl).astype(float), coord_map, order=order_z,
-                                                cval=cval, mode='nearest'))
-                            reshaped[reshaped_multihot >= 0.5] = cl
-                        reshaped_final_data.append(reshaped[None])
-                else:
-                    reshaped_final_data.append(reshaped_data[None])
-            reshaped_final_data = np.vstack(reshaped_final_data)
+                target = reshaped_final_data[c] if reshaped_data is None else reshaped_data
+
+                def resample_slice(slice_id):
+                    slicer = [slice(None)] * 3
+                    slicer[axis] = slice_id
+                    slicer = tuple(slicer)
+                    target[slicer] = resize_fn(data[c][slicer].astype(compute_dtype, copy=False), new_shape_2d, order,
+                                               cval=cval, **kwargs)
+
+                _run_threaded(pool, resample_slice, shape[axis])
+
+                if reshaped_data is not None:
+                    def resample_along_axis(slice_id):
+                        slicer = [slice(None)] * 3
+                        slicer[other_axis] = slice_id
+                        slicer = tuple(slicer)
+                        reshaped_final_data[c][slicer] = map_coordinates(reshaped_data[slicer], coord_map,
+                                                                         order=order_z, cval=cval, mode='nearest')
+
+                    _run_threaded(pool, resample_along_axis, new_shape[other_axis])
         else:
-            reshaped = []
-            for c in range(data.shape[0]):
-                reshaped.append(resize_fn(data[c], new_shape, order, cval=cval, **kwargs)[None])
-            reshaped_final_data = np.vstack(reshaped)
-        return reshaped_final_data.astype(dtype_data)
-    else:
+            # input channel (cast) and resampled channel per thread
+            buffer_bytes += min(num_threads, data.shape[0]) * (np.prod(shape) + np.prod(new_shape)) * itemsize
+
+            def resample_channel(c):
+                reshaped_final_data[c] = resize_fn(data[c].astype(compute_dtype, copy=False), new_shape, order,
+                                                   cval=cval, **kwargs)
+
+            _run_threaded(pool, resample_channel, data.shape[0])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if stats is not None:
+        elapsed = time() - start
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        print("resampling %s -> %s: %.2f s with %d threads, peak buffer memory %.1f MB, peak rss %.1f MB" %
+              (str(tuple(shape)), str(tuple(new_shape)), elapsed, num_threads, buffer_bytes / 1e6, max_rss / 1e6))
+        stats.update({'seconds': elapsed, 'num_threads': num_threads, 'peak_buffer_bytes': int(buffer_bytes),
+                      'max_rss_bytes': int(max_rss)})
+    return reshaped_final_data
+
+
+def _resample_labels_channels(data, new_shape, orders, compute_dtype, pool, out):
+    def resample_channel(c):
+        out[c] = resample_labels(data[c], new_shape, orders, compute_dtype)
+
+    _run_threaded(pool, resample_channel, data.shape[0])
+
+
+def resample_data_or_seg_separable(data, new_shape, is_seg, axis=None, order=3, do_separate_z=False, cval=0,
+                                   order_z=0, compute_dtype=np.float32, num_threads=None, stats=None):
+    """
+    drop-in alternative for resample_data_or_seg (same arguments) that uses resample_separable. order is used along all
+    axes, or only in plane if do_separate_z (order_z along axis). Segmentations are resampled as one hot maps per
+    label with resample_labels unless all orders are 0. cval is unused because the volumes are edge padded. Select it
+    with plans['resampling'] = 'separable'
+    :param num_threads: channels are resampled in parallel threads
+    :param stats: see resample_data_or_seg
+    """
+    assert len(data.shape) == 4, "data must be (c, x, y, z)"
+    start = time()
+    if num_threads is None:
+        num_threads = default_resampling_threads
+    shape = np.array(data[0].shape)
+    new_shape = np.array(new_shape)
+    if np.all(shape == new_shape):
         print("no resampling necessary")
-        return data
+        return data.astype(compute_dtype)
+
+    orders = [order] * 3
+    if do_separate_z:
+        assert len(axis) == 1, "only one anisotropic axis supported"
+        orders[axis[0]] = order_z
+    reshaped_final_data = np.empty([data.shape[0]] + list(new_shape), dtype=data.dtype)
+    # output, intermediate results and temporary array of the passes per thread
+    buffer_bytes = reshaped_final_data.nbytes + min(num_threads, data.shape[0]) * 3 * np.prod(
+        np.maximum(shape, new_shape)) * np.dtype(compute_dtype).itemsize
+
+    pool = ThreadPool(num_threads) if num_threads > 1 else None
+    try:
+        if not is_seg or all([o == 0 for o in orders]):
+            def resample_channel(c):
+                reshaped_final_data[c] = resample_separable(data[c], new_shape, orders, compute_dtype)
+
+            _run_threaded(pool, resample_channel, data.shape[0])
+        else:
+            _resample_labels_channels(data, new_shape, orders, compute_dtype, pool, reshaped_final_data)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if stats is not None:
+        elapsed = time() - start
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        print("separable resampling %s -> %s: %.2f s with %d threads, peak buffer memory %.1f MB, peak rss %.1f MB" %
+              (str(tuple(shape)), str(tuple(new_shape)), elapsed, num_threads, buffer_bytes / 1e6, max_rss / 1e6))
+        stats.update({'seconds': elapsed, 'num_threads': num_threads, 'peak_buffer_bytes': int(buffer_bytes),
+                      'max_rss_bytes': int(max_rss)})
+    return reshaped_final_data
+
+
+resampling_functions = {'spline': resample_data_or_seg, 'separable': resample_data_or_seg_separable}
@@ -0,0 +1,135 @@
+import numpy as np
+from scipy.ndimage import find_objects
+
+
+def _cubic_kernel(x, a=-0.5):
+    x = np.abs(x)
+    return np.where(x <= 1, ((a + 2) * x - (a + 3)) * x * x + 1,
+                    np.where(x < 2, ((a * x - 5 * a) * x + 8 * a) * x - 4 * a, 0))
+
+
+def get_separable_weights(old_size, new_size, order):
+    """
+    1D interpolation table with the pixel center convention of skimage's resize and edge padding
+    :param order: 0 (nearest), 1 (linear) or 3 (cubic convolution, Keys a=-0.5)
+    :return: indices and weights, both (new_size, taps): output voxel i = sum_k weights[i, k] * input[indices[i, k]]
+    """
+    coords = float(old_size) / new_size * (np.arange(new_size) + 0.5) - 0.5
+    if order == 0:
+        indices = np.floor(coords + 0.5).astype(int)[:, None]
+        weights = np.ones((new_size, 1))
+    elif order == 1:
+        lower = np.floor(coords).astype(int)
+        t = coords - lower
+        indices = np.stack((lower, lower + 1), 1)
+        weights = np.stack((1 - t, t), 1)
+    elif order == 3:
+        lower = np.floor(coords).astype(int)
+        indices = lower[:, None] + np.arange(-1, 3)[None]
+        weights = _cubic_kernel(coords[:, None] - indices)
+    else:
+        raise ValueError("separable resampling supports order 0, 1 and 3, not %s" % str(order))
+    return np.clip(indices, 0, old_size - 1), weights
+
+
+def _resample_axis_separable(arr, axis, indices, weights, compute_dtype):
+    """
+    applies a table of get_separable_weights along axis. Needs the output and one output sized temporary array
+    """
+    new_shape = list(arr.shape)
+    new_shape[axis] = indices.shape[0]
+    weight_shape = [1] * arr.ndim
+    weight_shape[axis] = -1
+    out = np.empty(new_shape, dtype=arr.dtype if indices.shape[1] == 1 else compute_dtype)
+    np.take(arr, indices[:, 0], axis, out=out, mode='clip')
+    if indices.shape[1] == 1:
+        return out
+    out *= weights[:, 0].astype(compute_dtype).reshape(weight_shape)
+    tmp = np.empty_like(out)
+    for k in range(1, indices.shape[1]):
+        np.take(arr, indices[:, k], axis, out=tmp, mode='clip')
+        tmp *= weights[:, k].astype(compute_dtype).reshape(weight_shape)
+        out += tmp
+    return out
+
+
+def resample_separable(volume, new_shape, orders, compute_dtype=np.float32):
+    """
+    resamples a 3D volume with one 1D interpolation pass per axis (strongest downsampling first), without dense
+    coordinate grids. Memory scales with the output size
+    :param volume: (x, y, z)
+    :param new_shape:
+    :param orders: interpolation order per axis (see get_separable_weights)
+    :return: compute_dtype (volume.dtype if all orders are 0)
+    """
+    result = volume if all([o == 0 for o in orders]) else volume.astype(compute_dtype, copy=False)
+    for axis in np.argsort(np.array(new_shape, dtype=float) / np.array(volume.shape)):
+        if result.shape[axis] != new_shape[axis]:
+            indices, weights = get_separable_weights(result.shape[axis], new_shape[axis], orders[axis])
+            result = _resample_axis_separable(result, axis, indices, weights, compute_dtype)
+    return result
+
+
+def resample_labels(segmentation, new_shape, orders, compute_dtype=np.float32):
+    """
+    resamples all labels of a segmentation in one pass instead of interpolating a full size one hot map per label.
+    Each label is interpolated (with the tables of get_separable_weights) only within its bounding box and the output
+    region this box can reach. The most frequent label (usually the background) is not interpolated at all, its weight
+    is 1 - the sum of the others. Every voxel gets the label with the highest weight. The runtime therefore grows with
+    the summed bounding box sizes of the labels, not with number of labels x volume
+    :param segmentation: (x, y, z)
+    :param new_shape:
+    :param orders: interpolation order per axis (see get_separable_weights)
+    :return: resampled segmentation with the dtype of segmentation
+    """
+    if all([o == 0 for o in orders]):
+        return resample_separable(segmentation, new_shape, orders, compute_dtype)
+    tables = [get_separable_weights(s, n, o) for s, n, o in zip(segmentation.shape, new_shape, orders)]
+    labels, label_ids, counts = np.unique(segmentation, return_inverse=True, return_counts=True)
+    background = labels[np.argmax(counts)]
+    result = np.full(new_shape, background, dtype=segmentation.dtype)
+    if len(labels) == 1:
+        return result
+    weight_sum = np.zeros(new_shape, dtype=compute_dtype)
+    best_weight = np.zeros(new_shape, dtype=compute_dtype)
+    # bounding boxes of all labels in one pass over the segmentation
+    bboxes = find_objects(label_ids.reshape(segmentation.shape) + 1)
+
+    for cl, bbox in zip(labels, bboxes):
+        if cl == background or bbox is None:
+            continue
+        input_slicer = []
+        output_slicer = []
+        axis_tables = []
+        for (indices, weights), b in zip(tables, bbox):
+            # output voxels with at least one tap inside the bounding box, they are contiguous because indices are
+            # monotonic
+            reached = np.where(np.any((indices >= b.start) & (indices < b.stop), 1))[0]
+            if len(reached) == 0:
+                # downsampled by more than the support of the interpolation, no tap hits the label
+                break
+            output_lb, output_ub = reached[0], reached[-1] + 1
+            input_lb = indices[output_lb:output_ub].min()
+            input_ub = indices[output_lb:output_ub].max() + 1
+            input_slicer.append(slice(input_lb, input_ub))
+            output_slicer.append(slice(output_lb, output_ub))
+            axis_tables.append((indices[output_lb:output_ub] - input_lb, weights[output_lb:output_ub]))
+        if len(axis_tables) < len(tables):
+            continue
+        input_slicer = tuple(input_slicer)
+        output_slicer = tuple(output_slicer)
+
+        weight = (segmentation[input_slicer] == cl).astype(compute_dtype)
+        for axis, (indices, weights) in enumerate(axis_tables):
+            weight = _resample_axis_separable(weight, axis, indices, weights, compute_dtype)
+
+        weight_sum[output_slicer] += weight
+        region_weight = best_weight[output_slicer]
+        region_label = result[output_slicer]
+        # labels are processed in ascending order, ties go to the smaller label
+        mask = weight > region_weight
+        region_weight[mask] = weight[mask]
+        region_label[mask] = cl
+
+    result[best_weight <= 1 - weight_sum] = background
+    return result
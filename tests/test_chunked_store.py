@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from preprocessing.chunked_store import ChunkedCase, save_chunked_case
+
+
+@pytest.fixture
+def case_2d(tmp_path):
+    rs = np.random.RandomState(1234)
+    data = rs.rand(2, 40, 30).astype(np.float32)
+    seg = np.zeros((1, 40, 30), dtype=np.float32)
+    seg[0, 10:20, 5:15] = 1
+    seg[0, :3] = -1
+    folder = save_chunked_case(str(tmp_path), "case_0", data, seg, chunk_size=(16, 16, 16))
+    return ChunkedCase(folder), np.concatenate((data, seg))
+
+
+@pytest.mark.parametrize("key", [
+    (slice(None), None),
+    (slice(None), None, slice(5, 30)),
+    (Ellipsis, 3),
+    (-1, Ellipsis, None),
+    (None, 1, slice(2, 9), 4),
+    ([0, 2], slice(None), -1),
+    (0,),
+    (slice(1, None), 7, slice(None)),
+])
+def test_indexing_matches_numpy(case_2d, key):
+    case, expected = case_2d
+    result = case[key]
+    np.testing.assert_array_equal(result, expected[key])
+    assert result.shape == expected[key].shape
+
+
+def test_2d_loader_with_chunked_case(case_2d, tmp_path):
+    dataset_generator = pytest.importorskip("preprocessing.dataset_generator")
+    case, expected = case_2d
+    properties = {'classes': np.array([-1, 0, 1]), 'size_after_resampling': list(expected.shape[1:])}
+    dataset = {'case_0': {'chunked_case': case.folder, 'data_file': str(tmp_path / "case_0.npz"),
+                          'properties': properties}}
+    loader = dataset_generator.BatchGenerator2D(dataset, (32, 32), (32, 32), 2, oversample_foreground_percent=0.5)
+    batch = loader.gen_train_batch()
+    assert batch['data'].shape == (2, 2, 32, 32)
+    assert batch['seg'].shape == (2, 1, 32, 32)
@@ -0,0 +1,29 @@
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import pytest
+from time import sleep
+from inference.pipeline import array_to_shared_memory, shared_memory_array
+
+
+def _produce(q):
+    q.put(array_to_shared_memory(np.arange(24, dtype=np.float32).reshape(2, 3, 4)))
+
+
+def test_shared_memory_outlives_producer():
+    ctx = get_context("fork")
+    q = ctx.Queue()
+    producer = ctx.Process(target=_produce, args=(q,))
+    producer.start()
+    descriptor = q.get()
+    producer.join()
+    # give the resource tracker of the producer time to clean up after it
+    sleep(1)
+    assert producer.exitcode == 0
+
+    with shared_memory_array(descriptor) as arr:
+        np.testing.assert_array_equal(arr, np.arange(24, dtype=np.float32).reshape(2, 3, 4))
+        del arr
+    # the consumer frees the block
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=descriptor[0])
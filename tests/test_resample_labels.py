@@ -0,0 +1,26 @@
+import numpy as np
+from preprocessing.separable_resampling import resample_labels
+
+
+def test_label_missed_when_downsampling_by_more_than_2x():
+    segmentation = np.zeros((10, 10, 10), dtype=np.int16)
+    segmentation[2, 2:5, 2:5] = 1
+    resampled = resample_labels(segmentation, (4, 4, 4), [1, 1, 1])
+    assert resampled.shape == (4, 4, 4)
+    assert resampled.dtype == segmentation.dtype
+    assert np.all(resampled == 0)
+
+
+def test_downsampling_keeps_large_labels():
+    segmentation = np.zeros((20, 20, 20), dtype=np.int16)
+    segmentation[:10] = 1
+    segmentation[10:, 10:] = 2
+    resampled = resample_labels(segmentation, (5, 5, 5), [1, 1, 1])
+    assert np.all(resampled[:2] == 1)
+    assert np.all(resampled[3:, 3:] == 2)
+    assert np.all(resampled[3:, :2] == 0)
+
+
+def test_single_label():
+    segmentation = np.full((5, 5, 5), 3, dtype=np.uint8)
+    assert np.all(resample_labels(segmentation, (7, 7, 7), [1, 1, 1]) == 3)
@@ -1,9 +1,12 @@
 
 import numpy as np
 from utils.files_utils import *
-from utils.exp_utils import prep_exp
+from utils.exp_utils import prep_exp, save_softmax_for_export
 import argparse
 from preprocessing.preprocessing import resample_data_or_seg
+from preprocessing.dataset_generator import load_case
+from models.base_net import prepare_cpu_workers
+from preprocessing.chunked_store import ChunkedCase, chunked_case_suffix
 
 from config.default_configuration import get_default_configuration
 from multiprocessing import Pool
@@ -13,6 +16,11 @@ from training.net_training.UNetTrainer import UNetTrainer
 
 
 def resample_and_save(predicted, target_shape, output_file):
+    if isinstance(predicted, str):
+        assert isfile(predicted), "If isinstance(predicted, str) then isfile(predicted) must be True"
+        predicted_file = predicted
+        predicted = np.load(predicted)
+        os.remove(predicted_file)
     predicted_new_shape = resample_data_or_seg(predicted, target_shape, False, order=1, do_separate_z=False, cval=0)
     seg_new_shape = predicted_new_shape.argmax(0)
     np.savez_compressed(output_file, data=seg_new_shape.astype(np.uint8))
@@ -27,16 +35,18 @@ def predict_next(trainer, stage_to_be_predicted_folder):
 
     for pat in trainer.dataset_val.keys():
         print(pat)
-        data_file = trainer.dataset_val[pat]['data_file']
-        data_preprocessing = np.load(data_file)['data'][:-1]
+        data_preprocessing = load_case(trainer.dataset_val[pat])[:-1]
         predicted = trainer.predict_preprocessing_return_softmax(data_preprocessing, True, 1, False, 1,
                                                                      trainer.data_aug_params['mirror_axes'],
                                                                      True, True, 2, trainer.patch_size, True)
-        data_file_nofolder = data_file.split("/")[-1]
-        data_file_nextstage = join(stage_to_be_predicted_folder, data_file_nofolder)
-        data_nextstage = np.load(data_file_nextstage)['data']
-        target_shp = data_nextstage.shape[1:]
-        output_file = join(output_folder, data_file_nextstage.split("/")[-1][:-4] + "_segFromPrevStage.npz")
+        # the next stage may be stored in either layout, only its shape is needed
+        chunked_nextstage = join(stage_to_be_predicted_folder, pat + chunked_case_suffix)
+        if isdir(chunked_nextstage):
+            target_shp = ChunkedCase(chunked_nextstage).shape[1:]
+        else:
+            target_shp = np.load(join(stage_to_be_predicted_folder, pat + ".npz"))['data'].shape[1:]
+        output_file = join(output_folder, pat + "_segFromPrevStage.npz")
+        predicted = save_softmax_for_export(predicted, output_file[:-4] + ".npy")
         results.append(process_manager.starmap_async(resample_and_save, [(predicted, target_shp, output_file)]))
 
     _ = [i.get() for i in results]
@@ -62,6 +72,8 @@ if __name__ == "__main__":
     parser.add_argument("net_trainer")
     parser.add_argument("task")
     parser.add_argument("fold", type=int)
+    parser.add_argument("--num_cpu_workers", required=False, type=int, default=1,
+                        help="CPU inference only: split the sliding window tiles of a case among this many processes")
 
     args = parser.parse_args()
 
@@ -89,6 +101,9 @@ if __name__ == "__main__":
     trainer.load_dataset()
     trainer.do_split()
     trainer.load_best_checkpoint(train=False)
+    trainer.inference_num_cpu_workers = args.num_cpu_workers
+    if args.num_cpu_workers > 1:
+        prepare_cpu_workers()
 
     stage_to_be_predicted_folder = join(dataset_directory, trainer.plans['data_identifier'] + "_stage%d" % 1)
     output_folder = join(pardir(trainer.output_folder), "pred_next_stage")
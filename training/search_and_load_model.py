@@ -68,15 +68,12 @@ def load_best_model_for_inference(folder):
     return search_and_load_model(pkl_file, checkpoint, False)
 
 
-def load_model_and_checkpoint_files(folder, folds=None):
+def get_fold_folders(folder, folds=None):
     """
-    used for ensemble the five models of a cross-validation. This will restore the model from the
-    checkpoint in fold 0, load all parameters of the five folds in ram and return both. 
-    This will allow for fast switching between parameters
-
-    used for inference and test prediction
+    output folders of the given folds of a cross-validation
     :param folder:
-    :return:
+    :param folds: see load_model_and_checkpoint_files
+    :return: list of folders
     """
     if isinstance(folds, str):
         folds = [join(folder, "all")]
@@ -96,6 +93,20 @@ def load_model_and_checkpoint_files(folder, folds=None):
         print("found the following folds: ", folds)
     else:
         raise ValueError("Unknown value for folds. Type: %s. Expected: list of int, int, str or None", str(type(folds)))
+    return folds
+
+
+def load_model_and_checkpoint_files(folder, folds=None):
+    """
+    used for ensemble the five models of a cross-validation. This will restore the model from the
+    checkpoint in fold 0, load all parameters of the five folds in ram and return both. 
+    This will allow for fast switching between parameters
+
+    used for inference and test prediction
+    :param folder:
+    :return:
+    """
+    folds = get_fold_folders(folder, folds)
 
     trainer = search_and_load_model(join(folds[0], "model_best.model.pkl"))
     trainer.output_folder = folder
@@ -4,9 +4,10 @@ from datasets.data_augmentation.default_data_augmentation import get_default_aug
 from training.dataloading.dataset_loading import DataLoader3D, unpack_dataset
 from evaluation.evaluator import aggregate_scores
 from training.Trainer import Trainer
+from preprocessing.dataset_generator import load_case
 from models.base_net import DetectionNet
 from configs import net_training_out_dir
-from utils.exp_utils import store_seg_from_softmax
+from utils.exp_utils import store_seg_from_softmax, save_softmax_for_export
 
 import numpy as np
 from utilities.one_hot_encoding import to_one_hot
@@ -112,7 +113,9 @@ class CascadeTrainer(Trainer):
             if self.folder_with_preprocessing_data is not None:
                 self.dl_tr, self.dl_val = self.get_basic_generators()
 
-                if self.unpack_data:
+                if self.unpack_data and all([v.get('chunked_case') is not None for v in self.dataset.values()]):
+                    print("INFO: chunked case store, nothing to unpack")
+                elif self.unpack_data:
                     print("unpacking dataset")
                     unpack_dataset(self.folder_with_preprocessing_data)
                     print("done")
@@ -167,7 +170,7 @@ class CascadeTrainer(Trainer):
 
         for k in self.dataset_val.keys():
             properties = self.dataset[k]['properties']
-            data = np.load(self.dataset[k]['data_file'])['data']
+            data = load_case(self.dataset[k])
 
             # concat segmentation of previous step
             seg_from_prev_stage = np.load(join(self.folder_with_segs_from_prev_stage,
@@ -197,9 +200,7 @@ class CascadeTrainer(Trainer):
             else:
                 softmax_fname = None
 
-            if np.prod(softmax_pred.shape) > (2e9 / 4 * 0.9): # *0.9 just to be save
-                np.save(fname + ".npy", softmax_pred)
-                softmax_pred = fname + ".npy"
+            softmax_pred = save_softmax_for_export(softmax_pred, join(output_folder, fname + ".npy"))
             results.append(process_manager.starmap_async(store_seg_from_softmax,
                                                          ((softmax_pred, join(output_folder, fname + ".nii.gz"),
                                                            properties, 1, None, None, None, softmax_fname, None),
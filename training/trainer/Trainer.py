@@ -7,13 +7,14 @@ import torch
 import numpy as np
 from utils.data_utils import sum_tensor
 from torch.optim import lr_scheduler
-from preprocessing.dataset_generator import load_dataset, BatchGenerator3D, BatchGenerator2D, unpack_dataset
+from preprocessing.dataset_generator import load_dataset, BatchGenerator3D, BatchGenerator2D, unpack_dataset, \
+    load_case
 from training.loss_functions.dice_loss import DC_and_CE_loss
 from models.generic_UNet import Generic_UNet
 from models.initialization import InitWeights_He
 from torch import nn
 from datasets.data_augmentation.default_data_augmentation import get_default_aug, get_patch_size
-from utils.exp_utils import store_seg_from_softmax
+from utils.exp_utils import store_seg_from_softmax, save_softmax_for_export, softmax_to_seg_channelwise
 from evaluation.evaluator import aggregate_scores
 from multiprocessing import Pool
 from utils.metrics import ConfusionMatrix
@@ -68,6 +69,22 @@ class Trainer(GenericTrainer):
 
         self.inference_pad_border_mode = "constant"
         self.inference_pad_kwargs = {'constant_values': 0}
+        # tiles per forward pass in tiled prediction. None: derive it from inference_tile_memory_budget (bytes)
+        self.inference_tile_batch_size = 1
+        self.inference_tile_memory_budget = None
+        # run all mirrored versions of a tile in one forward pass (test time augmentation)
+        self.inference_mirror_in_batch = False
+        # softmax aggregation buffers larger than this (bytes) are kept in memory-mapped files in
+        # inference_memmap_folder (None: system temp folder). None: always keep them in memory
+        self.inference_max_in_memory_bytes = None
+        self.inference_memmap_folder = None
+        # dtype the tiles of a sliding window prediction are aggregated in: float32, float16 or bfloat16
+        self.inference_accumulation_dtype = "float32"
+        # number of processes the sliding window tiles of one case are split among when predicting on the cpu
+        self.inference_num_cpu_workers = 1
+        # if set, tiled prediction uses tiles larger than the training patch whose forward pass fits into this many
+        # bytes, see DetectionNet.plan_inference_tiles
+        self.inference_large_tile_budget = None
 
         self.update_fold(fold)
         self.pad_all_sides = None
@@ -155,7 +172,9 @@ class Trainer(GenericTrainer):
                                                   "_stage%d" % self.stage)
         if training:
             self.dl_tr, self.dl_val = self.get_basic_generators()
-            if self.unpack_data:
+            if self.unpack_data and all([v.get('chunked_case') is not None for v in self.dataset.values()]):
+                print("INFO: chunked case store, nothing to unpack")
+            elif self.unpack_data:
                 print("unpacking dataset")
                 unpack_dataset(self.folder_with_preprocessing_data)
                 print("done")
@@ -299,10 +318,11 @@ class Trainer(GenericTrainer):
         from preprocessing.preprocessing import GenericPreprocessor, Preprocessor2D
         if self.threeD:
             preprocessor = GenericPreprocessor(self.normalization_schemes, self.use_mask_for_norm,
-                                               self.intensity_properties)
+                                               self.intensity_properties, self.plans.get('resampling', "spline"))
         else:
             preprocessor = Preprocessor2D(self.normalization_schemes, self.use_mask_for_norm,
-                                             self.intensity_properties)
+                                             self.intensity_properties,
+                                             resampling=self.plans.get('resampling', "spline"))
 
         d, s, properties = preprocessor.preprocess_test(input_files,
                                                              self.plans['plans_per_stage'][self.stage]['current_spacing'])
@@ -327,16 +347,44 @@ class Trainer(GenericTrainer):
         print("done")
 
     def predict_preprocessing_return_softmax(self, data, do_mirroring, num_repeats, use_train_mode, batch_size,
-                                                 mirror_axes, tiled, tile_in_z, step, min_size, use_gaussian):
+                                                 mirror_axes, tiled, tile_in_z, step, min_size, use_gaussian,
+                                                 roi_mask=None):
 
         assert isinstance(self.net, (DetectionNet, nn.DataParallel))
+        gaussian_sigma_scale = 1. / 8
+        if tiled and self.inference_large_tile_budget is not None:
+            plan = self.net.plan_inference_tiles(data.shape[-len(min_size):], min_size, data.shape[0],
+                                                 self.inference_large_tile_budget, step)
+            min_size, step, gaussian_sigma_scale = plan['patch_size'], plan['step'], plan['gaussian_sigma_scale']
         return self.net.predict_3D(data, do_mirroring, num_repeats, use_train_mode, batch_size, mirror_axes,
                                        tiled, tile_in_z, step, min_size, use_gaussian=use_gaussian,
                                        pad_border_mode=self.inference_pad_border_mode,
-                                       pad_kwargs=self.inference_pad_kwargs)[2]
+                                       pad_kwargs=self.inference_pad_kwargs,
+                                       tile_batch_size=self.inference_tile_batch_size,
+                                       tile_memory_budget=self.inference_tile_memory_budget,
+                                       mirror_in_batch=self.inference_mirror_in_batch,
+                                       max_in_memory_bytes=self.inference_max_in_memory_bytes,
+                                       memmap_folder=self.inference_memmap_folder,
+                                       accumulation_dtype=self.inference_accumulation_dtype,
+                                       roi_mask=roi_mask,
+                                       num_cpu_workers=self.inference_num_cpu_workers,
+                                       gaussian_sigma_scale=gaussian_sigma_scale)[2]
+
+    def predict_preprocessed_packed_return_softmax(self, data_list, do_mirroring, num_repeats, use_train_mode,
+                                                   mirror_axes):
+        """
+        softmax predictions of several preprocessed cases that are not larger than self.patch_size, computed in a
+        single batch (see DetectionNet.predict_packed)
+        """
+        assert isinstance(self.net, (DetectionNet, nn.DataParallel))
+        return self.net.predict_packed(data_list, do_mirroring, num_repeats, use_train_mode, mirror_axes,
+                                       self.patch_size, pad_border_mode=self.inference_pad_border_mode,
+                                       pad_kwargs=self.inference_pad_kwargs,
+                                       mirror_in_batch=self.inference_mirror_in_batch)
 
     def validate(self, do_mirroring=True, use_train_mode=False, tiled=True, step=2, save_softmax=True,
-                 use_gaussian=True, compute_global_dice=True, override=True, validation_folder_name='validation'):
+                 use_gaussian=True, compute_global_dice=True, override=True, validation_folder_name='validation',
+                 use_roi_mask=False):
 
         assert self.was_initialized, "must initialize, ideally with checkpoint (or train first)"
         if self.dataset_val is None:
@@ -364,25 +412,35 @@ class Trainer(GenericTrainer):
             properties = self.dataset[k]['properties']
             fname = properties['list_of_data_files'][0].split("/")[-1][:-12]
             if override or (not isfile(join(output_folder, fname + ".nii.gz"))):
-                data = np.load(self.dataset[k]['data_file'])['data']
+                data = load_case(self.dataset[k])
 
                 transpose_forward = self.plans.get('transpose_forward')
                 if transpose_forward is not None:
                     data = data.transpose([0] + [i+1 for i in transpose_forward])
 
                 print(k, data.shape)
+                # the cropper marks everything outside the nonzero mask with -1
+                roi_mask = data[-1] != -1 if use_roi_mask else None
                 data[-1][data[-1] == -1] = 0
 
                 softmax_pred = self.predict_preprocessing_return_softmax(data[:-1], do_mirroring, 1,
                                                                              use_train_mode, 1, mirror_axes, tiled,
                                                                              True, step, self.patch_size,
-                                                                             use_gaussian=use_gaussian)
+                                                                             use_gaussian=use_gaussian,
+                                                                             roi_mask=roi_mask)
+                if use_roi_mask:
+                    print(k, "skipped tiles:", self.net.inference_tile_stats)
                 if transpose_forward is not None:
                     transpose_backward = self.plans.get('transpose_backward')
                     softmax_pred = softmax_pred.transpose([0] + [i+1 for i in transpose_backward])
 
                 if compute_global_dice:
-                    predicted_segmentation = softmax_pred.argmax(0)
+                    if isinstance(softmax_pred, np.memmap):
+                        predicted_segmentation = softmax_to_seg_channelwise(lambda c: softmax_pred[c],
+                                                                            softmax_pred.shape[0],
+                                                                            softmax_pred.shape[1:])
+                    else:
+                        predicted_segmentation = softmax_pred.argmax(0)
                     gt_segmentation = data[-1]
                     labels = properties['classes']
                     labels = [int(i) for i in labels if i > 0]
@@ -404,9 +462,7 @@ class Trainer(GenericTrainer):
                 else:
                     softmax_fname = None
 
-                if np.prod(softmax_pred.shape) > (2e9 / 4 * 0.9): # *0.9 just to be save
-                    np.save(join(output_folder, fname + ".npy"), softmax_pred)
-                    softmax_pred = join(output_folder, fname + ".npy")
+                softmax_pred = save_softmax_for_export(softmax_pred, join(output_folder, fname + ".npy"))
                 results.append(export_pool.starmap_async(store_seg_from_softmax,
                                                          ((softmax_pred, join(output_folder, fname + ".nii.gz"),
                                                           properties, 3, None, None, None, softmax_fname, None),
@@ -8,6 +8,7 @@ import shutil
 from utils.files_utils import *
 import pickle
 from collections import OrderedDict
+from preprocessing.chunked_store import ChunkedCase, chunked_case_suffix
 
 def split_4D_nifti(filename, output_folder):
     img_itk = sitk.ReadImage(filename)
@@ -177,7 +178,11 @@ def get_net_numpool(patch_size, maxpool_cap=Generic_UNet.MAX_NUMPOOL_3D,
 def contain_classes_in_slice(args):
 
     npz_file, pkl_file, all_classes = args
-    seg_map = np.load(npz_file)['data'][-1]
+    if npz_file.endswith(chunked_case_suffix):
+        # int8 segmentation of the chunked layout, no need to read the data
+        seg_map = ChunkedCase(npz_file).get_seg()[-1]
+    else:
+        seg_map = np.load(npz_file)['data'][-1]
     with open(pkl_file, 'rb') as f:
         props = pickle.load(f)
     #if props.get('classes_in_slice_per_axis') is not None:
@@ -11,7 +11,11 @@ import plotting
 import importlib.util
 from copy import deepcopy
 import SimpleITK as sitk
-from preprocessing.preprocessor import get_lowres_axis, get_do_separate_z, resample_data_or_seg
+import shutil
+from threading import Thread
+from multiprocessing.pool import ThreadPool
+from preprocessing.preprocessor import get_lowres_axis, get_do_separate_z, resampling_functions, \
+    default_resampling_threads
 from utils.files_utils import *
 
 def get_logger(exp_dir):
@@ -96,23 +100,112 @@ def prep_exp(dataset_path, exp_path, server_env, use_stored_settings=True, is_tr
 
 
 
+def softmax_to_seg_channelwise(get_channel, num_channels, shape, region_class_order=None, out=None):
+    """
+    argmax (or region thresholding) over the channels of a softmax prediction that holds only one channel in memory
+    at a time
+    :param get_channel: get_channel(c) returns channel c of the softmax as array of shape
+    :param num_channels:
+    :param shape:
+    :param region_class_order:
+    :param out: uint8 array of shape the segmentation is written into (e.g. a view into a larger array). None: a new
+    array is allocated
+    :return: segmentation (uint8)
+    """
+    if out is None:
+        seg = np.zeros(shape, dtype=np.uint8)
+    else:
+        seg = out
+        seg[:] = 0
+    if region_class_order is None:
+        best = np.full(shape, -np.inf, dtype=np.float32)
+        for c in range(num_channels):
+            channel = get_channel(c)
+            # strictly greater: ties go to the lower class, like argmax
+            mask = channel > best
+            seg[mask] = c
+            best[mask] = channel[mask]
+    else:
+        for i, c in enumerate(region_class_order):
+            seg[get_channel(i) > 0.5] = c
+    return seg
+
+
+def save_softmax_for_export(softmax, npy_fname, max_in_memory_bytes=2e9 * 0.9):
+    """
+    store_seg_from_softmax runs in worker processes and large softmax predictions must not be pickled. Memory-mapped
+    predictions and predictions larger than max_in_memory_bytes are therefore handed over as .npy file. Memory-mapped
+    predictions are written one channel at a time (or just moved if they already are a complete .npy file), so they
+    are never fully loaded
+    :param softmax: (c, x, y, z) array or np.memmap, e.g. from predict_3D(..., max_in_memory_bytes=...)
+    :param npy_fname:
+    :param max_in_memory_bytes:
+    :return: softmax or npy_fname. Either way the result can be passed to store_seg_from_softmax
+    """
+    if isinstance(softmax, np.memmap) and softmax.filename is not None:
+        softmax.flush()
+        src = softmax.filename
+        on_disk = np.load(src, mmap_mode='r')
+        if on_disk.shape == softmax.shape and softmax.flags.c_contiguous and on_disk.dtype == softmax.dtype:
+            del on_disk
+            shutil.move(src, npy_fname)
+        else:
+            del on_disk
+            out = np.lib.format.open_memmap(npy_fname, mode='w+', dtype=softmax.dtype, shape=softmax.shape)
+            for c in range(softmax.shape[0]):
+                out[c] = softmax[c]
+            out.flush()
+            del out
+            os.remove(src)
+        return npy_fname
+    if softmax.nbytes > max_in_memory_bytes:
+        print("Output is too large. Saving output temporarily to disk")
+        np.save(npy_fname, softmax)
+        return npy_fname
+    return softmax
+
+
 def store_seg_from_softmax(segmentation_softmax, out_fname, dct, order=1, region_class_order=None,
                                          seg_postprogess_fn=None, seg_postprocess_args=None, resampled_npz_fname=None,
-                                         non_postprocessed_fname=None):
-
+                                         non_postprocessed_fname=None, compress_nifti=True, compress_npz=True):
+    """
+    resamples the softmax back to the spacing of the raw data and stores its argmax as nifti. The softmax is
+    resampled in float32 in groups of default_resampling_threads channels (one channel per thread of a shared pool)
+    and the argmax is written (uint8) directly into the bbox of the cropping, so neither the resampled softmax nor the
+    segmentation is ever held as float64
+    :param segmentation_softmax: (c, x, y, z) array or .npy file (see save_softmax_for_export), which is deleted
+    :param out_fname: .nii.gz file
+    :param dct: properties of the case
+    :param order: interpolation order of the resampling
+    :param region_class_order:
+    :param seg_postprogess_fn:
+    :param seg_postprocess_args:
+    :param resampled_npz_fname: if not None, the resampled softmax is also stored there as float16 (written in a
+    background thread while the nifti is exported)
+    :param non_postprocessed_fname:
+    :param compress_nifti: False: store .nii instead of .nii.gz (much faster to write)
+    :param compress_npz: False: store resampled_npz_fname with np.savez instead of np.savez_compressed
+    :return:
+    """
     if isinstance(segmentation_softmax, str):
         assert isfile(segmentation_softmax), "If isinstance(segmentation_softmax, str) then " \
                                              "isfile(segmentation_softmax) must be True"
         del_file = deepcopy(segmentation_softmax)
-        segmentation_softmax = np.load(segmentation_softmax)
+        # softmax predictions on disk are too large to be loaded at once, they are processed one channel at a time
+        segmentation_softmax = np.load(segmentation_softmax, mmap_mode='r')
         os.remove(del_file)
+        on_disk = True
+    else:
+        on_disk = False
 
     # first resample, then put result into bbox of cropping, then save
     current_shape = segmentation_softmax.shape
     shape_original_after_cropping = dct.get('size_after_cropping')
     shape_original_before_cropping = dct.get('original_size_of_raw_data')
+    num_channels = current_shape[0]
+    seg_shape = tuple(shape_original_after_cropping)
 
-    if np.any(np.array(current_shape) != np.array(shape_original_after_cropping)):
+    if np.any(np.array(current_shape[1:]) != np.array(shape_original_after_cropping)):
         if get_do_separate_z(dct.get('original_spacing')):
             do_separate_z = True
             lowres_axis = get_lowres_axis(dct.get('original_spacing'))
@@ -124,41 +217,75 @@ def store_seg_from_softmax(segmentation_softmax, out_fname, dct, order=1, region
             lowres_axis = None
 
         print("separate z:",do_separate_z, "lowres axis", lowres_axis)
-        seg_old_spacing = resample_data_or_seg(segmentation_softmax, shape_original_after_cropping, is_seg=False,
-                                               axis=lowres_axis, order=order, do_separate_z=do_separate_z, cval=0)
-        #seg_old_spacing = resize_softmax_output(segmentation_softmax, shape_original_after_cropping, order=order)
+        resample_kwargs = {'is_seg': False, 'axis': lowres_axis, 'order': order, 'do_separate_z': do_separate_z,
+                           'cval': 0, 'compute_dtype': np.float32}
+        # the softmax is resampled the same way the case was preprocessed (see GenericPreprocessor.resampling)
+        resample_fn = resampling_functions[dct.get('resampling', 'spline')]
+        resample_channel = lambda c: resample_fn(np.asarray(segmentation_softmax[c:c + 1], dtype=np.float32),
+                                                 seg_shape, num_threads=1, **resample_kwargs)[0]
+        # the channels are requested in order, the next group is resampled in parallel when the first of it is needed
+        pool = ThreadPool(default_resampling_threads)
+        resampled_channels = {}
+
+        def get_channel(c):
+            if c not in resampled_channels:
+                group = list(range(c, min(c + default_resampling_threads, num_channels)))
+                resampled_channels.update(zip(group, pool.map(resample_channel, group)))
+            return resampled_channels.pop(c)
     else:
-        seg_old_spacing = segmentation_softmax
+        pool = None
+        get_channel = lambda c: np.asarray(segmentation_softmax[c], dtype=np.float32)
 
     if resampled_npz_fname is not None:
-        np.savez_compressed(resampled_npz_fname, softmax=seg_old_spacing.astype(np.float16))
-        save_pickle(dct, resampled_npz_fname[:-4] + ".pkl")
+        # the resampled channels are collected as float16 while the argmax is computed
+        if on_disk:
+            resampled = np.lib.format.open_memmap(resampled_npz_fname[:-4] + "_tmp.npy", mode='w+',
+                                                  dtype=np.float16, shape=(num_channels,) + seg_shape)
+        else:
+            resampled = np.zeros((num_channels,) + seg_shape, dtype=np.float16)
+        get_resampled_channel = get_channel
+
+        def get_channel(c):
+            channel = get_resampled_channel(c)
+            resampled[c] = channel
+            return channel
+
+    try:
+        bbox = dct.get('crop_bbox')
+        if bbox is not None:
+            seg_old_size = np.zeros(shape_original_before_cropping, dtype=np.uint8)
+            for c in range(3):
+                bbox[c][1] = np.min((bbox[c][0] + seg_shape[c], shape_original_before_cropping[c]))
+            seg_in_bbox = seg_old_size[bbox[0][0]:bbox[0][1], bbox[1][0]:bbox[1][1], bbox[2][0]:bbox[2][1]]
+            if seg_in_bbox.shape == seg_shape:
+                softmax_to_seg_channelwise(get_channel, num_channels, seg_shape, region_class_order, out=seg_in_bbox)
+            else:
+                seg_in_bbox[:] = softmax_to_seg_channelwise(get_channel, num_channels, seg_shape, region_class_order)[
+                    tuple([slice(0, i) for i in seg_in_bbox.shape])]
+        else:
+            seg_old_size = softmax_to_seg_channelwise(get_channel, num_channels, seg_shape, region_class_order)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    if region_class_order is None:
-        seg_old_spacing = seg_old_spacing.argmax(0)
-    else:
-        seg_old_spacing_final = np.zeros(seg_old_spacing.shape[1:])
-        for i, c in enumerate(region_class_order):
-            seg_old_spacing_final[seg_old_spacing[i] > 0.5] = c
-        seg_old_spacing = seg_old_spacing_final
-
-    bbox = dct.get('crop_bbox')
-
-    if bbox is not None:
-        seg_old_size = np.zeros(shape_original_before_cropping)
-        for c in range(3):
-            bbox[c][1] = np.min((bbox[c][0] + seg_old_spacing.shape[c], shape_original_before_cropping[c]))
-        seg_old_size[bbox[0][0]:bbox[0][1],
-        bbox[1][0]:bbox[1][1],
-        bbox[2][0]:bbox[2][1]] = seg_old_spacing
-    else:
-        seg_old_size = seg_old_spacing
+    npz_writer = None
+    if resampled_npz_fname is not None:
+        if on_disk:
+            resampled.flush()
+        save_fn = np.savez_compressed if compress_npz else np.savez
+        # zlib and file io release the GIL, so the npz is written while the nifti is exported
+        npz_writer = Thread(target=save_fn, args=(resampled_npz_fname,), kwargs={'softmax': resampled})
+        npz_writer.start()
+        save_pickle(dct, resampled_npz_fname[:-4] + ".pkl")
 
     if seg_postprogess_fn is not None:
         seg_old_size_postprocessed = seg_postprogess_fn(np.copy(seg_old_size), *seg_postprocess_args)
     else:
         seg_old_size_postprocessed = seg_old_size
 
+    if not compress_nifti and out_fname.endswith(".nii.gz"):
+        out_fname = out_fname[:-3]
     seg_resized_itk = sitk.GetImageFromArray(seg_old_size_postprocessed.astype(np.uint8))
     seg_resized_itk.SetSpacing(dct['itk_spacing'])
     seg_resized_itk.SetOrigin(dct['itk_origin'])
@@ -166,12 +293,20 @@ def store_seg_from_softmax(segmentation_softmax, out_fname, dct, order=1, region
     sitk.WriteImage(seg_resized_itk, out_fname)
 
     if (non_postprocessed_fname is not None) and (seg_postprogess_fn is not None):
+        if not compress_nifti and non_postprocessed_fname.endswith(".nii.gz"):
+            non_postprocessed_fname = non_postprocessed_fname[:-3]
         seg_resized_itk = sitk.GetImageFromArray(seg_old_size.astype(np.uint8))
         seg_resized_itk.SetSpacing(dct['itk_spacing'])
         seg_resized_itk.SetOrigin(dct['itk_origin'])
         seg_resized_itk.SetDirection(dct['itk_direction'])
         sitk.WriteImage(seg_resized_itk, non_postprocessed_fname)
 
+    if npz_writer is not None:
+        npz_writer.join()
+        if on_disk:
+            del resampled
+            os.remove(resampled_npz_fname[:-4] + "_tmp.npy")
+
 
 
 def import_module(name, path):